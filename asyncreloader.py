@@ -0,0 +1,74 @@
+"""
+A code reloader for applications built around an asyncio event loop.  As
+this library targets Python 2, this uses 'trollius', the backport of asyncio.
+
+Rather than having a thread detect file changes and apply them whenever they
+happen, file changes are detected in an executor and the resulting reloads
+are applied on the event loop thread, between the application's own tasks.
+
+    cr = AsyncCodeReloader()
+    cr.AddDirectory("game", scriptDirPath)
+    task = asyncio.async(cr.Run())
+"""
+
+import trollius as asyncio
+from trollius import From, Return
+
+import reloader
+import filechanges
+from filechanges import asyncwatcher
+
+
+class AsyncCodeReloader(reloader.CodeReloader):
+    fileChangeWatcher = None
+
+    def GetChangeHandler(self, cb, *args, **kwargs):
+        kwargs["useThread"] = False
+
+        # The watcher stands in for the handler, so that directories are
+        # registered in step with the scanning done in the executor.
+        handler = filechanges.ChangeHandler(cb, *args, **kwargs)
+        self.fileChangeWatcher = asyncwatcher.ChangeWatcher(handler)
+        return self.fileChangeWatcher
+
+    def EndMonitoring(self):
+        if self.fileChangeWatcher is not None:
+            self.fileChangeWatcher.Close()
+        reloader.CodeReloader.EndMonitoring(self)
+
+    def StartNotificationServer(self, socketPath):
+        # Reported files are applied on the event loop, which must be the
+        # current one of the calling thread.
+        if self.fileChangeWatcher is None:
+            raise RuntimeError("File change notifications require file change monitoring")
+        self.fileChangeWatcher.GetLoop()
+        return reloader.CodeReloader.StartNotificationServer(self, socketPath)
+
+    @asyncio.coroutine
+    def Run(self):
+        """
+        Apply file changes as they are detected, until monitoring is ended.
+        """
+        if self.fileChangeWatcher is None:
+            raise RuntimeError("File changes are not being monitored")
+
+        while True:
+            changes = yield From(self.fileChangeWatcher.Next())
+            if changes is None:
+                break
+            self.ProcessChangedFiles(changes)
+
+    @asyncio.coroutine
+    def ScanNow(self):
+        """
+        Look for file changes immediately, and apply any that are found before
+        returning.  This is independent of any 'Run' task.
+        """
+        if self.fileChangeWatcher is None:
+            raise Return(False)
+
+        watcher = self.fileChangeWatcher
+        yield From(watcher.ScanNow())
+        while watcher.batches:
+            self.ProcessChangedFiles(watcher.batches.pop(0))
+        raise Return(True)
@@ -0,0 +1,182 @@
+"""
+Script directories packed into a single file, for where the scripts are not
+edited in place and listing, reading and compiling each of them on every
+start is slow.
+
+    python bundle.py <script directory> <bundle path>
+
+A bundle holds an index of the scripts by their path relative to the script
+directory, followed by the compiled code of each written with 'marshal'.  A
+'BundleScriptDirectory' maps the bundle into memory and loads its scripts
+from it, into the same namespaces and with the same file paths as if they
+had been loaded from the script directory.  The script directory itself
+need not exist.
+
+If it does exist and 'sourceOverrides' is set, any script in it which is not
+in the bundle, or which differs in size or mtime from the version which was
+packed, is loaded from the script directory instead.  'CodeReloader.AddBundle'
+monitors the script directory for changes in this case.
+"""
+
+import os, sys, imp, mmap, struct, marshal, logging
+
+import namespace
+from filechanges import datafile
+
+logger = logging.getLogger("reloader")
+
+BUNDLE_MAGIC = "PYBUNDLE"
+# Bundles are mapped into memory rather than loaded with 'datafile', so they
+# carry their own version, to be increased if the layout changes.
+BUNDLE_VERSION = 1
+# The bundle magic, bundle version, interpreter magic number and index length.
+BUNDLE_HEADER = struct.Struct("<8sI4sI")
+
+
+class Bundle(object):
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.file = None
+        self.map = None
+        self.Open()
+
+    def __repr__(self):
+        return "<Bundle filePath='%s'>" % self.filePath
+
+    def Open(self):
+        self.file = open(self.filePath, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, interpreterMagic, indexLength = BUNDLE_HEADER.unpack_from(self.map, 0)
+            if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+                raise ValueError("Not a script bundle of this version", self.filePath)
+            if interpreterMagic != imp.get_magic():
+                raise ValueError("Script bundle compiled by another interpreter version", self.filePath)
+
+            self.dataOffset = BUNDLE_HEADER.size + indexLength
+            self.baseDirPath, self.entries = marshal.loads(self.map[BUNDLE_HEADER.size:self.dataOffset])
+        except:
+            self.Close()
+            raise
+
+    def Close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def GetEntry(self, relativePath):
+        # Returns '(size, mtime, sourceHash, codeHash, offset, length)' or None.
+        return self.entries.get(relativePath)
+
+    def GetCode(self, entry):
+        if self.map is None:
+            self.Open()
+        offset, length = entry[4:6]
+        offset += self.dataOffset
+        return marshal.loads(self.map[offset:offset+length])
+
+
+class BundleScriptDirectory(namespace.ScriptDirectory):
+    # Whether scripts in the script directory take the place of those in the
+    # bundle, where they differ.
+    sourceOverrides = False
+    bundle = None
+
+    def __init__(self, bundlePath, baseDirPath=None, baseNamespace=None, delScriptGlobals=False, codeCache=None, sourceOverrides=None, manifestPath=None):
+        namespace.ScriptDirectory.__init__(self, baseDirPath, baseNamespace, delScriptGlobals=delScriptGlobals, codeCache=codeCache, manifestPath=manifestPath)
+        if sourceOverrides is not None:
+            self.sourceOverrides = sourceOverrides
+
+        self.bundle = Bundle(bundlePath)
+        # By default, the directory the scripts were packed from.
+        if baseDirPath is None:
+            self.SetBaseDirectory(self.bundle.baseDirPath)
+
+    def LoadDirectory(self, dirPath):
+        if self.sourceOverrides and os.path.isdir(dirPath):
+            namespace.ScriptDirectory.LoadDirectory(self, dirPath)
+
+        # The rest are found in the index, rather than by listing directories.
+        for relativePath in sorted(self.bundle.entries):
+            filePath = os.path.join(self.baseDirPath, *relativePath.split("/"))
+            if filePath in self.filesByPath:
+                continue
+            scriptFile = self.LoadScript(filePath, self.GetNamespacePath(os.path.dirname(filePath)))
+            self.RegisterScript(scriptFile)
+
+    def LoadScript(self, filePath, namespacePath):
+        entry = self.bundle.GetEntry(self.GetRelativePath(filePath))
+        if entry is None or self.IsOverridden(filePath, entry):
+            return namespace.ScriptDirectory.LoadScript(self, filePath, namespacePath)
+
+        logger.debug("LoadScript %s (bundled)", filePath)
+        size, mtime, sourceHash, codeHash = entry[:4]
+        scriptFile = self.scriptFileClass(filePath, namespacePath, implicitLoad=False, delGlobals=self.delScriptGlobals, codeCache=self.codeCache)
+        scriptFile.LoadCode(filePath, self.bundle.GetCode(entry), sourceHash, codeHash)
+        return scriptFile
+
+    def CompileScripts(self, filePaths):
+        # Only the scripts which are not to be loaded from the bundle.
+        filePaths = [ filePath for filePath in filePaths if self.IsLoadedFromSource(filePath) ]
+        if len(filePaths) > 1:
+            namespace.ScriptDirectory.CompileScripts(self, filePaths)
+
+    def IsLoadedFromSource(self, filePath):
+        entry = self.bundle.GetEntry(self.GetRelativePath(filePath))
+        return entry is None or self.IsOverridden(filePath, entry)
+
+    def IsOverridden(self, filePath, entry):
+        if not self.sourceOverrides:
+            return False
+        try:
+            t = os.stat(filePath)
+        except OSError:
+            return False
+        return (t.st_size, t.st_mtime) != entry[:2]
+
+    def Unload(self):
+        namespace.ScriptDirectory.Unload(self)
+        if self.bundle is not None:
+            self.bundle.Close()
+
+
+def PackDirectory(baseDirPath, bundlePath, scriptDirectoryClass=namespace.ScriptDirectory):
+    """
+    Write the scripts in the given directory to a bundle, using the rules of
+    the given script directory class to decide which files are scripts.
+    Returns the number of scripts written.
+    """
+    baseDirPath = os.path.abspath(baseDirPath)
+    scriptDirectory = scriptDirectoryClass(baseDirPath, None)
+
+    entries = {}
+    codeData = []
+    offset = 0
+    scripts = sorted(scriptDirectory.FindScripts(baseDirPath))
+    if scriptDirectory.compileProcesses and len(scripts) > 1:
+        scriptDirectory.CompileScripts([ filePath for (filePath, namespacePath) in scripts ])
+
+    for filePath, namespacePath in scripts:
+        t = os.stat(filePath)
+        scriptFile = scriptDirectory.LoadScript(filePath, namespacePath)
+        data = marshal.dumps(scriptFile.codeObject)
+        entries[scriptDirectory.GetRelativePath(filePath)] = (t.st_size, t.st_mtime, scriptFile.sourceHash, scriptFile.codeHash, offset, len(data))
+        codeData.append(data)
+        offset += len(data)
+
+    index = marshal.dumps((baseDirPath, entries))
+    header = BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, imp.get_magic(), len(index))
+    datafile.Write(bundlePath, [ header, index ] + codeData)
+    return len(entries)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage: %s <script directory> <bundle path>" % sys.argv[0]
+        sys.exit(1)
+
+    count = PackDirectory(sys.argv[1], sys.argv[2])
+    print "%d scripts written to '%s'" % (count, sys.argv[2])
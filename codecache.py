@@ -0,0 +1,140 @@
+"""
+A cache of compiled script code on disk, so that scripts which have not
+changed since they were last loaded do not need compiling again.
+
+There is one entry per script path.  Each holds the size, mtime and source
+fingerprint of the script it was compiled from, along with the magic number
+of the interpreter which compiled it, and is only used if all of these still
+match.  The mtime is in nanoseconds where the interpreter provides it
+('GetModificationTime'), but it is the fingerprint, a hash of the whole
+source, which keeps a script rewritten within the mtime resolution with the
+same size from being given the code of its earlier version.  Entries are written with 'marshal' and renamed into place, see
+'filechanges.datafile'.
+
+The cache directory should be outside of any script directory.  Once the
+entries in it take up more than 'maxSize' bytes, the least recently used
+are removed.  How often entries were used, missing, written and removed is
+counted in 'statistics'.
+"""
+
+import os, imp, hashlib, logging, collections
+
+from filechanges import datafile
+
+logger = logging.getLogger("reloader")
+
+# Version 2 moved the version out of the entry header, see 'filechanges.datafile'.
+CACHE_VERSION = 2
+ENTRY_SUFFIX = ".code"
+
+
+def GetModificationTime(t):
+    # Python 2 only has the float mtime, which may be coarser.
+    return getattr(t, "st_mtime_ns", t.st_mtime)
+
+
+class CodeCache(object):
+    maxSize = 64 * 1024 * 1024
+
+    def __init__(self, dirPath, maxSize=None):
+        self.dirPath = dirPath
+        if maxSize is not None:
+            self.maxSize = maxSize
+        # Not known until the first entry is written.
+        self.totalSize = None
+        self.statistics = collections.defaultdict(int)
+
+        if not os.path.isdir(self.dirPath):
+            os.makedirs(self.dirPath)
+
+    def __repr__(self):
+        return "<CodeCache dirPath='%s'>" % self.dirPath
+
+    def GetEntryPath(self, filePath):
+        return os.path.join(self.dirPath, hashlib.sha1(filePath).hexdigest() + ENTRY_SUFFIX)
+
+    def GetHeader(self, filePath, size, mtime, sourceHash):
+        return (imp.get_magic(), filePath, size, mtime, sourceHash)
+
+    def Get(self, filePath, size, mtime, sourceHash):
+        """
+        Returns '(codeObject, codeHash)' for the given script, or None if
+        there is no entry matching it.
+        """
+        entryPath = self.GetEntryPath(filePath)
+        values = datafile.Load(entryPath, CACHE_VERSION, "code cache entry")
+        if values is None or values[0] != self.GetHeader(filePath, size, mtime, sourceHash):
+            self.statistics["misses"] += 1
+            return None
+        header, codeHash, codeObject = values
+
+        # The modification time of an entry is when it was last used.
+        try:
+            os.utime(entryPath, None)
+        except OSError:
+            pass
+        self.statistics["hits"] += 1
+        return codeObject, codeHash
+
+    def Put(self, filePath, size, mtime, sourceHash, codeObject, codeHash):
+        entryPath = self.GetEntryPath(filePath)
+        oldSize = self.GetEntrySize(entryPath)
+        try:
+            entrySize = datafile.Save(entryPath, CACHE_VERSION, (self.GetHeader(filePath, size, mtime, sourceHash), codeHash, codeObject))
+        except (IOError, OSError), e:
+            logger.warning("Unable to write code cache entry for '%s': %s", filePath, e)
+            return
+
+        self.statistics["writes"] += 1
+        if self.totalSize is None:
+            self.totalSize = self.GetTotalSize()
+        else:
+            self.totalSize += entrySize - oldSize
+        if self.totalSize > self.maxSize:
+            self.Evict()
+
+    def GetEntrySize(self, entryPath):
+        try:
+            return os.path.getsize(entryPath)
+        except OSError:
+            return 0
+
+    def GetEntries(self):
+        # Returns '(mtime, size, path)' for each entry.
+        entries = []
+        for entryName in os.listdir(self.dirPath):
+            if not entryName.endswith(ENTRY_SUFFIX):
+                continue
+            entryPath = os.path.join(self.dirPath, entryName)
+            try:
+                t = os.stat(entryPath)
+            except OSError:
+                continue
+            entries.append((t.st_mtime, t.st_size, entryPath))
+        return entries
+
+    def GetTotalSize(self):
+        return sum(size for (mtime, size, entryPath) in self.GetEntries())
+
+    def Evict(self):
+        # Other processes may share the directory, so it is listed afresh.
+        entries = self.GetEntries()
+        entries.sort()
+        self.totalSize = sum(size for (mtime, size, entryPath) in entries)
+        for mtime, size, entryPath in entries:
+            if self.totalSize <= self.maxSize:
+                break
+            try:
+                os.remove(entryPath)
+            except OSError:
+                continue
+            self.totalSize -= size
+            self.statistics["evictions"] += 1
+
+    def Clear(self):
+        for mtime, size, entryPath in self.GetEntries():
+            try:
+                os.remove(entryPath)
+            except OSError:
+                pass
+        self.totalSize = 0
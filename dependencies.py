@@ -0,0 +1,232 @@
+"""
+Works out the order to run the scripts in a script directory, from what each
+takes from the namespaces the others contribute to.
+
+The compiled code of each script is examined, rather than its source, so
+that scripts loaded from a code cache or a bundle can be ordered too.  Only
+the code which runs when the script is run is followed, the top level of the
+script and the bodies of its classes.  Function bodies run later, when the
+namespaces are complete.  Within that code:
+
+- The names a script stores at its top level are what it contributes to its
+  namespace, other than those bound by imports.
+- 'import game' and 'from game import X' bind names to namespaces and their
+  contents, and 'game.X' or 'X' used through those names is a use of 'X'
+  from the 'game' namespace.  'from game import *' uses everything
+  contributed to the 'game' namespace.
+
+A script depends on the scripts which contribute the names it uses.  Imports
+made some other way, through '__import__' or 'exec', are not seen, and
+scripts which fail to run in the worked out order are retried by
+'ScriptDirectory.Load'.
+"""
+
+import types, opcode
+
+CO_OPTIMIZED = 0x0001
+
+IMPORT_NAME = opcode.opmap["IMPORT_NAME"]
+IMPORT_FROM = opcode.opmap["IMPORT_FROM"]
+IMPORT_STAR = opcode.opmap["IMPORT_STAR"]
+LOAD_CONST = opcode.opmap["LOAD_CONST"]
+LOAD_NAME = opcode.opmap["LOAD_NAME"]
+LOAD_GLOBAL = opcode.opmap["LOAD_GLOBAL"]
+LOAD_ATTR = opcode.opmap["LOAD_ATTR"]
+STORE_NAME = opcode.opmap["STORE_NAME"]
+POP_TOP = opcode.opmap["POP_TOP"]
+EXTENDED_ARG = opcode.EXTENDED_ARG
+
+
+def GetInstructions(codeObject):
+    # Yields '(op, arg)' for each instruction, with None for no argument.
+    code = codeObject.co_code
+    i, extendedArg = 0, 0
+    while i < len(code):
+        op = ord(code[i])
+        if op >= opcode.HAVE_ARGUMENT:
+            arg = ord(code[i+1]) + ord(code[i+2]) * 256 + extendedArg
+            extendedArg = 0
+            i += 3
+            if op == EXTENDED_ARG:
+                extendedArg = arg * 65536
+                continue
+        else:
+            arg = None
+            i += 1
+        yield op, arg
+
+def AnalyseCode(codeObject):
+    """
+    Returns '(defines, uses)', the names stored at the top level of the given
+    script code, and the dotted names it uses when run.
+    """
+    defines, uses = set(), set()
+    AnalyseBlock(codeObject, {}, defines, uses)
+    return defines, uses
+
+def AnalyseBlock(codeObject, aliases, defines, uses):
+    # The dotted name of the value on the top of the stack, where it is known.
+    current = None
+    # Whether that value came from an import, rather than being used.
+    imported = False
+    # The module a 'from' import is taking names from.
+    fromModule = None
+    lastConst = None
+
+    for op, arg in GetInstructions(codeObject):
+        if op == IMPORT_NAME:
+            name = codeObject.co_names[arg]
+            uses.add(name)
+            if lastConst:
+                current = fromModule = name
+            else:
+                # Without a from list, the top level package is what is bound.
+                current = name.split(".", 1)[0]
+            imported = True
+        elif op == IMPORT_FROM and fromModule is not None:
+            current = fromModule +"."+ codeObject.co_names[arg]
+            uses.add(current)
+            imported = True
+        elif op == IMPORT_STAR and fromModule is not None:
+            uses.add(fromModule +".*")
+            current = fromModule = None
+        elif op == LOAD_ATTR and current is not None:
+            current += "."+ codeObject.co_names[arg]
+            if not imported:
+                uses.add(current)
+        elif op in (LOAD_NAME, LOAD_GLOBAL):
+            current = aliases.get(codeObject.co_names[arg])
+            imported = False
+            if current is not None:
+                uses.add(current)
+        elif op == STORE_NAME:
+            name = codeObject.co_names[arg]
+            if imported and current is not None:
+                # A name taken from elsewhere is not a contribution, otherwise
+                # scripts importing the same name would provide it to each other.
+                aliases[name] = current
+            else:
+                aliases.pop(name, None)
+                if defines is not None:
+                    defines.add(name)
+            current = None
+            imported = False
+        else:
+            if op == LOAD_CONST:
+                lastConst = codeObject.co_consts[arg]
+                # Class bodies run when the class statement does.
+                if isinstance(lastConst, types.CodeType) and not lastConst.co_flags & CO_OPTIMIZED:
+                    AnalyseBlock(lastConst, dict(aliases), None, uses)
+            elif op == POP_TOP:
+                fromModule = None
+            current = None
+            imported = False
+
+def OrderScripts(scriptFiles, baseNamespaceName):
+    """
+    Returns '(order, cycles, dependencies)'.  The order has each script after
+    those it depends on.  Scripts which depend on each other are not in it,
+    and are returned as the cycles they form.  Scripts which depend on a
+    cycle, without being part of one, are in neither, and are left to be
+    retried.  'dependencies' maps each script to those it depends on.
+    """
+    analyses = {}
+    providers = {}
+    namespaceProviders = {}
+    for scriptFile in scriptFiles:
+        defines, uses = analyses[scriptFile] = AnalyseCode(scriptFile.codeObject)
+        namespaceProviders.setdefault(scriptFile.namespacePath, []).append(scriptFile)
+        for name in defines:
+            providers.setdefault(scriptFile.namespacePath +"."+ name, []).append(scriptFile)
+
+    prefix = baseNamespaceName +"."
+    dependencies = {}
+    for scriptFile, (defines, uses) in analyses.iteritems():
+        scriptDependencies = dependencies[scriptFile] = set()
+        for use in uses:
+            if not use.startswith(prefix):
+                continue
+            if use.endswith(".*"):
+                scriptDependencies.update(namespaceProviders.get(use[:-2], ()))
+                continue
+            # Any part of the name may be contributed, 'game.Class.attribute'
+            # depends on whatever contributes 'Class' to 'game'.
+            parts = use.split(".")
+            for i in xrange(2, len(parts) + 1):
+                scriptDependencies.update(providers.get(".".join(parts[:i]), ()))
+        scriptDependencies.discard(scriptFile)
+
+    dependents = dict((scriptFile, []) for scriptFile in dependencies)
+    waitingCounts = {}
+    for scriptFile, scriptDependencies in dependencies.iteritems():
+        waitingCounts[scriptFile] = len(scriptDependencies)
+        for dependency in scriptDependencies:
+            dependents[dependency].append(scriptFile)
+
+    # Where there is a choice, scripts run in path order.
+    ready = sorted((scriptFile for (scriptFile, count) in waitingCounts.iteritems() if count == 0), key=GetFilePath, reverse=True)
+    order = []
+    while ready:
+        scriptFile = ready.pop()
+        order.append(scriptFile)
+        released = []
+        for dependent in dependents[scriptFile]:
+            waitingCounts[dependent] -= 1
+            if waitingCounts[dependent] == 0:
+                released.append(dependent)
+        if released:
+            ready.extend(released)
+            ready.sort(key=GetFilePath, reverse=True)
+
+    cycles = []
+    if len(order) < len(dependencies):
+        remaining = set(dependencies) - set(order)
+        cycles = FindCycles(remaining, dependencies)
+    return order, cycles, dependencies
+
+def GetFilePath(scriptFile):
+    return scriptFile.filePath
+
+def FindCycles(scriptFiles, dependencies):
+    """
+    Returns the groups of the given scripts which depend on each other,
+    directly or indirectly (Tarjan's strongly connected components).
+    """
+    indexes, lowLinks = {}, {}
+    stack, onStack = [], set()
+    cycles = []
+
+    for root in sorted(scriptFiles, key=GetFilePath):
+        if root in indexes:
+            continue
+        work = [ (root, iter(sorted(dependencies[root] & scriptFiles, key=GetFilePath))) ]
+        indexes[root] = lowLinks[root] = len(indexes)
+        stack.append(root)
+        onStack.add(root)
+        while work:
+            scriptFile, children = work[-1]
+            for child in children:
+                if child not in indexes:
+                    indexes[child] = lowLinks[child] = len(indexes)
+                    stack.append(child)
+                    onStack.add(child)
+                    work.append((child, iter(sorted(dependencies[child] & scriptFiles, key=GetFilePath))))
+                    break
+                if child in onStack:
+                    lowLinks[scriptFile] = min(lowLinks[scriptFile], indexes[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowLinks[parent] = min(lowLinks[parent], lowLinks[scriptFile])
+                if lowLinks[scriptFile] == indexes[scriptFile]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack.remove(member)
+                        component.append(member)
+                        if member is scriptFile:
+                            break
+                    if len(component) > 1:
+                        cycles.append(sorted(component, key=GetFilePath))
+    return cycles
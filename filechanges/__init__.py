@@ -1,168 +1,831 @@
-#
-# Do some generic stuff to wrap whatever method is chosen.
-#
-# To do list:
-#
-# - Detect if stackless is present and use that instead of a thread.  This
-#   of course requires that the user is running the scheduler, but that is
-#   their problem.
-#
-
-import os, sys, time, weakref, logging
-import threading, Queue
-
-logger = logging.getLogger("reloader")
-
-class ChangeHandler:
-    def __init__(self, callback, delay=None, useThread=True):
-        self.callback = callback
-        self.delay = delay is None and 1.0 or delay
-
-        self.directories = []
-        self.watchState = None
-
-        self.skipList = [
-            "\\.svn\\",
-            "/.svn/",
-        ]
-
-        self.thread = None
-        self.module = None
-
-        if useThread:
-            self.thread = ChangeThread(weakref.proxy(self))
-        else:
-            self.module = GetFileChangeModule()
-            self.module.Prepare(self)
-
-    def AddDirectory(self, path):
-        if self.module:
-            self.directories.append(path)
-            self.module.Prepare(self)
-        elif self.thread:
-            # We only want to add the new directory when we can be sure it
-            # won't interfere with the change detecting thread.
-            self.thread.lock.acquire()
-            self.directories.append(path)
-            self.thread.resetEvent.set()
-            self.thread.lock.release()
-
-    def RemoveDirectory(self, path):
-        self.directories.remove(path)
-
-    def DispatchFileChange(self, filePath, added=False, changed=False, deleted=False):
-        try:
-            self.callback(filePath, added=added, changed=changed, deleted=deleted)
-        except Exception:
-            # Richard: I added Exception here so that TaskletExit would raise and
-            # kill the thread.  But I have a suspicion that I had these being
-            # caught for a reason.
-            logger.exception("Problem executing callback")
-
-    def ShouldIgnorePathEntry(self, path):
-        # By default this concentrates on files, not directories.
-        if os.path.isdir(path):
-            return True
-
-        # Perhaps there are some standard things we should ignore.
-        for skipPath in self.skipList:
-            if skipPath in path:
-                return True
-
-        return not path.endswith(".py")
-
-    def ProcessFileEvents(self):
-        self.module.Check(self)
-
-    def WaitForNextMonitoringCheck(self, maxDelay=10.0, checkDelay=0.05):
-        lastCheckTimestamp = self.thread.lastCheckTimestamp
-        initialMaxDelay = maxDelay
-        while maxDelay > 0:
-            self.thread.lock.acquire()
-            try:
-                if lastCheckTimestamp != self.thread.lastCheckTimestamp:
-                    return initialMaxDelay - maxDelay
-            finally:
-                self.thread.lock.release()
-
-            time.sleep(checkDelay)
-            maxDelay -= checkDelay
-
-        return None
-
-
-def GetFileChangeModule():
-    module = None
-    # Not ready for use.  If it is going to handle multiple directories,
-    # it needs to be non-blocking.
-    #if os.name == "nt":
-    #    if IsModuleAvailable("win32file"):
-    #        import golden3
-    #        module = golden3
-    if module is None:
-        import recipe215418
-        module = recipe215418
-    return module
-
-class ChangeThread(threading.Thread):
-    def __init__(self, handler, **kwargs):
-        threading.Thread.__init__ (self, **kwargs)
-        self.setDaemon(1)
-
-        self.handler = handler
-        self.resetEvent = threading.Event()
-        self.lock = threading.Lock()
-        self.lastCheckTimestamp = None
-        self.start()
-
-    def run(self):
-        try:
-            self._run()
-        except ReferenceError:
-            return
-    
-    def _run(self):
-        module = GetFileChangeModule()
-        module.Prepare(self.handler)
-        time.sleep(self.handler.delay)
-
-        while True:
-            self.lock.acquire()
-            try:
-                if self.resetEvent.isSet():
-                    self.resetEvent.clear()
-                    module.Prepare(self.handler)
-                else:
-                    module.Check(self.handler)
-                self.lastCheckTimestamp = time.time()
-            finally:
-                self.lock.release()
-
-            time.sleep(self.handler.delay)
-
-
-if __name__ == "__main__":
-    testWithThreads = False
-
-    # Simple callback which informs of any events via printing.
-    def f(path, added=False, changed=False, deleted=False):
-        print "f", path, (added, changed, deleted)
-
-    # This script may not be run in this directory, handle that case.
-    if os.path.sep in __file__:
-        path = os.path.split(__file__)[0]
-    else:
-        path = os.getcwd()
-
-    # Start monitoring the given directory.
-    ch = ChangeHandler(f, useThread=testWithThreads)
-    ch.AddDirectory(path)
-
-    # Wait for you to change a file in the directory this file is in.
-    while 1:
-        if testWithThreads:
-            time.sleep(10.0)
-        else:
-            ch.ProcessFileEvents()
-            time.sleep(1.0)
-
+#
+# Do some generic stuff to wrap whatever method is chosen.
+#
+# To do list:
+#
+# - Detect if stackless is present and use that instead of a thread.  This
+#   of course requires that the user is running the scheduler, but that is
+#   their problem.
+#
+
+import os, sys, time, fnmatch, weakref, logging
+import threading, Queue
+import collections
+
+import pathfilter, scheduling, snapshot
+
+logger = logging.getLogger("reloader")
+
+class ChangeHandler:
+    # Use kernel change notifications where the platform supports them,
+    # rather than polling.
+    useNativeMonitoring = True
+    # When polling, only list directories again when their mtime changes.
+    cacheDirectoryListings = False
+    # When polling, do not stat files in directories whose mtime has not
+    # changed.  Only safe if files are replaced rather than written in place.
+    trustDirectoryMtimes = False
+    # When polling, keep the watched state of each directory in a compact
+    # table rather than a dictionary, see 'filetable'.  For large trees.
+    compactWatchState = False
+    # When polling, check files less often the longer it has been since they
+    # last changed.  Hot files, changed within the last 'hotCheckCount' checks,
+    # are checked every time.  Warm files, changed within 'coldCheckCount'
+    # checks, are checked every 'warmCheckInterval' checks.  Cold files are
+    # only checked every 'coldCheckInterval' checks, or when their directory
+    # mtime changes.  Directory listings are cached to tell when that is.
+    tieredPolling = False
+    hotCheckCount = 4
+    warmCheckInterval = 4
+    coldCheckCount = 64
+    coldCheckInterval = 32
+
+    # The default rules deciding which files are of interest, used for
+    # directories registered without a filter of their own.  See 'pathfilter'.
+    pathFilterClass = pathfilter.PathFilter
+    includeRules = ( "*.py", )
+    excludeRules = ( ".svn/", ".git/", "node_modules/" )
+
+    # If either bound is given, the delay between checks adapts to activity.
+    # It drops to the minimum after changes are seen, and grows by the backoff
+    # factor after each check where there were none, up to the maximum.
+    minimumDelay = None
+    maximumDelay = None
+    delayBackoffFactor = 2.0
+    # The fraction of elapsed time the change detecting thread may spend
+    # scanning, measured over chunks of this many files.
+    scanBudget = None
+    scanBudgetChunkSize = 256
+    # When polling, scan with this many threads so that waiting on stat calls
+    # overlaps.  Timings for each shard of the last scan are in 'shardTimings'.
+    # This is intended for slow filesystems, the scan budget is not applied.
+    scanThreads = 1
+    # Given a snapshot path, the change detecting thread saves the watched
+    # state this often, in seconds.  'SaveSnapshot' can also be called directly.
+    snapshotInterval = 60.0
+    # The change detecting thread passes the changes it finds to the callbacks
+    # through a queue of this size, serviced by a dispatching thread.  This
+    # keeps slow callbacks from delaying scans, or the registration of new
+    # directories.  Scanning only waits for the callbacks when the queue is
+    # full.  If None, the callbacks are called on the change detecting thread.
+    dispatchQueueSize = 256
+    # Given a settle time, in seconds, changes to files which may still be
+    # being written are held back until the writes look to be complete.  See
+    # 'IsWriteComplete'.
+    settleTime = None
+    # Editor temporary files, which are written and then renamed into place.
+    # Changes to them are not dispatched while there is a settle time.
+    temporaryFilePatterns = ( "*.swp", "*.swx", "*~", "*.tmp", ".#*", "#*#" )
+    # A file is taken to be being written while there is a file with the same
+    # path and one of these suffixes, for instance "script.py.lock".
+    lockFileSuffixes = ()
+
+    def __init__(self, callback, delay=None, useThread=True, batchCallback=None, coalesceDelay=None, snapshotPath=None, settleTime=None):
+        self.callback = callback
+        self.delay = delay is None and 1.0 or delay
+
+        # Events are coalesced into batches if a batch callback is given, or
+        # a period of quiet is required before any are dispatched.  Batches
+        # are passed a list of '(filePath, added, changed, deleted)' tuples.
+        self.batchCallback = batchCallback
+        self.coalesceDelay = coalesceDelay
+        if batchCallback is not None and coalesceDelay is None:
+            self.coalesceDelay = 0.0
+        self.pendingChanges = {}
+        self.pendingChangeSequence = 0
+        self.lastChangeTimestamp = None
+
+        if settleTime is not None:
+            self.settleTime = settleTime
+        # The changes held back until the files are completely written, with
+        # the signature each file had when last looked at.
+        self.unfinishedWrites = {}
+
+        self.directories = []
+        self.watchState = None
+        self.directoryState = None
+        # For tiered polling, the check each recently changed file last changed
+        # in, and whether the less frequently checked tiers are due.
+        self.fileActivity = {}
+        self.tieredCheckCount = 0
+        self.warmTierDue = self.coldTierDue = True
+        # Counters of work done, and work avoided, while detecting changes.
+        self.statistics = collections.defaultdict(int)
+        self.shardTimings = []
+
+        # The watched state saved by an earlier process, for each directory
+        # which has not been compared against it yet.  See 'snapshot'.
+        self.snapshotPath = snapshotPath
+        self.snapshotState = {}
+        self.lastSnapshotTimestamp = None
+        if snapshotPath is not None:
+            self.snapshotState = snapshot.Load(snapshotPath)
+
+        # Callback invocations collected during a check, for the dispatching
+        # thread to make, or to be spread over calls to 'ProcessFileEvents'.
+        self.dispatchBuffer = None
+        if useThread and self.dispatchQueueSize is not None:
+            self.dispatchBuffer = []
+        # Calls queued from other threads, see 'QueueCall'.
+        self.queuedCalls = collections.deque()
+        # Where 'ProcessFileEvents' got to, when given a time budget.
+        self.checkCursor = None
+        self.checkDirectoryCount = 0
+        self.lastCheckDirectoryCount = None
+
+        self.pathFilters = {}
+        self.defaultPathFilter = self.pathFilterClass(self.includeRules, self.excludeRules)
+        # Any path containing one of these fragments is ignored, whatever
+        # the filter rules.  Kept for compatibility, use 'excludeRules'.
+        self.skipList = []
+
+        self.adaptiveDelay = None
+        if self.minimumDelay is not None or self.maximumDelay is not None:
+            minimumDelay = self.minimumDelay is None and self.delay or self.minimumDelay
+            maximumDelay = self.maximumDelay is None and self.delay or self.maximumDelay
+            self.adaptiveDelay = scheduling.AdaptiveDelay(self.delay, minimumDelay, maximumDelay, self.delayBackoffFactor)
+
+        # Throttling is only done on the change detecting thread, it is up to
+        # the caller of 'ProcessFileEvents' to decide how often to call it.
+        self.budget = None
+        if useThread and self.scanBudget is not None:
+            self.budget = scheduling.ScanBudget(self.scanBudget, self.scanBudgetChunkSize, self.statistics)
+
+        self.thread = None
+        self.module = None
+
+        if useThread:
+            self.thread = ChangeThread(weakref.proxy(self))
+        else:
+            self.module = self.GetFileChangeModule()
+            self.module.Prepare(self)
+
+    def AddDirectory(self, path, pathFilter=None):
+        if pathFilter is None:
+            pathFilter = self.defaultPathFilter
+        pathFilter.Compile()
+
+        if self.module:
+            self.directories.append(path)
+            self.pathFilters[path] = pathFilter
+            self.AbandonCheck()
+            self.module.AddDirectory(self, path)
+        elif self.thread:
+            # We only want to add the new directory when we can be sure it
+            # won't interfere with the change detecting thread.  It gathers
+            # the state of the new directory before its next check.  A check
+            # may be sleeping part way through, with the lock released, so
+            # the list it is working through is replaced rather than changed.
+            self.thread.lock.acquire()
+            try:
+                self.directories = self.directories + [ path ]
+                self.pathFilters[path] = pathFilter
+                self.thread.addedDirectories.append(path)
+            finally:
+                self.thread.lock.release()
+
+    def RemoveDirectory(self, path):
+        if self.module:
+            self.directories.remove(path)
+            del self.pathFilters[path]
+            self.AbandonCheck()
+            self.module.RemoveDirectory(self, path)
+        elif self.thread:
+            self.thread.lock.acquire()
+            try:
+                directories = list(self.directories)
+                directories.remove(path)
+                self.directories = directories
+                del self.pathFilters[path]
+                self.thread.removedDirectories.append(path)
+            finally:
+                self.thread.lock.release()
+
+    def DispatchFileChange(self, filePath, added=False, changed=False, deleted=False):
+        if self.settleTime is not None:
+            if self.IsTemporaryFile(filePath):
+                self.statistics["temporaryFilesIgnored"] += 1
+                return
+
+            entry = self.unfinishedWrites.pop(filePath, None)
+            if entry is not None:
+                wasAdded, signature, fresh = entry
+                if deleted and wasAdded:
+                    # The file came and went before it was finished.
+                    return
+                if not deleted:
+                    added, changed = wasAdded or added, not (wasAdded or added)
+
+            if not deleted:
+                complete, signature = self.IsWriteComplete(filePath)
+                if not complete:
+                    self.statistics["unfinishedWritesHeld"] += 1
+                    self.unfinishedWrites[filePath] = (added, signature, True)
+                    return
+
+        self.DispatchCompleteFileChange(filePath, added, changed, deleted)
+
+    def DispatchCompleteFileChange(self, filePath, added=False, changed=False, deleted=False):
+        self.statistics["eventsDispatched"] += 1
+
+        if self.coalesceDelay is not None:
+            self.CoalesceFileChange(filePath, added, changed, deleted)
+            return
+
+        if self.dispatchBuffer is not None:
+            self.dispatchBuffer.append((self.InvokeCallback, (filePath, added, changed, deleted)))
+            return
+
+        self.InvokeCallback(filePath, added, changed, deleted)
+
+    def IsTemporaryFile(self, filePath):
+        fileName = os.path.basename(filePath)
+        for pattern in self.temporaryFilePatterns:
+            if fnmatch.fnmatch(fileName, pattern):
+                return True
+        return False
+
+    def IsWriteComplete(self, filePath, lastSignature=None):
+        """
+        Returns '(complete, signature)'.  A file is taken to be completely
+        written if it has not been written to for the settle time, if it has
+        not changed since it was last looked at, or if it was renamed into
+        place after it was written.  Not while it has a lock file, though.
+        """
+        try:
+            t = os.stat(filePath)
+        except os.error:
+            # A deletion will follow.
+            return True, None
+
+        signature = (t.st_mtime, t.st_size)
+        for suffix in self.lockFileSuffixes:
+            if os.path.exists(filePath + suffix):
+                return False, signature
+
+        if signature == lastSignature or time.time() - t.st_mtime >= self.settleTime:
+            return True, signature
+        # Renaming a file updates its inode change time, but not its mtime.
+        # Elsewhere 'st_ctime' is the creation time.
+        if os.name != "nt" and t.st_ctime > t.st_mtime:
+            return True, signature
+        return False, signature
+
+    def DispatchFinishedWrites(self):
+        """
+        Dispatch the held changes for the files whose writes are now complete.
+        Called after each check, those held during the check are left for the
+        next one.
+        """
+        for filePath, (added, signature, fresh) in self.unfinishedWrites.items():
+            if fresh:
+                self.unfinishedWrites[filePath] = (added, signature, False)
+                continue
+
+            complete, signature = self.IsWriteComplete(filePath, signature)
+            if not complete:
+                self.unfinishedWrites[filePath] = (added, signature, False)
+                continue
+
+            del self.unfinishedWrites[filePath]
+            self.DispatchCompleteFileChange(filePath, added=added, changed=not added)
+
+    def InvokeCallback(self, filePath, added=False, changed=False, deleted=False):
+        try:
+            self.callback(filePath, added=added, changed=changed, deleted=deleted)
+        except Exception:
+            # Richard: I added Exception here so that TaskletExit would raise and
+            # kill the thread.  But I have a suspicion that I had these being
+            # caught for a reason.
+            logger.exception("Problem executing callback")
+
+    def CoalesceFileChange(self, filePath, added=False, changed=False, deleted=False):
+        self.lastChangeTimestamp = time.time()
+
+        entry = self.pendingChanges.get(filePath)
+        if entry is None:
+            self.pendingChangeSequence += 1
+            self.pendingChanges[filePath] = (self.pendingChangeSequence, (added, changed, deleted))
+            return
+
+        self.statistics["eventsCoalesced"] += 1
+
+        sequence, (wasAdded, wasChanged, wasDeleted) = entry
+        if wasAdded and deleted:
+            # The file came and went without anyone needing to know.
+            del self.pendingChanges[filePath]
+            return
+
+        if wasAdded:
+            flags = (True, False, False)
+        elif wasDeleted and not deleted:
+            # The file was replaced.
+            flags = (False, True, False)
+        elif deleted:
+            flags = (False, False, True)
+        else:
+            flags = (False, True, False)
+        self.pendingChanges[filePath] = (sequence, flags)
+
+    def DispatchCoalescedFileChanges(self, force=False):
+        # Nothing is dispatched until there have been no new events for the
+        # coalescing delay, unless forced.
+        if not self.pendingChanges:
+            return
+        if not force and time.time() - self.lastChangeTimestamp < self.coalesceDelay:
+            return
+
+        entries = [ (sequence, filePath, flags) for (filePath, (sequence, flags)) in self.pendingChanges.iteritems() ]
+        entries.sort()
+        self.pendingChanges = {}
+
+        changes = [ (filePath,) + flags for (sequence, filePath, flags) in entries ]
+        if self.dispatchBuffer is not None:
+            self.dispatchBuffer.append((self.InvokeCallbacks, (changes,)))
+            return
+
+        self.InvokeCallbacks(changes)
+
+    def QueueCall(self, function, args=()):
+        """
+        Have the given function called where the callbacks are called, so that
+        it does not run at the same time as them.  With a thread this is the
+        dispatching thread, otherwise the next call to 'ProcessFileEvents'.
+        """
+        if self.thread is None:
+            self.queuedCalls.append((function, args))
+        elif self.thread.dispatchQueue is not None:
+            self.thread.dispatchQueue.put((function, args))
+        else:
+            # The callbacks are called by the change detecting thread, while
+            # it holds the lock.
+            self.thread.lock.acquire()
+            try:
+                function(*args)
+            finally:
+                self.thread.lock.release()
+
+    def InvokeCallbacks(self, changes):
+        if self.batchCallback is not None:
+            try:
+                self.batchCallback(changes)
+            except Exception:
+                logger.exception("Problem executing batch callback")
+            return
+
+        for filePath, added, changed, deleted in changes:
+            self.InvokeCallback(filePath, added, changed, deleted)
+
+    def ShouldIgnorePathEntry(self, path):
+        # No longer used by the scanning modules, which know whether each entry
+        # is a file or a directory.  Kept for those who call it directly.
+        if os.path.isdir(path):
+            return True
+
+        return self.ShouldIgnoreFile(path)
+
+    def ShouldIgnoreFile(self, path):
+        # Only the path is examined, the caller knows that it is a file.
+        if self.skipList and self.IsSkipped(path):
+            return True
+        pathFilter, relativePath = self.GetPathFilter(path)
+        return pathFilter.IsFileIgnored(relativePath)
+
+    def ShouldIgnoreDirectory(self, path):
+        # Nothing within an ignored directory is visited.
+        if self.skipList and self.IsSkipped(os.path.join(path, "")):
+            return True
+        pathFilter, relativePath = self.GetPathFilter(path)
+        return pathFilter.IsDirectoryIgnored(relativePath)
+
+    def IsSkipped(self, path):
+        for skipPath in self.skipList:
+            if skipPath in path:
+                return True
+        return False
+
+    def GetPathFilter(self, path):
+        # Filter rules are relative to the registered directory the path is in.
+        dirPath = None
+        for registeredPath in self.directories:
+            if path != registeredPath and not path.startswith(os.path.join(registeredPath, "")):
+                continue
+            if dirPath is None or len(registeredPath) > len(dirPath):
+                dirPath = registeredPath
+
+        if dirPath is None:
+            return self.defaultPathFilter, os.path.basename(path)
+
+        relativePath = path[len(dirPath):].lstrip(os.path.sep)
+        if os.path.sep != "/":
+            relativePath = relativePath.replace(os.path.sep, "/")
+        return self.pathFilters.get(dirPath, self.defaultPathFilter), relativePath
+
+    def SaveSnapshot(self):
+        if self.snapshotPath is None:
+            return False
+
+        # The change detecting thread saves while holding the lock already.
+        # Others wait for any check which is sleeping part way through.
+        if self.thread is not None and threading.currentThread() is not self.thread:
+            self.thread.lock.acquire()
+            try:
+                while self.thread.checking:
+                    self.thread.checkCondition.wait()
+                return self.SaveSnapshot()
+            finally:
+                self.thread.lock.release()
+
+        # Nothing has been gathered yet, keep whatever was saved before.
+        if self.watchState is None:
+            return False
+
+        try:
+            snapshot.Save(self.snapshotPath, self.watchState)
+        except (IOError, OSError):
+            logger.exception("Unable to save file change snapshot '%s'", self.snapshotPath)
+            return False
+
+        self.lastSnapshotTimestamp = time.time()
+        return True
+
+    def IsSnapshotDue(self):
+        if self.snapshotPath is None:
+            return False
+        if self.lastSnapshotTimestamp is None:
+            return True
+        return time.time() - self.lastSnapshotTimestamp >= self.snapshotInterval
+
+    def GetFileChangeModule(self):
+        # The module which does the work, providing 'Prepare' and 'Check'.
+        return GetFileChangeModule(self.useNativeMonitoring)
+
+    def ScanStep(self, count=1):
+        # Called by the scanning modules as they progress through the files.
+        if self.budget is not None:
+            self.budget.Step(count)
+
+    def GetNextDelay(self, activity):
+        if self.adaptiveDelay is not None:
+            return self.adaptiveDelay.Update(activity)
+        return self.delay
+
+    def ProcessFileEvents(self, timeBudget=None):
+        """
+        Check for changes and call the callbacks for any that are found.
+
+        Given a time budget, in seconds, the check and the callbacks are done
+        in steps, and no new step is started once the budget is used up.  The
+        next call carries on from where this one stopped, so that a host can
+        spread the work over its frames.  Returns True if there is work left,
+        see 'GetRemainingWork'.
+        """
+        endTime = None
+        if timeBudget is not None:
+            endTime = time.time() + timeBudget
+            if self.dispatchBuffer is None:
+                self.dispatchBuffer = []
+
+        while self.queuedCalls:
+            function, args = self.queuedCalls.popleft()
+            function(*args)
+
+        # A call does at most one check, which may be one carried over.
+        checkStarted = self.checkCursor is not None
+        while True:
+            if self.dispatchBuffer:
+                # Earlier callbacks are called before anything more is done.
+                function, args = self.dispatchBuffer.pop(0)
+                function(*args)
+            elif self.checkCursor is not None:
+                try:
+                    self.checkCursor.next()
+                except StopIteration:
+                    self.checkCursor = None
+            elif not checkStarted:
+                self.checkCursor = self.IterateCheck()
+                checkStarted = True
+                continue
+            else:
+                break
+
+            if endTime is not None and time.time() >= endTime:
+                break
+
+        return self.checkCursor is not None or bool(self.dispatchBuffer)
+
+    def IterateCheck(self):
+        iterateCheck = getattr(self.module, "IterateCheck", None)
+        if iterateCheck is None:
+            self.module.Check(self)
+        else:
+            self.checkDirectoryCount = 0
+            for directoryCount in iterateCheck(self):
+                self.checkDirectoryCount = directoryCount
+                yield
+            self.lastCheckDirectoryCount = self.checkDirectoryCount
+
+        self.DispatchFinishedWrites()
+        self.DispatchCoalescedFileChanges()
+        if self.IsSnapshotDue():
+            self.SaveSnapshot()
+
+    def AbandonCheck(self):
+        # The watched state is about to be replaced, so a check in progress
+        # has nothing to compare against.
+        if self.checkCursor is not None:
+            self.checkCursor.close()
+            self.checkCursor = None
+
+    def GetRemainingWork(self):
+        """
+        Returns '(directoryCount, callbackCount)', the estimated number of
+        directories the check in progress has yet to scan, and the number of
+        callbacks waiting to be called.  The estimate is based on the number
+        of directories the last complete check scanned.
+        """
+        directoryCount = 0
+        if self.checkCursor is not None and self.lastCheckDirectoryCount is not None:
+            directoryCount = max(self.lastCheckDirectoryCount - self.checkDirectoryCount, 0)
+        return directoryCount, len(self.dispatchBuffer or [])
+
+    def ScanNow(self, timeout=None):
+        """
+        Check for changes immediately, rather than waiting for the next
+        scheduled check, and return once the events for any changes found
+        have been dispatched.  Coalesced events are dispatched without waiting
+        for a quiet period.  Returns False if this did not happen within the
+        given number of seconds.
+        """
+        if self.thread is None:
+            self.ProcessFileEvents()
+            self.DispatchCoalescedFileChanges(force=True)
+            # Once given a time budget, callbacks are buffered for later calls.
+            while self.dispatchBuffer:
+                function, args = self.dispatchBuffer.pop(0)
+                function(*args)
+            return True
+
+        return self.thread.ScanNow(timeout)
+
+    def WaitForNextMonitoringCheck(self, maxDelay=10.0, checkDelay=None):
+        # 'checkDelay' is no longer used, the monitoring thread notifies us.
+        startTime = time.time()
+        self.thread.lock.acquire()
+        try:
+            if not self.thread.WaitForCheck(self.thread.scanCount + 1, maxDelay):
+                return None
+        finally:
+            self.thread.lock.release()
+
+        return time.time() - startTime
+
+
+def GetFileChangeModule(allowNative=True):
+    module = None
+    if allowNative and sys.platform.startswith("linux"):
+        import linuxinotify
+        if linuxinotify.IsAvailable():
+            module = linuxinotify
+    # Not ready for use.  If it is going to handle multiple directories,
+    # it needs to be non-blocking.
+    #if os.name == "nt":
+    #    if IsModuleAvailable("win32file"):
+    #        import golden3
+    #        module = golden3
+    if module is None:
+        import recipe215418
+        module = recipe215418
+    return module
+
+class ChangeThread(threading.Thread):
+    def __init__(self, handler, **kwargs):
+        threading.Thread.__init__ (self, **kwargs)
+        self.setDaemon(1)
+
+        self.handler = handler
+        self.lock = threading.Lock()
+        # Registration changes, applied before the next check.
+        self.addedDirectories = []
+        self.removedDirectories = []
+        # Notified, with the lock held, each time a check completes.
+        self.checkCondition = threading.Condition(self.lock)
+        self.checkCount = 0
+        self.lastCheckTimestamp = None
+        # Set to cut short the delay before the next check.
+        self.wakeEvent = threading.Event()
+        self.forceDispatch = False
+        # Whether a check is in progress.  The lock is released while the
+        # scan budget sleeps, see 'Throttle'.
+        self.checking = False
+        if handler.budget is not None:
+            handler.budget.sleepFunction = self.Throttle
+
+        # Checks are counted as they are made, and again once the resulting
+        # callbacks have been called.  Where there is no dispatching thread,
+        # these happen at the same time.
+        self.scanCount = 0
+        self.dispatchQueue = None
+        self.dispatchThread = None
+        if handler.dispatchBuffer is not None:
+            self.dispatchQueue = Queue.Queue(handler.dispatchQueueSize)
+            self.dispatchThread = threading.Thread(target=self.RunDispatch)
+            self.dispatchThread.setDaemon(1)
+            self.dispatchThread.start()
+
+        self.start()
+
+    def run(self):
+        try:
+            self._run()
+        except ReferenceError:
+            pass
+
+        if self.dispatchQueue is not None:
+            self.dispatchQueue.put(None)
+
+    def RunDispatch(self):
+        while True:
+            entry = self.dispatchQueue.get()
+            if entry is None:
+                return
+
+            function, args = entry
+            startTime = time.time()
+            try:
+                function(*args)
+            except ReferenceError:
+                return
+            try:
+                self.handler.statistics["dispatchTime"] += time.time() - startTime
+            except ReferenceError:
+                return
+
+    def QueueDispatches(self, entries, scanCount):
+        # Called without the lock held, so that waiting for room in the queue
+        # does not hold up directory registration.  The check is complete
+        # once the dispatching thread gets past its callbacks.
+        statistics = self.handler.statistics
+        statistics["dispatchesQueued"] += len(entries)
+
+        for entry in entries + [ (self.CompleteQueuedCheck, (scanCount,)) ]:
+            try:
+                self.dispatchQueue.put_nowait(entry)
+            except Queue.Full:
+                statistics["dispatchQueueFullWaits"] += 1
+                startTime = time.time()
+                self.dispatchQueue.put(entry)
+                statistics["dispatchQueueWaitTime"] += time.time() - startTime
+
+        statistics["dispatchQueueHighWater"] = max(statistics["dispatchQueueHighWater"], self.dispatchQueue.qsize())
+
+    def CompleteCheck(self, scanCount):
+        # The lock must be held by the caller.
+        self.lastCheckTimestamp = time.time()
+        self.checkCount = scanCount
+        self.checkCondition.notifyAll()
+
+    def CompleteQueuedCheck(self, scanCount):
+        self.lock.acquire()
+        try:
+            self.CompleteCheck(scanCount)
+        finally:
+            self.lock.release()
+
+    def ScanNow(self, timeout=None):
+        if threading.currentThread() in (self, self.dispatchThread):
+            raise RuntimeError("Unable to wait for a check from the monitoring thread")
+
+        self.lock.acquire()
+        try:
+            # A check in progress may have got past the changes of interest,
+            # the one after it is the first to have started after this request.
+            checkCount = self.scanCount + 1
+            if self.checking:
+                checkCount += 1
+            self.forceDispatch = True
+            self.wakeEvent.set()
+            return self.WaitForCheck(checkCount, timeout)
+        finally:
+            self.lock.release()
+
+    def Throttle(self, sleepTime):
+        # Called by the scan budget on this thread.  During a check the lock
+        # is released for the sleep, so that directory registration is not
+        # held up by it.
+        if not self.checking:
+            time.sleep(sleepTime)
+            return
+
+        self.lock.release()
+        try:
+            time.sleep(sleepTime)
+        finally:
+            self.lock.acquire()
+
+    def WaitForCheck(self, checkCount, timeout=None):
+        # The lock must be held by the caller.
+        if timeout is not None:
+            endTime = time.time() + timeout
+
+        while self.checkCount < checkCount:
+            if timeout is None:
+                self.checkCondition.wait()
+            else:
+                remainingTime = endTime - time.time()
+                if remainingTime <= 0:
+                    return False
+                self.checkCondition.wait(remainingTime)
+
+        return True
+
+    def ApplyRegistrations(self, module):
+        # The lock must be held by the caller.  A directory may have been
+        # added and removed again, or the reverse, since the last check.
+        removedDirectories, self.removedDirectories = self.removedDirectories, []
+        addedDirectories, self.addedDirectories = self.addedDirectories, []
+        for path in removedDirectories:
+            if path not in self.handler.directories:
+                module.RemoveDirectory(self.handler, path)
+        for path in addedDirectories:
+            if path in self.handler.directories:
+                module.AddDirectory(self.handler, path)
+
+    def _run(self):
+        module = self.handler.GetFileChangeModule()
+        self.lock.acquire()
+        try:
+            # Directories registered before now are covered by this.
+            self.addedDirectories = []
+            self.removedDirectories = []
+            module.Prepare(self.handler)
+        finally:
+            self.lock.release()
+        self.wakeEvent.wait(self.handler.delay)
+
+        while True:
+            eventCount = self.handler.statistics["eventsDispatched"]
+            if self.handler.budget is not None:
+                self.handler.budget.Reset()
+
+            self.lock.acquire()
+            try:
+                self.wakeEvent.clear()
+                forceDispatch, self.forceDispatch = self.forceDispatch, False
+
+                self.ApplyRegistrations(module)
+                self.checking = True
+                try:
+                    module.Check(self.handler)
+                finally:
+                    self.checking = False
+                    self.checkCondition.notifyAll()
+                self.handler.DispatchFinishedWrites()
+                self.handler.DispatchCoalescedFileChanges(force=forceDispatch)
+                if self.handler.IsSnapshotDue():
+                    self.handler.SaveSnapshot()
+
+                self.scanCount += 1
+                scanCount = self.scanCount
+                if self.dispatchQueue is None:
+                    self.CompleteCheck(scanCount)
+                else:
+                    entries, self.handler.dispatchBuffer = self.handler.dispatchBuffer, []
+            finally:
+                self.lock.release()
+
+            if self.dispatchQueue is not None:
+                self.QueueDispatches(entries, scanCount)
+
+            if self.handler.budget is not None:
+                self.handler.budget.Finish()
+
+            activity = self.handler.statistics["eventsDispatched"] != eventCount
+            self.wakeEvent.wait(self.handler.GetNextDelay(activity))
+
+
+if __name__ == "__main__":
+    testWithThreads = False
+
+    # Simple callback which informs of any events via printing.
+    def f(path, added=False, changed=False, deleted=False):
+        print "f", path, (added, changed, deleted)
+
+    # This script may not be run in this directory, handle that case.
+    if os.path.sep in __file__:
+        path = os.path.split(__file__)[0]
+    else:
+        path = os.getcwd()
+
+    # Start monitoring the given directory.
+    ch = ChangeHandler(f, useThread=testWithThreads)
+    ch.AddDirectory(path)
+
+    # Wait for you to change a file in the directory this file is in.
+    while 1:
+        if testWithThreads:
+            time.sleep(10.0)
+        else:
+            ch.ProcessFileEvents()
+            time.sleep(1.0)
+
@@ -0,0 +1,155 @@
+"""
+Change detection driven by an asyncio event loop, rather than by a thread of
+its own.  As this library targets Python 2, this uses 'trollius', the
+backport of asyncio, and its 'yield From(...)' style of coroutine.
+
+The scanning is done in an executor, so that the file system access does not
+block the event loop.  Directories added or removed while a scan is in
+progress are registered in the executor as that scan finishes, rather than
+the event loop waiting for it.  Batches of changes are handed out on the event
+loop thread, so whatever is done with them happens at a well defined point.
+
+    watcher = ChangeWatcher(ChangeHandler(None, useThread=False))
+    watcher.AddDirectory(path)
+
+    while True:
+        changes = yield From(watcher.Next())
+        if changes is None:
+            break
+        for filePath, added, changed, deleted in changes:
+            ...
+"""
+
+import threading
+
+import trollius as asyncio
+from trollius import From, Return
+
+
+class ChangeWatcher(object):
+    def __init__(self, handler, loop=None, executor=None):
+        if handler.thread is not None:
+            raise ValueError("The change handler must be created with useThread=False")
+
+        self.handler = handler
+        self.loop = loop
+        self.executor = executor
+
+        # Scans happen in the executor, this keeps registration out of the way.
+        self.lock = threading.Lock()
+        # Registrations waiting for the next scan, see 'ApplyRegistrations'.
+        self.registrationLock = threading.Lock()
+        self.registrations = []
+        self.batches = []
+        self.nextScanTime = 0.0
+        self.closed = False
+
+        handler.batchCallback = self.batches.append
+        if handler.coalesceDelay is None:
+            handler.coalesceDelay = 0.0
+
+    def GetLoop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        return self.loop
+
+    def AddDirectory(self, path, pathFilter=None):
+        self.QueueRegistration(self.handler.AddDirectory, (path,), { "pathFilter": pathFilter })
+
+    def RemoveDirectory(self, path):
+        self.QueueRegistration(self.handler.RemoveDirectory, (path,), {})
+
+    def QueueRegistration(self, function, args, kwargs):
+        self.registrationLock.acquire()
+        try:
+            self.registrations.append((function, args, kwargs))
+        finally:
+            self.registrationLock.release()
+
+        # A scan may hold the lock for some time, in which case it is left to
+        # apply the registration rather than waiting for it here.
+        if self.lock.acquire(False):
+            try:
+                self.ApplyRegistrations()
+            finally:
+                self.lock.release()
+
+    def ApplyRegistrations(self):
+        # Called with the scan lock held.  The state of an added directory is
+        # gathered here, changes to it are detected from then on.
+        self.registrationLock.acquire()
+        try:
+            registrations = self.registrations
+            self.registrations = []
+        finally:
+            self.registrationLock.release()
+
+        for function, args, kwargs in registrations:
+            function(*args, **kwargs)
+
+    def SaveSnapshot(self):
+        self.lock.acquire()
+        try:
+            self.ApplyRegistrations()
+            return self.handler.SaveSnapshot()
+        finally:
+            self.lock.release()
+
+    def QueueCall(self, function, args=()):
+        """
+        Have the given function called on the event loop thread, where the
+        batches of changes are handled.  This may be called from any thread,
+        once the loop is known.
+        """
+        if self.loop is None:
+            raise RuntimeError("The event loop is not yet known")
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def Close(self):
+        # Any pending or future call to 'Next' will return None.
+        self.closed = True
+
+    def Scan(self, force=False):
+        # Called in the executor.
+        self.lock.acquire()
+        try:
+            self.ApplyRegistrations()
+            if force:
+                self.handler.ScanNow()
+            else:
+                self.handler.ProcessFileEvents()
+            self.ApplyRegistrations()
+        finally:
+            self.lock.release()
+
+    @asyncio.coroutine
+    def ScanNow(self):
+        """
+        Scan immediately, including any changes still waiting for a quiet
+        period.  The resulting batches are returned by subsequent calls to
+        'Next'.
+        """
+        loop = self.GetLoop()
+        yield From(loop.run_in_executor(self.executor, self.Scan, True))
+
+    @asyncio.coroutine
+    def Next(self):
+        """
+        Wait for the next batch of changes, a list of '(filePath, added,
+        changed, deleted)' tuples.  None is returned once closed.
+        """
+        loop = self.GetLoop()
+        while not self.batches:
+            if self.closed:
+                raise Return(None)
+
+            delay = self.nextScanTime - loop.time()
+            if delay > 0:
+                yield From(asyncio.sleep(delay, loop=loop))
+                if self.closed:
+                    raise Return(None)
+
+            yield From(loop.run_in_executor(self.executor, self.Scan))
+            self.nextScanTime = loop.time() + self.handler.GetNextDelay(len(self.batches) > 0)
+
+        raise Return(self.batches.pop(0))
@@ -0,0 +1,573 @@
+"""
+Change detection done by a separate watcher process, on behalf of any number
+of client processes.  A prefork server can have one process do the scanning,
+rather than having each of its workers scan the same directories.
+
+The watcher process listens on a Unix socket.  It is started from the
+directory the 'filechanges' package is in, or with it on the path:
+
+    python -m filechanges.daemon /tmp/watcher.sock
+
+Each worker uses a 'DaemonChangeHandler' in place of a 'ChangeHandler':
+
+    handler = DaemonChangeHandler(callback, socketPath="/tmp/watcher.sock")
+    handler.AddDirectory(path)
+
+The watcher scans each distinct directory and set of filter rules once, and
+publishes the changes it finds to every client watching it.  The changes for
+each directory are numbered in sequence, and the watcher keeps a history of
+the most recent ones.  A client which reconnects, after the watcher restarted
+or its connection was dropped for falling behind, gives the last sequence
+number it saw and is sent the changes it missed.  If these are no longer in
+the history, it is sent the current state of the directory instead, and works
+out the changes from that.  This is also how a client which has just started
+watching a directory gets its starting point.
+
+Messages are length prefixed 'marshal' data.  As 'marshal' is not safe for
+untrusted data, the socket is only accessible to the user the watcher runs as.
+"""
+
+import os, sys, time, socket, select, struct, marshal, collections, itertools, errno, logging
+
+if __name__ == "__main__" and __package__ is None:
+    # Run as a script rather than with 'python -m', the package is not on the path.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import filechanges
+from filechanges import pathfilter
+
+logger = logging.getLogger("reloader")
+
+MESSAGE_HEADER = struct.Struct("!I")
+READ_SIZE = 64 * 1024
+
+# Each watched directory has an identity of its own, so that sequence numbers
+# from a directory the watcher has since dropped, or from before the watcher
+# restarted, are not mistaken for current ones.
+_watchIds = itertools.count(1)
+
+def GetWatchEpoch():
+    return "%d-%d-%d" % (os.getpid(), int(time.time() * 1000), _watchIds.next())
+
+
+class ConnectionLost(Exception):
+    pass
+
+
+class MessageStream(object):
+    """
+    Sends and receives messages over a connected socket.
+    """
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.readBuffer = ""
+
+    def Close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def EncodeMessage(self, message):
+        data = marshal.dumps(message)
+        return MESSAGE_HEADER.pack(len(data)) + data
+
+    def ReceiveMessages(self):
+        # Called when the socket is readable.
+        try:
+            data = self.socket.recv(READ_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise ConnectionLost(e)
+        if not data:
+            raise ConnectionLost("Connection closed")
+
+        self.readBuffer += data
+        messages = []
+        while len(self.readBuffer) >= MESSAGE_HEADER.size:
+            length, = MESSAGE_HEADER.unpack_from(self.readBuffer)
+            end = MESSAGE_HEADER.size + length
+            if len(self.readBuffer) < end:
+                break
+            messages.append(marshal.loads(self.readBuffer[MESSAGE_HEADER.size:end]))
+            self.readBuffer = self.readBuffer[end:]
+        return messages
+
+
+# ----------------------------------------------------------------------------
+# The watcher process.
+
+class ServerWatch(object):
+    def __init__(self, server, key, path, pathFilter):
+        self.key = key
+        self.path = path
+        self.epoch = GetWatchEpoch()
+        self.sequence = 0
+        self.history = collections.deque(maxlen=server.historySize)
+        # The clients watching, and the path each knows the directory by.
+        self.clients = {}
+
+        self.changes = []
+        self.handler = server.handlerClass(self.RecordFileChange, useThread=False)
+        self.handler.AddDirectory(path, pathFilter=pathFilter)
+
+    def RecordFileChange(self, filePath, added=False, changed=False, deleted=False):
+        self.changes.append((filePath, added, changed, deleted))
+
+    def GetRelativePath(self, filePath):
+        return filePath[len(os.path.join(self.path, "")):]
+
+    def GetFiles(self):
+        tldState = self.handler.watchState.get(self.path, {})
+        return dict((self.GetRelativePath(filePath), signature) for (filePath, signature) in tldState.iteritems())
+
+    def Scan(self):
+        self.handler.ProcessFileEvents()
+        changes, self.changes = self.changes, []
+
+        # The signatures are only known once the check is complete.
+        tldState = self.handler.watchState.get(self.path, {})
+        for filePath, added, changed, deleted in changes:
+            self.sequence += 1
+            entry = (self.sequence, self.GetRelativePath(filePath), added, changed, deleted, tldState.get(filePath))
+            self.history.append(entry)
+            for client, root in self.clients.items():
+                client.SendChange(root, entry)
+
+    def SendState(self, client, root, epoch, sequence):
+        """
+        Bring the client up to date, from the last sequence number it saw.
+        """
+        if epoch == self.epoch and sequence is not None:
+            if sequence == self.sequence:
+                return
+            if self.history and self.history[0][0] <= sequence + 1 and sequence < self.sequence:
+                for entry in self.history:
+                    if entry[0] > sequence:
+                        client.SendChange(root, entry)
+                return
+
+        client.Send({ "op": "snapshot", "root": root, "epoch": self.epoch, "sequence": self.sequence, "files": self.GetFiles() })
+
+
+class ServerClient(MessageStream):
+    def __init__(self, server, sock):
+        MessageStream.__init__(self, sock)
+        self.server = server
+        self.writeBuffer = ""
+        self.watches = {}
+
+    def Send(self, message):
+        if self.socket is None:
+            return
+        self.writeBuffer += self.EncodeMessage(message)
+        # A client this far behind gets dropped, and catches up on reconnecting.
+        if len(self.writeBuffer) > self.server.maxClientBuffer:
+            logger.warning("Dropping file change client which is not keeping up")
+            self.server.RemoveClient(self)
+
+    def SendChange(self, root, entry):
+        sequence, relativePath, added, changed, deleted, signature = entry
+        self.Send({ "op": "change", "root": root, "sequence": sequence, "relativePath": relativePath, "added": added, "changed": changed, "deleted": deleted, "signature": signature })
+
+    def Flush(self):
+        try:
+            sent = self.socket.send(self.writeBuffer)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise ConnectionLost(e)
+        self.writeBuffer = self.writeBuffer[sent:]
+
+
+class WatcherServer(object):
+    # The class used to scan each distinct directory.
+    handlerClass = filechanges.ChangeHandler
+    # How many changes are kept for each directory for clients to catch up on.
+    historySize = 10000
+    # How much unsent data a client is allowed to have pending.
+    maxClientBuffer = 4 * 1024 * 1024
+    # The longest the server waits before noticing it has been closed.
+    pollInterval = 0.5
+
+    def __init__(self, socketPath, delay=1.0):
+        self.socketPath = socketPath
+        self.delay = delay
+        self.listener = None
+        self.clients = []
+        self.watches = {}
+        self.closed = False
+
+    def Listen(self):
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socketPath)
+        os.chmod(self.socketPath, 0600)
+        self.listener.listen(64)
+        self.listener.setblocking(0)
+
+    def Close(self):
+        # Serving stops within the poll interval.
+        self.closed = True
+
+    def Serve(self):
+        if self.listener is None:
+            self.Listen()
+
+        nextScanTime = time.time() + self.delay
+        try:
+            while not self.closed:
+                timeout = min(max(0.0, nextScanTime - time.time()), self.pollInterval)
+                readers = [ self.listener ] + [ client.socket for client in self.clients ]
+                writers = [ client.socket for client in self.clients if client.writeBuffer ]
+                try:
+                    readable, writable, broken = select.select(readers, writers, [], timeout)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                clientsBySocket = dict((client.socket, client) for client in self.clients)
+                for sock in readable:
+                    if sock is self.listener:
+                        self.AcceptClient()
+                        continue
+                    client = clientsBySocket[sock]
+                    if client.socket is None:
+                        continue
+                    try:
+                        for message in client.ReceiveMessages():
+                            self.HandleMessage(client, message)
+                    except (ConnectionLost, ValueError, EOFError, TypeError, KeyError):
+                        self.RemoveClient(client)
+
+                for sock in writable:
+                    client = clientsBySocket[sock]
+                    if client.socket is None:
+                        continue
+                    try:
+                        client.Flush()
+                    except ConnectionLost:
+                        self.RemoveClient(client)
+
+                if time.time() >= nextScanTime:
+                    self.Scan()
+                    nextScanTime = time.time() + self.delay
+        finally:
+            for client in self.clients[:]:
+                self.RemoveClient(client)
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+
+    def AcceptClient(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        self.clients.append(ServerClient(self, sock))
+
+    def RemoveClient(self, client):
+        for watch in client.watches.values():
+            self.Unwatch(client, watch)
+        client.Close()
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def Unwatch(self, client, watch):
+        watch.clients.pop(client, None)
+        if not watch.clients and self.watches.get(watch.key) is watch:
+            del self.watches[watch.key]
+
+    def Scan(self):
+        for watch in self.watches.values():
+            watch.Scan()
+
+    def HandleMessage(self, client, message):
+        op = message["op"]
+        if op == "watch":
+            root = message["root"]
+            pathFilter = pathfilter.PathFilter(message["includeRules"], message["excludeRules"])
+            key = os.path.normcase(os.path.abspath(root)), tuple(pathFilter.includeRules), tuple(pathFilter.excludeRules)
+
+            watch = self.watches.get(key)
+            if watch is None:
+                watch = self.watches[key] = ServerWatch(self, key, root, pathFilter)
+            previousWatch = client.watches.get(root)
+            if previousWatch is not None and previousWatch is not watch:
+                self.Unwatch(client, previousWatch)
+
+            watch.clients[client] = root
+            client.watches[root] = watch
+            watch.SendState(client, root, message.get("epoch"), message.get("sequence"))
+        elif op == "unwatch":
+            watch = client.watches.pop(message["root"], None)
+            if watch is not None:
+                self.Unwatch(client, watch)
+        elif op == "scan":
+            # Bring the watches this client is interested in up to date now.
+            for watch in client.watches.values():
+                watch.Scan()
+            client.Send({ "op": "scanned", "request": message["request"] })
+        else:
+            logger.error("Unknown file change client request '%s'", op)
+
+
+# ----------------------------------------------------------------------------
+# The client side, acting as the module which does the work for the handler.
+
+class ClientConnection(MessageStream):
+    def __init__(self, socketPath, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socketPath)
+        except socket.error, e:
+            sock.close()
+            raise ConnectionLost(e)
+        MessageStream.__init__(self, sock)
+
+        # Where each directory is up to, so that the watcher can catch us up.
+        self.epochs = {}
+        self.sequences = {}
+        # Directories waiting on their state from the watcher, and whether it
+        # is their starting state, rather than a resynchronisation.
+        self.awaitingState = {}
+        self.requestIds = itertools.count(1)
+
+    def Send(self, message):
+        if self.socket is None:
+            raise ConnectionLost("Connection closed")
+        try:
+            self.socket.sendall(self.EncodeMessage(message))
+        except socket.error, e:
+            raise ConnectionLost(e)
+
+    def Receive(self, timeout=0.0):
+        if self.socket is None:
+            raise ConnectionLost("Connection closed")
+        readable, writable, broken = select.select([ self.socket ], [], [], timeout)
+        if not readable:
+            return []
+        return self.ReceiveMessages()
+
+
+def Prepare(handler):
+    if handler.watchState is None:
+        handler.watchState = {}
+
+    try:
+        connection = handler.daemonConnection
+        if connection is None:
+            connection = Reconnect(handler)
+            if connection is None:
+                return
+
+        for path in connection.sequences.keys():
+            if path not in handler.directories:
+                connection.Send({ "op": "unwatch", "root": path })
+                DropDirectory(handler, path)
+
+        # Only the directories we are not watching already need their state.
+        for path in handler.directories:
+            if path not in connection.sequences and path not in connection.awaitingState:
+                WatchDirectory(handler, path)
+
+        # Wait for the starting points, so that existing files are not
+        # reported as added.
+        endTime = time.time() + handler.connectTimeout
+        while True in connection.awaitingState.values() and time.time() < endTime:
+            for message in connection.Receive(endTime - time.time()):
+                HandleMessage(handler, message)
+    except ConnectionLost:
+        Disconnect(handler)
+
+def AddDirectory(handler, path):
+    # Only directories which are not being watched already are asked for.
+    Prepare(handler)
+
+def RemoveDirectory(handler, path):
+    Prepare(handler)
+
+def Connect(handler):
+    try:
+        connection = ClientConnection(handler.socketPath, handler.connectTimeout)
+    except ConnectionLost, e:
+        if not handler.daemonConnectionFailed:
+            logger.warning("Unable to connect to the file change watcher at '%s': %s", handler.socketPath, e)
+            handler.daemonConnectionFailed = True
+        return None
+
+    handler.daemonConnection = connection
+    handler.daemonConnectionFailed = False
+    return connection
+
+def Disconnect(handler):
+    connection = handler.daemonConnection
+    if connection is not None:
+        logger.warning("Lost the connection to the file change watcher at '%s'", handler.socketPath)
+        connection.Close()
+        # Where each directory is up to is kept, for catching up on reconnecting.
+        handler.daemonEpochs = connection.epochs
+        handler.daemonSequences = connection.sequences
+    handler.daemonConnection = None
+
+def Reconnect(handler):
+    connection = Connect(handler)
+    if connection is None:
+        return None
+
+    # Catch up on whatever happened while we were not connected.
+    for path in handler.directories:
+        sequence = handler.daemonSequences.get(path)
+        if sequence is None:
+            continue
+        epoch = handler.daemonEpochs.get(path)
+        connection.epochs[path] = epoch
+        connection.sequences[path] = sequence
+        WatchDirectory(handler, path, epoch, sequence)
+    return connection
+
+def WatchDirectory(handler, path, epoch=None, sequence=None):
+    connection = handler.daemonConnection
+    pathFilter = handler.pathFilters.get(path, handler.defaultPathFilter)
+    if sequence is None:
+        connection.awaitingState[path] = path not in connection.sequences
+    connection.Send({ "op": "watch", "root": path, "includeRules": list(pathFilter.includeRules), "excludeRules": list(pathFilter.excludeRules), "epoch": epoch, "sequence": sequence })
+
+def DropDirectory(handler, path):
+    connection = handler.daemonConnection
+    connection.epochs.pop(path, None)
+    connection.sequences.pop(path, None)
+    connection.awaitingState.pop(path, None)
+    handler.watchState.pop(path, None)
+
+def Check(handler, skipEvents=False):
+    try:
+        connection = handler.daemonConnection
+        if connection is None:
+            connection = Reconnect(handler)
+            if connection is None:
+                return
+
+        if handler.scanRequested:
+            handler.scanRequested = False
+            requestId = connection.requestIds.next()
+            connection.Send({ "op": "scan", "request": requestId })
+
+            endTime = time.time() + handler.connectTimeout
+            while time.time() < endTime:
+                messages = connection.Receive(endTime - time.time())
+                for message in messages:
+                    HandleMessage(handler, message, skipEvents)
+                if any(message["op"] == "scanned" and message["request"] == requestId for message in messages):
+                    break
+
+        while True:
+            messages = connection.Receive()
+            if not messages:
+                break
+            for message in messages:
+                HandleMessage(handler, message, skipEvents)
+    except ConnectionLost:
+        Disconnect(handler)
+
+def HandleMessage(handler, message, skipEvents=False):
+    connection = handler.daemonConnection
+    op = message["op"]
+    if op == "scanned":
+        return
+
+    root = message["root"]
+    if root not in handler.directories:
+        return
+
+    tldState = handler.watchState.setdefault(root, {})
+    if op == "change":
+        if root in connection.awaitingState:
+            return
+        # A gap in the sequence means changes have been missed.
+        if message["sequence"] != connection.sequences.get(root, 0) + 1:
+            WatchDirectory(handler, root)
+            return
+        connection.sequences[root] = message["sequence"]
+
+        filePath = os.path.join(root, message["relativePath"])
+        if message["deleted"]:
+            tldState.pop(filePath, None)
+        else:
+            tldState[filePath] = message["signature"]
+        if not skipEvents:
+            handler.DispatchFileChange(filePath, added=message["added"], changed=message["changed"], deleted=message["deleted"])
+    elif op == "snapshot":
+        # The first state of a directory is the starting point, after that
+        # the differences from what we knew are reported.
+        skipEvents = skipEvents or connection.awaitingState.pop(root, False)
+        connection.epochs[root] = message["epoch"]
+        connection.sequences[root] = message["sequence"]
+
+        files = dict((os.path.join(root, relativePath), signature) for (relativePath, signature) in message["files"].iteritems())
+        if not skipEvents:
+            for filePath, signature in files.iteritems():
+                oldSignature = tldState.get(filePath)
+                if oldSignature is None:
+                    handler.DispatchFileChange(filePath, added=True)
+                elif oldSignature != signature:
+                    handler.DispatchFileChange(filePath, changed=True)
+            for filePath in tldState:
+                if filePath not in files:
+                    handler.DispatchFileChange(filePath, deleted=True)
+        handler.watchState[root] = files
+
+
+class DaemonChangeHandler(filechanges.ChangeHandler):
+    """
+    A change handler which gets its changes from a watcher process.  With a
+    thread, the changes are collected as often as the delay given, and the
+    watcher is only asked to scan when 'ScanNow' is called.
+    """
+
+    # Nothing is scanned by the handler itself.
+    useNativeMonitoring = False
+    socketPath = None
+    # How long to wait for the watcher to connect, or reply.
+    connectTimeout = 5.0
+
+    def __init__(self, callback, delay=None, useThread=True, batchCallback=None, coalesceDelay=None, snapshotPath=None, settleTime=None, socketPath=None):
+        if snapshotPath is not None:
+            raise ValueError("Daemon change handlers do not support snapshots")
+        if socketPath is not None:
+            self.socketPath = socketPath
+        if self.socketPath is None:
+            raise ValueError("No watcher socket path given")
+
+        self.daemonConnection = None
+        self.daemonConnectionFailed = False
+        self.daemonEpochs = {}
+        self.daemonSequences = {}
+        self.scanRequested = False
+        filechanges.ChangeHandler.__init__(self, callback, delay, useThread, batchCallback, coalesceDelay, settleTime=settleTime)
+
+    def GetFileChangeModule(self):
+        return sys.modules[__name__]
+
+    def ScanNow(self, timeout=None):
+        self.scanRequested = True
+        return filechanges.ChangeHandler.ScanNow(self, timeout)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print "Usage: python -m filechanges.daemon <socket path> [<scan delay>]"
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO)
+    server = WatcherServer(sys.argv[1])
+    if len(sys.argv) == 3:
+        server.delay = float(sys.argv[2])
+    server.Serve()
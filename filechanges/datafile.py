@@ -0,0 +1,67 @@
+"""
+Files of saved data which are replaced whole, so that a reader never sees a
+partially written one.
+
+'Write' writes to a temporary file of the calling process's own and renames
+it into place.  'Save' and 'Load' keep a tuple of values written with
+'marshal', preceded by a version number.  The version should be increased
+whenever the layout of the values changes, so that data saved by another
+version is ignored rather than misread.
+"""
+
+import os, marshal, logging
+
+logger = logging.getLogger("reloader")
+
+
+def Write(filePath, chunks):
+    # The chunks are the strings to write, in order.
+    tmpFilePath = "%s.%d.tmp" % (filePath, os.getpid())
+    try:
+        f = open(tmpFilePath, "wb")
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+        finally:
+            f.close()
+
+        # Windows does not allow renaming over an existing file.
+        if os.name == "nt" and os.path.exists(filePath):
+            os.remove(filePath)
+        os.rename(tmpFilePath, filePath)
+    except (IOError, OSError):
+        if os.path.exists(tmpFilePath):
+            os.remove(tmpFilePath)
+        raise
+
+def Save(filePath, version, values):
+    data = marshal.dumps((version,) + tuple(values))
+    Write(filePath, [ data ])
+    return len(data)
+
+def Load(filePath, version, description):
+    """
+    Returns the tuple of values saved in the given file, or None if there is
+    no file, or it is unreadable or from another version.  The description
+    names what the file is, for logging.
+    """
+    try:
+        f = open(filePath, "rb")
+    except IOError:
+        return None
+
+    try:
+        try:
+            data = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            data = None
+    finally:
+        f.close()
+
+    if not isinstance(data, tuple) or not data:
+        logger.warning("Ignoring unreadable %s '%s'", description, filePath)
+        return None
+    if data[0] != version:
+        logger.info("Ignoring %s '%s' from another version", description, filePath)
+        return None
+    return data[1:]
@@ -0,0 +1,194 @@
+"""
+A compact form of the watched state of a registered directory, for use where
+the trees being watched are large ('ChangeHandler.compactWatchState').
+
+The watched state is normally a dictionary mapping each full file path to a
+'(mtime, size, inode)' tuple.  A 'FileTable' holds each directory path once,
+the names of the files within them, and the signatures in parallel typed
+arrays.  The rows are ordered by directory and then by file name, so the
+state from one scan can be compared with the state from the last by merging,
+and where a directory holds the same files as it did, by comparing whole
+arrays at once.  NumPy is used to find the rows which differ if it is
+available, otherwise the rows are only examined in the directories which
+have changes.
+
+A table can be read like the dictionary it replaces, but not modified.
+"""
+
+import os, bisect
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Python 2 arrays have no type code which is explicitly 64 bits.  Where a long
+# is smaller than that, doubles hold sizes and inodes exactly up to 2**53.
+if array("l").itemsize >= 8:
+    SIZE_TYPECODE = "l"
+    INODE_TYPECODE = "L"
+else:
+    SIZE_TYPECODE = INODE_TYPECODE = "d"
+
+
+class FileTable(object):
+    def __init__(self, items=()):
+        self.dirPaths = []
+        # The first row of each directory, followed by the number of rows.
+        self.dirStarts = array("l")
+        self.fileNames = []
+        self.mtimes = array("d")
+        self.sizes = array(SIZE_TYPECODE)
+        self.inodes = array(INODE_TYPECODE)
+        self.dirIndexes = None
+
+        lastDirPath = None
+        for (dirPath, fileName), signature in sorted((os.path.split(path), signature) for (path, signature) in items):
+            if dirPath != lastDirPath:
+                self.dirStarts.append(len(self.fileNames))
+                self.dirPaths.append(dirPath)
+                lastDirPath = dirPath
+            self.fileNames.append(fileName)
+            mtime, size, inode = signature
+            self.mtimes.append(mtime)
+            self.sizes.append(size)
+            self.inodes.append(inode)
+        self.dirStarts.append(len(self.fileNames))
+
+    def __repr__(self):
+        return "<FileTable directories=%d files=%d>" % (len(self.dirPaths), len(self.fileNames))
+
+    def __len__(self):
+        return len(self.fileNames)
+
+    def __iter__(self):
+        for dirIndex, dirPath in enumerate(self.dirPaths):
+            for fileName in self.fileNames[self.dirStarts[dirIndex]:self.dirStarts[dirIndex+1]]:
+                yield os.path.join(dirPath, fileName)
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        row = 0
+        for path in self:
+            yield path, self.GetSignature(row)
+            row += 1
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __contains__(self, path):
+        return self.FindRow(path) is not None
+
+    def __getitem__(self, path):
+        row = self.FindRow(path)
+        if row is None:
+            raise KeyError(path)
+        return self.GetSignature(row)
+
+    def get(self, path, default=None):
+        row = self.FindRow(path)
+        if row is None:
+            return default
+        return self.GetSignature(row)
+
+    def FindRow(self, path):
+        if self.dirIndexes is None:
+            self.dirIndexes = dict((dirPath, dirIndex) for (dirIndex, dirPath) in enumerate(self.dirPaths))
+
+        dirPath, fileName = os.path.split(path)
+        dirIndex = self.dirIndexes.get(dirPath)
+        if dirIndex is None:
+            return None
+
+        start, end = self.dirStarts[dirIndex], self.dirStarts[dirIndex+1]
+        row = bisect.bisect_left(self.fileNames, fileName, start, end)
+        if row < end and self.fileNames[row] == fileName:
+            return row
+
+    def GetSignature(self, row):
+        return self.mtimes[row], self.sizes[row], self.inodes[row]
+
+    def GetPath(self, row):
+        dirIndex = bisect.bisect_right(self.dirStarts, row) - 1
+        return os.path.join(self.dirPaths[dirIndex], self.fileNames[row])
+
+    def GetPaths(self, dirIndex, rows):
+        dirPath = self.dirPaths[dirIndex]
+        return [ os.path.join(dirPath, self.fileNames[row]) for row in rows ]
+
+    def FindChangedRows(self, old, start, oldStart, count):
+        """
+        Returns the offsets, from 'start', of the rows whose signatures differ
+        from the rows at the same offset from 'oldStart' in the old table.
+        """
+        end, oldEnd = start + count, oldStart + count
+        columns = []
+        for values, oldValues in ((self.mtimes, old.mtimes), (self.sizes, old.sizes), (self.inodes, old.inodes)):
+            values, oldValues = values[start:end], oldValues[oldStart:oldEnd]
+            if values != oldValues:
+                columns.append((values, oldValues))
+        if not columns:
+            return []
+
+        if numpy is not None:
+            differs = numpy.zeros(count, dtype=bool)
+            for values, oldValues in columns:
+                differs |= numpy.frombuffer(values, dtype=values.typecode) != numpy.frombuffer(oldValues, dtype=oldValues.typecode)
+            return numpy.flatnonzero(differs).tolist()
+
+        offsets = set()
+        for values, oldValues in columns:
+            offsets.update(offset for offset in xrange(count) if values[offset] != oldValues[offset])
+        return sorted(offsets)
+
+    def Compare(self, old):
+        """
+        Returns '(added, changed, deleted)', the paths of the files which
+        differ between the old table and this one.
+        """
+        added, changed, deleted = [], [], []
+
+        # Nothing was added or removed, only the signatures need comparing.
+        if self.fileNames == old.fileNames and self.dirPaths == old.dirPaths and self.dirStarts == old.dirStarts:
+            changed = [ self.GetPath(row) for row in self.FindChangedRows(old, 0, 0, len(self)) ]
+            return added, changed, deleted
+
+        oldDirIndexes = dict((dirPath, dirIndex) for (dirIndex, dirPath) in enumerate(old.dirPaths))
+        for dirIndex, dirPath in enumerate(self.dirPaths):
+            start, end = self.dirStarts[dirIndex], self.dirStarts[dirIndex+1]
+            oldDirIndex = oldDirIndexes.pop(dirPath, None)
+            if oldDirIndex is None:
+                added.extend(self.GetPaths(dirIndex, xrange(start, end)))
+                continue
+
+            oldStart, oldEnd = old.dirStarts[oldDirIndex], old.dirStarts[oldDirIndex+1]
+            fileNames, oldFileNames = self.fileNames[start:end], old.fileNames[oldStart:oldEnd]
+            if fileNames == oldFileNames:
+                offsets = self.FindChangedRows(old, start, oldStart, end - start)
+                changed.extend(self.GetPaths(dirIndex, [ start + offset for offset in offsets ]))
+                continue
+
+            # Both lists of names are sorted, so they can be merged.
+            row, oldRow = start, oldStart
+            while row < end or oldRow < oldEnd:
+                if oldRow == oldEnd or (row < end and self.fileNames[row] < old.fileNames[oldRow]):
+                    added.append(os.path.join(dirPath, self.fileNames[row]))
+                    row += 1
+                elif row == end or old.fileNames[oldRow] < self.fileNames[row]:
+                    deleted.append(os.path.join(dirPath, old.fileNames[oldRow]))
+                    oldRow += 1
+                else:
+                    if self.GetSignature(row) != old.GetSignature(oldRow):
+                        changed.append(os.path.join(dirPath, self.fileNames[row]))
+                    row += 1
+                    oldRow += 1
+
+        for dirPath, oldDirIndex in sorted(oldDirIndexes.iteritems()):
+            deleted.extend(old.GetPaths(oldDirIndex, xrange(old.dirStarts[oldDirIndex], old.dirStarts[oldDirIndex+1])))
+
+        return added, changed, deleted
@@ -0,0 +1,397 @@
+"""
+Change detection for Linux using the kernel inotify interface, accessed via
+ctypes so that no compiled extension is required.
+
+Every directory under each registered directory gets a watch.  Instead of
+walking and stat'ing the whole tree on each check, only the paths the kernel
+has reported events for are examined.  Directories created after the watches
+were added get watches of their own, and the files already within them are
+reported as added.
+
+Fallbacks:
+
+- If the kernel event queue overflows, events have been lost.  A full rescan
+  is done using the polling module to resynchronise the watched state.
+- If the per-user watch limit (/proc/sys/fs/inotify/max_user_watches) is
+  reached, inotify is abandoned for the given handler and the polling module
+  is used in its place.
+
+The watched state is kept in 'handler.watchState' in the same form that the
+polling module uses, which is what allows either fallback to take over at
+any point.
+"""
+
+import os, stat, errno, struct, logging
+import ctypes, ctypes.util
+
+import recipe215418
+
+logger = logging.getLogger("reloader")
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+
+IN_CLOEXEC      = 0x00080000
+IN_NONBLOCK     = 0x00000800
+
+# 'IN_ATTRIB' is for changes to the mtime alone, as from 'touch', which the
+# polling scanner reports.
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+def GetLibC():
+    global _libc
+    if _libc is None:
+        libraryName = ctypes.util.find_library("c") or "libc.so.6"
+        libc = ctypes.CDLL(libraryName, use_errno=True)
+        libc.inotify_init1.argtypes = [ ctypes.c_int ]
+        libc.inotify_init1.restype = ctypes.c_int
+        libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+        libc.inotify_add_watch.restype = ctypes.c_int
+        libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+        libc.inotify_rm_watch.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+def IsAvailable():
+    try:
+        libc = GetLibC()
+    except (OSError, AttributeError):
+        return False
+    return hasattr(libc, "inotify_init1")
+
+
+class WatchLimitReached(Exception):
+    pass
+
+
+class InotifyState(object):
+    def __init__(self):
+        self.libc = GetLibC()
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.pathsByWatch = {}
+        self.watchesByPath = {}
+        self.directories = []
+        # Directories which need a full scan on the next check.
+        self.resyncDirectories = []
+
+    def __del__(self):
+        self.Close()
+
+    def Close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.pathsByWatch.clear()
+            self.watchesByPath.clear()
+
+    def AddWatch(self, dirPath):
+        wd = self.libc.inotify_add_watch(self.fd, dirPath, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchLimitReached(dirPath)
+            # The directory may have gone away before we got to it.
+            if err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                logger.error("Unable to watch directory '%s': %s", dirPath, os.strerror(err))
+            return False
+
+        self.pathsByWatch[wd] = dirPath
+        self.watchesByPath[dirPath] = wd
+        return True
+
+    def RemoveWatches(self, dirPath):
+        prefix = os.path.join(dirPath, "")
+        for path, wd in self.watchesByPath.items():
+            if path == dirPath or path.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watchesByPath[path]
+                self.pathsByWatch.pop(wd, None)
+
+    def ReadEvents(self):
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, nameLength = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset+nameLength].rstrip("\0")
+                offset += nameLength
+                events.append((wd, mask, name))
+        return events
+
+
+def Prepare(handler):
+    Release(handler)
+
+    try:
+        state = InotifyState()
+    except OSError, e:
+        logger.warning("Unable to initialise inotify (%s), falling back to polling", e)
+        recipe215418.Prepare(handler)
+        return
+
+    handler.inotifyState = state
+    handler.watchState = {}
+
+    try:
+        for path in handler.directories:
+            PrimeDirectory(handler, path)
+    except WatchLimitReached:
+        # Nothing has been reported yet, polling gathers the state afresh.
+        LogWatchLimitReached()
+        Release(handler)
+        recipe215418.Prepare(handler)
+        return
+
+    state.directories = list(handler.directories)
+
+def PrimeDirectory(handler, path):
+    state = handler.inotifyState
+    tldState = handler.snapshotState.get(path)
+    if tldState is None:
+        handler.watchState[path] = {}
+        WatchDirectory(handler, path, path, skipEvents=True)
+    else:
+        # Compared against the snapshot by the next check.
+        handler.watchState[path] = dict(tldState)
+        AddWatches(handler, path)
+        state.resyncDirectories.append(path)
+
+def AddDirectory(handler, path):
+    state = getattr(handler, "inotifyState", None)
+    if state is None:
+        recipe215418.AddDirectory(handler, path)
+        return
+
+    # Only the new directory needs watches, and its state gathered.
+    try:
+        PrimeDirectory(handler, path)
+    except WatchLimitReached:
+        # The state of the other directories is kept for polling to carry on
+        # from, only the new directory is gathered afresh.
+        LogWatchLimitReached()
+        Release(handler)
+        recipe215418.AddDirectory(handler, path)
+        return
+    state.directories.append(path)
+
+def RemoveDirectory(handler, path):
+    state = getattr(handler, "inotifyState", None)
+    if state is None:
+        recipe215418.RemoveDirectory(handler, path)
+        return
+
+    state.RemoveWatches(path)
+    handler.watchState.pop(path, None)
+    if path in state.directories:
+        state.directories.remove(path)
+
+def Release(handler):
+    state = getattr(handler, "inotifyState", None)
+    if state is not None:
+        state.Close()
+    handler.inotifyState = None
+
+def LogWatchLimitReached():
+    logger.warning("Reached the inotify watch limit (see /proc/sys/fs/inotify/max_user_watches), falling back to polling")
+
+def FallBackToPolling(handler, skipEvents=False):
+    # The watched state is not yet up to date with the events which were
+    # read, or lost.  Polling compares it against the disk, so that whatever
+    # changed since it was last updated is still reported.
+    LogWatchLimitReached()
+    Release(handler)
+    recipe215418.Check(handler, skipEvents)
+
+def Check(handler, skipEvents=False):
+    state = getattr(handler, "inotifyState", None)
+    if state is None:
+        recipe215418.Check(handler, skipEvents)
+        return
+
+    # Directories may have been unregistered since the last check.
+    if state.directories != handler.directories:
+        for path in state.directories:
+            if path not in handler.directories:
+                state.RemoveWatches(path)
+                handler.watchState.pop(path, None)
+        state.directories = list(handler.directories)
+
+    if state.resyncDirectories:
+        directories = [ path for path in state.resyncDirectories if path in handler.directories ]
+        state.resyncDirectories = []
+        recipe215418.Check(handler, skipEvents, directories=directories)
+
+    overflowed = False
+    createdDirectories = []
+    # Changed paths are examined in the order they were first reported.
+    changedPaths = []
+    changedPathSet = set()
+
+    for wd, mask, name in state.ReadEvents():
+        if mask & IN_Q_OVERFLOW:
+            overflowed = True
+            continue
+
+        if mask & IN_IGNORED:
+            dirPath = state.pathsByWatch.pop(wd, None)
+            if dirPath is not None and state.watchesByPath.get(dirPath) == wd:
+                del state.watchesByPath[dirPath]
+            continue
+
+        dirPath = state.pathsByWatch.get(wd)
+        if dirPath is None:
+            continue
+
+        if not name:
+            # Events about the watched directory itself are covered by the
+            # events its parent directory receives.
+            continue
+
+        path = os.path.join(dirPath, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if not handler.ShouldIgnoreDirectory(path):
+                    createdDirectories.append(path)
+            elif mask & IN_MOVED_FROM:
+                # Anything we knew about under the directory is now gone.
+                prefix = os.path.join(path, "")
+                for tldState in handler.watchState.itervalues():
+                    for filePath in tldState:
+                        if filePath.startswith(prefix) and filePath not in changedPathSet:
+                            changedPathSet.add(filePath)
+                            changedPaths.append(filePath)
+                state.RemoveWatches(path)
+            continue
+
+        if handler.ShouldIgnoreFile(path):
+            continue
+
+        if path not in changedPathSet:
+            changedPathSet.add(path)
+            changedPaths.append(path)
+
+    if overflowed:
+        logger.warning("The inotify event queue overflowed, rescanning all directories")
+        try:
+            for path in handler.directories:
+                AddWatches(handler, path)
+        except WatchLimitReached:
+            FallBackToPolling(handler, skipEvents)
+            return
+        recipe215418.Check(handler, skipEvents)
+        return
+
+    try:
+        for dirPath in createdDirectories:
+            tldPath = FindDirectory(handler, dirPath)
+            if tldPath is not None:
+                WatchDirectory(handler, tldPath, dirPath, skipEvents=skipEvents)
+    except WatchLimitReached:
+        FallBackToPolling(handler, skipEvents)
+        return
+
+    for path in changedPaths:
+        tldPath = FindDirectory(handler, path)
+        if tldPath is not None:
+            CheckFile(handler, tldPath, path, skipEvents)
+
+def FindDirectory(handler, path):
+    # Where registered directories are nested, the innermost one.
+    dirPath = None
+    for tldPath in handler.directories:
+        if path.startswith(os.path.join(tldPath, "")):
+            if dirPath is None or len(tldPath) > len(dirPath):
+                dirPath = tldPath
+    return dirPath
+
+def AddWatches(handler, dirPath):
+    state = handler.inotifyState
+    for dirPath, dirNames, fileNames in os.walk(dirPath):
+        dirNames[:] = [ dirName for dirName in dirNames if not handler.ShouldIgnoreDirectory(os.path.join(dirPath, dirName)) ]
+        state.AddWatch(dirPath)
+
+def GetDirectoryState(handler, tldPath):
+    # Files are updated here one at a time, which a compact table from a
+    # rescan does not allow.  It is replaced by a dictionary.
+    tldState = handler.watchState.get(tldPath)
+    if tldState is None:
+        tldState = handler.watchState[tldPath] = {}
+    elif not isinstance(tldState, dict):
+        tldState = handler.watchState[tldPath] = dict(tldState.iteritems())
+    return tldState
+
+def WatchDirectory(handler, tldPath, dirPath, skipEvents=False):
+    state = handler.inotifyState
+    tldState = GetDirectoryState(handler, tldPath)
+
+    # The watch is added before the directory contents are listed, so that
+    # files created in between are not missed.
+    for subDirPath, dirNames, fileNames in os.walk(dirPath):
+        dirNames[:] = [ dirName for dirName in dirNames if not handler.ShouldIgnoreDirectory(os.path.join(subDirPath, dirName)) ]
+        state.AddWatch(subDirPath)
+
+        for fileName in fileNames:
+            path = os.path.join(subDirPath, fileName)
+            if path in tldState or handler.ShouldIgnoreFile(path):
+                continue
+            CheckFile(handler, tldPath, path, skipEvents)
+
+def CheckFile(handler, tldPath, path, skipEvents=False):
+    tldState = GetDirectoryState(handler, tldPath)
+    oldSignature = tldState.get(path)
+
+    try:
+        t = os.stat(path)
+    except os.error:
+        if oldSignature is not None:
+            del tldState[path]
+            if not skipEvents:
+                handler.DispatchFileChange(path, deleted=True)
+        return
+
+    handler.statistics["statCalls"] += 1
+    if stat.S_ISDIR(t.st_mode):
+        return
+
+    signature = recipe215418.GetFileSignature(t)
+    tldState[path] = signature
+    if skipEvents:
+        return
+
+    if oldSignature is None:
+        handler.DispatchFileChange(path, added=True)
+    elif signature != oldSignature:
+        handler.DispatchFileChange(path, changed=True)
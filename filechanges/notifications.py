@@ -0,0 +1,213 @@
+"""
+A local channel through which editors and deploy tools can report the files
+they have written, rather than waiting for the next scan to find them.
+
+The server listens on a Unix socket, and passes each reported file to a
+callback where the change handler calls its callbacks (see
+'ChangeHandler.QueueCall', or the event loop for an
+'asyncwatcher.ChangeWatcher').  Once the callback has been called for all the
+files in a message, the sender is told the result for each, and how long
+it took.  A 'CodeReloader' starts one with 'StartNotificationServer'.
+
+    reply = NotifyFileChanges("/tmp/reloader.sock", [ filePath ])
+
+Or from the command line, with the 'filechanges' package on the path:
+
+    python -m filechanges.notifications /tmp/reloader.sock <file path> ...
+
+A sender can give the SHA-1 of the contents it wrote for each file.  A file
+which no longer has those contents is not passed on, as it is still being
+written or has been written again since, and is reported as "stale".  The
+other results are "applied", where the callback returned a true value, and
+"rejected".
+
+The messages are those of the watcher process, length prefixed 'marshal'
+data, see 'daemon'.  The socket is only accessible to the user the server
+runs as.
+"""
+
+import os, sys, time, socket, hashlib, threading, itertools, logging
+
+if __name__ == "__main__" and __package__ is None:
+    # Run as a script rather than with 'python -m', the package is not on the path.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filechanges.daemon import MessageStream, ClientConnection, ConnectionLost
+
+logger = logging.getLogger("reloader")
+
+
+class NotificationConnection(MessageStream):
+    def __init__(self, server, sock):
+        MessageStream.__init__(self, sock)
+        self.server = server
+        # Replies are sent from wherever the callbacks are called.
+        self.sendLock = threading.Lock()
+
+    def Send(self, message):
+        self.sendLock.acquire()
+        try:
+            if self.socket is None:
+                return
+            try:
+                self.socket.sendall(self.EncodeMessage(message))
+            except socket.error:
+                self.Close()
+        finally:
+            self.sendLock.release()
+
+    def Serve(self):
+        try:
+            while self.socket is not None:
+                for message in self.ReceiveMessages():
+                    self.server.HandleMessage(self, message)
+        except (ConnectionLost, ValueError, EOFError, TypeError, KeyError, socket.error):
+            pass
+        self.server.RemoveConnection(self)
+
+
+class NotificationServer(threading.Thread):
+    # The longest the server waits before noticing it has been closed.
+    pollInterval = 0.5
+
+    def __init__(self, socketPath, handler, callback):
+        threading.Thread.__init__(self, name="NotificationServer")
+        self.setDaemon(1)
+
+        self.socketPath = socketPath
+        self.handler = handler
+        # Called with the path of each reported file, returning whether the
+        # change was applied.
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.connections = []
+        self.closed = False
+
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socketPath)
+        os.chmod(self.socketPath, 0600)
+        self.listener.listen(16)
+        self.listener.settimeout(self.pollInterval)
+
+    def Close(self):
+        # Serving stops within the poll interval.
+        self.closed = True
+
+    def run(self):
+        try:
+            while not self.closed:
+                try:
+                    sock, address = self.listener.accept()
+                except socket.timeout:
+                    continue
+                except socket.error:
+                    if self.closed:
+                        break
+                    raise
+
+                sock.settimeout(None)
+                connection = NotificationConnection(self, sock)
+                self.lock.acquire()
+                try:
+                    self.connections.append(connection)
+                finally:
+                    self.lock.release()
+                thread = threading.Thread(target=connection.Serve, name="NotificationConnection")
+                thread.setDaemon(1)
+                thread.start()
+        finally:
+            self.lock.acquire()
+            try:
+                for connection in self.connections:
+                    connection.Close()
+                self.connections = []
+            finally:
+                self.lock.release()
+            self.listener.close()
+            if os.path.exists(self.socketPath):
+                os.remove(self.socketPath)
+
+    def RemoveConnection(self, connection):
+        connection.Close()
+        self.lock.acquire()
+        try:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        finally:
+            self.lock.release()
+
+    def HandleMessage(self, connection, message):
+        op = message["op"]
+        if op == "changed":
+            self.handler.QueueCall(self.ApplyChanges, (connection, message, time.time()))
+        else:
+            logger.error("Unknown file change notification '%s'", op)
+
+    def ApplyChanges(self, connection, message, receivedTime):
+        hashes = message.get("hashes") or {}
+        results = {}
+        for filePath in message["paths"]:
+            expectedHash = hashes.get(filePath)
+            if expectedHash is not None and GetFileHash(filePath) != expectedHash:
+                results[filePath] = "stale"
+                continue
+
+            try:
+                applied = self.callback(filePath)
+            except Exception:
+                logger.exception("Problem applying notified file change '%s'", filePath)
+                applied = False
+            results[filePath] = applied and "applied" or "rejected"
+
+        connection.Send({ "op": "applied", "request": message.get("request"), "results": results, "elapsed": time.time() - receivedTime })
+
+def GetFileHash(filePath):
+    try:
+        f = open(filePath, "rb")
+    except IOError:
+        return None
+    try:
+        return hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+
+_requestIds = itertools.count(1)
+
+def NotifyFileChanges(socketPath, filePaths, hashes=None, timeout=10.0):
+    """
+    Report the given files as changed, and wait for them to be applied.
+    Returns the reply, with the 'results' for each file and the 'elapsed'
+    time, or None if there was none within the timeout.
+    """
+    connection = ClientConnection(socketPath, timeout)
+    try:
+        request = _requestIds.next()
+        message = { "op": "changed", "request": request, "paths": list(filePaths) }
+        if hashes:
+            message["hashes"] = hashes
+        connection.Send(message)
+
+        endTime = time.time() + timeout
+        while time.time() < endTime:
+            for reply in connection.Receive(endTime - time.time()):
+                if reply.get("request") == request:
+                    return reply
+    finally:
+        connection.Close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: python -m filechanges.notifications <socket path> <file path> ..."
+        sys.exit(1)
+
+    filePaths = [ os.path.abspath(filePath) for filePath in sys.argv[2:] ]
+    reply = NotifyFileChanges(sys.argv[1], filePaths, dict((filePath, GetFileHash(filePath)) for filePath in filePaths))
+    if reply is None:
+        print "No reply"
+        sys.exit(1)
+    for filePath in filePaths:
+        print reply["results"].get(filePath), filePath
+    print "%0.3f seconds" % reply["elapsed"]
@@ -0,0 +1,258 @@
+"""
+Decides which files and directories are of interest, using glob and
+gitignore-style rules.
+
+Rules are given relative to a registered directory, using '/' as the
+separator whatever the platform:
+
+- 'name' matches a file or directory with that name at any depth.
+- 'name/' only matches directories, and so everything within them.
+- A rule containing a '/' other than a trailing one is anchored to the
+  registered directory, e.g. '/build' or 'docs/*.py'.
+- '*' and '?' do not match '/', '**' does.  '[...]' matches a character set.
+- A leading '!' negates the rule.  As with gitignore, the last matching rule
+  decides the outcome.
+
+A filter has include rules, which select the files which are candidates at
+all (directories are never subject to these), and exclude rules, which remove
+files and whole directories from consideration.
+
+The rules are compiled once into lookup tables and a single regular
+expression.  Rules which are plain names or '*suffix' patterns, the great
+majority in practice, are matched with dictionary lookups, so the cost of a
+match does not grow with the number of those rules.
+"""
+
+import re
+
+# Python limits the number of groups in a regular expression.
+MAX_GROUPS_PER_EXPRESSION = 90
+
+GLOB_CHARACTERS = "*?["
+
+
+class Rule(object):
+    def __init__(self, index, text):
+        self.index = index
+        self.text = text
+
+        pattern = text
+        self.negated = pattern.startswith("!")
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\!") or pattern.startswith("\\#"):
+            pattern = pattern[1:]
+
+        self.directoryOnly = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+
+        self.anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        self.pattern = pattern
+
+        # Plain names, and names with a wildcard prefix, can be looked up.
+        self.name = None
+        self.suffix = None
+        if not self.anchored:
+            if not ContainsGlob(pattern):
+                self.name = pattern
+            elif pattern.startswith("*") and not ContainsGlob(pattern[1:]) and len(pattern) > 1:
+                self.suffix = pattern[1:]
+
+    def __repr__(self):
+        return "<Rule %d '%s'>" % (self.index, self.text)
+
+    def GetExpression(self, forDirectory, matchAncestors=True):
+        expression = TranslateGlob(self.pattern)
+        if not self.anchored:
+            expression = "(?:.*/)?" + expression
+
+        if not matchAncestors:
+            return expression
+
+        # A rule that matches a directory also matches everything in it.
+        if self.directoryOnly and not forDirectory:
+            return expression + "/.*"
+        return expression + "(?:/.*)?"
+
+
+class RuleMatcher(object):
+    """
+    Finds the last rule, in the order given, which matches a path.  Unless
+    'matchAncestors' is False, a path also matches the rules matching any of
+    the directories it is within.
+    """
+
+    def __init__(self, ruleTexts, matchAncestors=True):
+        self.matchAncestors = matchAncestors
+        self.rules = []
+        for ruleText in ruleTexts:
+            ruleText = ruleText.strip()
+            if not ruleText or ruleText.startswith("#"):
+                continue
+            self.rules.append(Rule(len(self.rules), ruleText))
+
+        # Lookup tables, keyed by (name, directoryOnly).
+        self.names = {}
+        # Lookup tables, keyed by suffix length then (suffix, directoryOnly).
+        self.suffixes = {}
+        expressionRules = []
+
+        for rule in self.rules:
+            if rule.name is not None:
+                self.names[(rule.name, rule.directoryOnly)] = rule.index
+            elif rule.suffix is not None:
+                self.suffixes.setdefault(len(rule.suffix), {})[(rule.suffix, rule.directoryOnly)] = rule.index
+            else:
+                expressionRules.append(rule)
+
+        self.fileExpressions = CompileExpressions(expressionRules, False, matchAncestors)
+        self.directoryExpressions = CompileExpressions(expressionRules, True, matchAncestors)
+
+    def FindLastRule(self, relativePath, isDirectory):
+        if not self.rules:
+            return None
+
+        parts = relativePath.split("/")
+        index = -1
+
+        if self.names or self.suffixes:
+            lastPart = len(parts) - 1
+            if not self.matchAncestors:
+                parts = parts[lastPart:]
+                lastPart = 0
+            for i, part in enumerate(parts):
+                # Only the last part of a file path is not a directory.
+                partIsDirectory = isDirectory or i < lastPart
+                for directoryOnly in (False, True):
+                    if directoryOnly and not partIsDirectory:
+                        continue
+
+                    ruleIndex = self.names.get((part, directoryOnly), -1)
+                    if ruleIndex > index:
+                        index = ruleIndex
+
+                    for suffixLength, suffixes in self.suffixes.iteritems():
+                        if suffixLength <= len(part):
+                            ruleIndex = suffixes.get((part[-suffixLength:], directoryOnly), -1)
+                            if ruleIndex > index:
+                                index = ruleIndex
+
+        if isDirectory:
+            expressions = self.directoryExpressions
+        else:
+            expressions = self.fileExpressions
+
+        # The expressions are ordered so that the first match is the last rule.
+        for expression, groupRules in expressions:
+            if groupRules[0].index < index:
+                break
+            match = expression.match(relativePath)
+            if match is not None:
+                ruleIndex = groupRules[match.lastindex - 1].index
+                if ruleIndex > index:
+                    index = ruleIndex
+                break
+
+        if index == -1:
+            return None
+        return self.rules[index]
+
+    def Matches(self, relativePath, isDirectory):
+        rule = self.FindLastRule(relativePath, isDirectory)
+        return rule is not None and not rule.negated
+
+
+class PathFilter(object):
+    def __init__(self, includeRules=("*.py",), excludeRules=()):
+        self.includeRules = list(includeRules)
+        self.excludeRules = list(excludeRules)
+        self.includeMatcher = None
+        self.excludeMatcher = None
+
+    def AddIncludeRule(self, ruleText):
+        self.includeRules.append(ruleText)
+        self.includeMatcher = None
+
+    def AddExcludeRule(self, ruleText):
+        self.excludeRules.append(ruleText)
+        self.excludeMatcher = None
+
+    def AddExcludeRules(self, text):
+        # Accepts the contents of a '.gitignore' file.
+        for line in text.splitlines():
+            self.AddExcludeRule(line)
+
+    def Compile(self):
+        if self.includeMatcher is None:
+            self.includeMatcher = RuleMatcher(self.includeRules, matchAncestors=False)
+        if self.excludeMatcher is None:
+            self.excludeMatcher = RuleMatcher(self.excludeRules)
+
+    def IsFileIgnored(self, relativePath):
+        if self.includeMatcher is None or self.excludeMatcher is None:
+            self.Compile()
+
+        if not self.includeMatcher.Matches(relativePath, isDirectory=False):
+            return True
+        return self.excludeMatcher.Matches(relativePath, isDirectory=False)
+
+    def IsDirectoryIgnored(self, relativePath):
+        if self.excludeMatcher is None:
+            self.Compile()
+
+        if not relativePath:
+            return False
+        return self.excludeMatcher.Matches(relativePath, isDirectory=True)
+
+
+def ContainsGlob(pattern):
+    for c in GLOB_CHARACTERS:
+        if c in pattern:
+            return True
+    return False
+
+def TranslateGlob(pattern):
+    i, n = 0, len(pattern)
+    expression = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            if pattern[i:i+3] == "**/":
+                expression.append("(?:.*/)?")
+                i += 3
+                continue
+            if pattern[i:i+2] == "**":
+                expression.append(".*")
+                i += 2
+                continue
+            expression.append("[^/]*")
+        elif c == "?":
+            expression.append("[^/]")
+        elif c == "[":
+            j = pattern.find("]", i + 2)
+            if j == -1:
+                expression.append("\\[")
+            else:
+                characters = pattern[i+1:j].replace("\\", "\\\\")
+                if characters[0] == "!":
+                    characters = "^" + characters[1:]
+                expression.append("[" + characters + "]")
+                i = j + 1
+                continue
+        else:
+            expression.append(re.escape(c))
+        i += 1
+    return "".join(expression)
+
+def CompileExpressions(rules, forDirectory, matchAncestors):
+    # Later rules take precedence, so they are tried first.  Each rule gets a
+    # group so that the rule which matched can be identified.
+    rules = list(reversed(rules))
+    expressions = []
+    for i in range(0, len(rules), MAX_GROUPS_PER_EXPRESSION):
+        groupRules = rules[i:i+MAX_GROUPS_PER_EXPRESSION]
+        alternatives = [ "(%s)" % rule.GetExpression(forDirectory, matchAncestors) for rule in groupRules ]
+        expression = re.compile("(?:%s)$" % "|".join(alternatives), re.DOTALL)
+        expressions.append((expression, groupRules))
+    return expressions
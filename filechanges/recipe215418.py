@@ -1,94 +1,499 @@
-"""
-The original version of this script is publically available from the web page
-given below.  It has been modified to suit the needs of the livecoding
-library.  The license of this script is that of the original version.
-
-Author: A.M. Kuchling
-Source: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/215418
-
-From recipe page:
-
-Locking is not taken into account. The watch_directories() function itself
-doesn't really need to do locking; if it misses a modification on one pass,
-it'll notice it on the next pass. However, if jobs are written directly
-into a watched directory, the callable object might start running while a
-job file is only half-written. To solve this, you can use a lockfile; the
-callable must acquire the lock when it runs, and submitters must acquire the
-lock when they wish to add a new job. A simpler approach is to rely on the
-rename() system call being atomic: write the job into a temporary directory
-that isn't being watched, and once the file is complete use os.rename() to
-move it into the submission directory.
-
-To do list:
-
-- Do the locking mentioned above.
-"""
-
-import os, time
-
-def Prepare(handler):
-    # Need to prime this attribute as it is immediately used.
-    handler.watchState = {}
-    # Do a silent first run to gather the contents of each directory
-    # so that we don't trigger an addition event for each file in
-    # them.
-    Check(handler, skipEvents=True)
-
-def Check(handler, skipEvents=False):
-    # Basic principle: watchState is a dictionary mapping paths to
-    # modification times.  We repeatedly crawl through the directory
-    # tree rooted at 'path', doing a stat() on each file and comparing
-    # the modification time.
-
-    def f(data, dirname, files):
-        handler, tldPath = data
-        if not handler.watchState.has_key(tldPath):
-            handler.watchState[tldPath] = {}
-
-        # Traversal function for directories
-        for filename in files:
-            path = os.path.join(dirname, filename)
-
-            if handler.ShouldIgnorePathEntry(path):
-                continue
-
-            try:
-                t = os.stat(path)
-            except os.error:
-                # If a file has been deleted between os.path.walk()
-                # scanning the directory and now, we'll get an
-                # os.error here.  Just ignore it -- we'll report
-                # the deletion on the next pass through the main loop.
-                continue
-
-            mtime = remaining_files.get(path)
-            if mtime is not None:
-                # Record this file as having been seen
-                del remaining_files[path]
-                # File's mtime has been changed since we last looked at it.
-                # NOTE: mtime is to the nearest second..
-                if not skipEvents and t.st_mtime > mtime:
-                    handler.DispatchFileChange(path, changed=True)
-            elif not skipEvents:
-                # No recorded modification time, so it must be a brand new file.
-                handler.DispatchFileChange(path, added=True)
-
-            # Record current mtime of file.
-            handler.watchState[tldPath][path] = t.st_mtime
-
-    # What directories we are managing might have changed.  By doing this we
-    # can drop the results for the old directories.
-    remainingFilesByPath = {}
-    for path in handler.directories:
-        remainingFilesByPath[path] = handler.watchState.get(path, {})
-
-    # Initialise this as it is used later below, and there may be no registered
-    # directories.
-    handler.watchState = {}
-    for path in handler.directories:
-        remaining_files = remainingFilesByPath[path]
-        os.path.walk(path, f, (handler, path))
-
-        if not skipEvents:
-            for path in remaining_files.keys():
-                handler.DispatchFileChange(path, deleted=True)
+"""
+The original version of this script is publically available from the web page
+given below.  It has been modified to suit the needs of the livecoding
+library.  The license of this script is that of the original version.
+
+Author: A.M. Kuchling
+Source: http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/215418
+
+From recipe page:
+
+Locking is not taken into account. The watch_directories() function itself
+doesn't really need to do locking; if it misses a modification on one pass,
+it'll notice it on the next pass. However, if jobs are written directly
+into a watched directory, the callable object might start running while a
+job file is only half-written. To solve this, you can use a lockfile; the
+callable must acquire the lock when it runs, and submitters must acquire the
+lock when they wish to add a new job. A simpler approach is to rely on the
+rename() system call being atomic: write the job into a temporary directory
+that isn't being watched, and once the file is complete use os.rename() to
+move it into the submission directory.
+
+Changes to files which are still being written, or which are locked, can be
+held back until they are finished.  See 'ChangeHandler.settleTime'.
+"""
+
+import os, stat, time
+import collections
+
+import filetable
+
+# Where the directory entry type information is available from a listing,
+# use it rather than stat'ing each entry to find out what it is.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Directories modified less than this many seconds before they were listed
+# may be modified again without their mtime changing, on filesystems with a
+# coarse timestamp resolution.  Their listings are not trusted.
+RACY_MTIME_WINDOW = 1.0
+
+# Detecting changes the original way ('os.path.walk' and 'ShouldIgnorePathEntry')
+# did an 'isdir' for each entry during the walk, and another in the filter.
+OLD_STATS_PER_ENTRY = 2
+
+def Prepare(handler):
+    # Need to prime this attribute as it is immediately used.
+    handler.watchState = {}
+    handler.directoryState = {}
+
+    # Directories with a saved snapshot are not scanned now.  The next check
+    # compares them against the snapshot, reporting what changed while we
+    # were not running.
+    unknownDirectories = []
+    for path in handler.directories:
+        tldState = handler.snapshotState.get(path)
+        if tldState is None:
+            unknownDirectories.append(path)
+        else:
+            handler.watchState[path] = dict(tldState)
+
+    # Do a silent first run to gather the contents of each directory
+    # so that we don't trigger an addition event for each file in
+    # them.
+    Check(handler, skipEvents=True, directories=unknownDirectories)
+
+def GetFileSignature(t):
+    # A file replaced by another can have the same mtime, but is unlikely to
+    # also have the same size and inode.
+    return t.st_mtime, t.st_size, t.st_ino
+
+def AddDirectory(handler, path):
+    # Only the new directory is scanned.  The others keep their state, so
+    # changes to them are still found by the next check.
+    tldState = handler.snapshotState.get(path)
+    if tldState is None:
+        Check(handler, skipEvents=True, directories=[ path ])
+    else:
+        handler.watchState[path] = dict(tldState)
+
+def RemoveDirectory(handler, path):
+    handler.watchState.pop(path, None)
+    PopDirectoryState(handler, [ path ])
+
+def PopDirectoryState(handler, dirPaths):
+    """
+    Remove the cached listings of the given directories, and everything
+    within them, returning them.  Only the directories within are visited,
+    by following the subdirectories recorded in the listings.
+    """
+    directoryState = {}
+    pending = list(dirPaths)
+    while pending:
+        dirPath = pending.pop()
+        entry = handler.directoryState.pop(dirPath, None)
+        if entry is not None:
+            directoryState[dirPath] = entry
+            pending.extend(entry[2])
+    return directoryState
+
+def ListDirectory(handler, dirPath, statistics):
+    """
+    Split the entries of the given directory into the files the handler is
+    interested in, and the subdirectories it does not ignore.  Ignored
+    subdirectories are pruned here, so nothing beneath them is visited.
+
+    Returns '(filePaths, subDirPaths, stats)', where 'stats' holds the stat
+    results of any files that had to be stat'ed to find out what they were.
+    The caller can use these rather than stat'ing the files a second time.
+    """
+    filePaths = []
+    subDirPaths = []
+    stats = {}
+
+    if scandir is not None:
+        for entry in scandir(dirPath):
+            statistics["statsSaved"] += OLD_STATS_PER_ENTRY
+            if entry.is_dir(follow_symlinks=False):
+                if handler.ShouldIgnoreDirectory(entry.path):
+                    statistics["directoriesPruned"] += 1
+                else:
+                    subDirPaths.append(entry.path)
+            elif not handler.ShouldIgnoreFile(entry.path):
+                filePaths.append(entry.path)
+        return filePaths, subDirPaths, stats
+
+    for name in os.listdir(dirPath):
+        path = os.path.join(dirPath, name)
+        try:
+            t = os.lstat(path)
+        except os.error:
+            continue
+
+        statistics["statCalls"] += 1
+        statistics["statsSaved"] += OLD_STATS_PER_ENTRY - 1
+        if stat.S_ISDIR(t.st_mode):
+            if handler.ShouldIgnoreDirectory(path):
+                statistics["directoriesPruned"] += 1
+            else:
+                subDirPaths.append(path)
+        elif not handler.ShouldIgnoreFile(path):
+            filePaths.append(path)
+            # Symbolic links need another stat to find what they refer to.
+            if not stat.S_ISLNK(t.st_mode):
+                stats[path] = t
+    return filePaths, subDirPaths, stats
+
+def ReadDirectory(handler, dirPath, oldDirectoryState, statistics):
+    """
+    Returns '(filePaths, subDirPaths, stats, unchanged)' for the given
+    directory, or None if it could not be read.
+
+    If the handler caches directory listings, a directory whose mtime has not
+    moved since the last scan is not listed again.  Instead the listing from
+    that scan is reused, and 'unchanged' is True.
+    """
+    useCache = handler.cacheDirectoryListings or handler.trustDirectoryMtimes or handler.tieredPolling
+
+    if useCache:
+        try:
+            mtime = os.stat(dirPath).st_mtime
+        except os.error:
+            return None
+
+        statistics["statCalls"] += 1
+        entry = oldDirectoryState.get(dirPath)
+        if entry is not None and entry[0] == mtime:
+            handler.directoryState[dirPath] = entry
+            statistics["listingsSaved"] += 1
+            return entry[1], entry[2], {}, True
+
+    try:
+        filePaths, subDirPaths, stats = ListDirectory(handler, dirPath, statistics)
+    except os.error:
+        return None
+
+    statistics["listings"] += 1
+    if useCache:
+        if time.time() - mtime < RACY_MTIME_WINDOW:
+            mtime = None
+        handler.directoryState[dirPath] = (mtime, filePaths, subDirPaths)
+
+    return filePaths, subDirPaths, stats, False
+
+def Walk(handler, tldPath, oldDirectoryState, statistics=None, throttle=True):
+    """
+    Yield '(dirPath, filePaths, stats, unchanged)' for each directory in the
+    tree rooted at 'tldPath', where 'filePaths' are the entries the handler
+    does not ignore, and 'stats' are any already known stat results for them.
+    """
+    if statistics is None:
+        statistics = handler.statistics
+
+    pending = [ tldPath ]
+    while pending:
+        dirPath = pending.pop()
+        if throttle:
+            handler.ScanStep()
+
+        listing = ReadDirectory(handler, dirPath, oldDirectoryState, statistics)
+        if listing is None:
+            continue
+
+        filePaths, subDirPaths, stats, unchanged = listing
+        yield dirPath, filePaths, stats, unchanged
+        pending.extend(reversed(subDirPaths))
+
+def ScanFiles(handler, filePaths, stats, unchanged, knownFiles, statistics, throttle=True):
+    """
+    Returns '[ (path, signature), ... ]' for the given files of a directory,
+    leaving out any which have gone away.
+
+    Where directory mtimes are trusted, files in a directory that has not
+    changed since the last scan are assumed to be unchanged, and are given the
+    signatures in 'knownFiles'.  This only holds where files are replaced rather
+    than modified in place, as writing to an existing file does not touch its
+    directory.
+    """
+    trusted = unchanged and handler.trustDirectoryMtimes
+    # Files in a directory which has changed may have been replaced, so they
+    # are all checked whatever their tier.
+    tiered = unchanged and handler.tieredPolling
+
+    files = []
+    for path in filePaths:
+        if throttle:
+            handler.ScanStep()
+
+        if trusted:
+            signature = knownFiles.get(path)
+            if signature is not None:
+                files.append((path, signature))
+                statistics["statsSaved"] += 1
+                continue
+
+        if tiered and not IsFileDue(handler, path):
+            signature = knownFiles.get(path)
+            if signature is not None:
+                files.append((path, signature))
+                statistics["statsSaved"] += 1
+                statistics["tieredStatsSaved"] += 1
+                continue
+
+        t = stats.get(path)
+        if t is None:
+            try:
+                t = os.stat(path)
+            except os.error:
+                # If a file has been deleted between listing the
+                # directory and now, we'll get an os.error here.  Just
+                # ignore it -- we'll report the deletion on the next
+                # pass through the main loop.
+                continue
+
+            statistics["statCalls"] += 1
+            # A symbolic link to a directory.
+            if stat.S_ISDIR(t.st_mode):
+                continue
+
+        files.append((path, GetFileSignature(t)))
+    return files
+
+# ----------------------------------------------------------------------------
+# Tiered polling.
+#
+# Only the files which have changed recently are tracked, everything else is
+# in the cold tier.  A file is promoted to the hot tier when it changes, and
+# is demoted as checks go by without it changing again.
+
+def StartTieredCheck(handler, directories):
+    if directories is not handler.directories:
+        # A partial check is done to gather or resynchronise state.
+        handler.warmTierDue = handler.coldTierDue = True
+        return
+
+    handler.tieredCheckCount += 1
+    checkCount = handler.tieredCheckCount
+    for path, lastCheckCount in handler.fileActivity.items():
+        if checkCount - lastCheckCount >= handler.coldCheckCount:
+            del handler.fileActivity[path]
+
+    handler.warmTierDue = checkCount % handler.warmCheckInterval == 0
+    handler.coldTierDue = checkCount % handler.coldCheckInterval == 0
+
+    statistics = handler.statistics
+    statistics["hotTierChecks"] += 1
+    if handler.warmTierDue:
+        statistics["warmTierChecks"] += 1
+    if handler.coldTierDue:
+        statistics["coldTierChecks"] += 1
+
+def IsFileDue(handler, path):
+    lastCheckCount = handler.fileActivity.get(path)
+    if lastCheckCount is None:
+        return handler.coldTierDue
+    if handler.tieredCheckCount - lastCheckCount < handler.hotCheckCount:
+        return True
+    return handler.warmTierDue
+
+def PromoteFile(handler, path):
+    if handler.tieredPolling:
+        handler.fileActivity[path] = handler.tieredCheckCount
+
+def ScanTree(handler, dirPath, oldDirectoryState, knownFiles, statistics, throttle=True):
+    files = []
+    for dirPath, filePaths, stats, unchanged in Walk(handler, dirPath, oldDirectoryState, statistics, throttle):
+        files.extend(ScanFiles(handler, filePaths, stats, unchanged, knownFiles, statistics, throttle))
+    return files
+
+# ----------------------------------------------------------------------------
+# Parallel scanning.
+#
+# On network filesystems in particular, the time taken to scan is dominated by
+# waiting for stat calls to complete.  Splitting the directory trees into
+# shards which are scanned on separate threads, allows these waits to overlap.
+
+# Aim for this many shards per thread, so that a few large shards do not
+# leave the other threads idle.
+SHARDS_PER_THREAD = 4
+# How many levels below a registered directory will be split into shards.
+MAX_SHARD_DEPTH = 3
+
+_threadPools = {}
+
+def GetThreadPool(threadCount):
+    # Pools are shared by all handlers wanting the same number of threads.
+    pool = _threadPools.get(threadCount)
+    if pool is None:
+        from multiprocessing.pool import ThreadPool
+        pool = _threadPools[threadCount] = ThreadPool(threadCount)
+    return pool
+
+def ScanInParallel(handler, directories, oldDirectoryState, knownFilesByPath):
+    """
+    Returns a dictionary mapping each of the given directories to the scanned
+    '(path, signature)' entries for the files within it.  The order of entries is
+    determined by the directory layout alone, whatever order the shards
+    complete in.
+    """
+    statistics = handler.statistics
+    shardTarget = handler.scanThreads * SHARDS_PER_THREAD
+
+    filesByPath = {}
+    shards = []
+    for tldPath in directories:
+        knownFiles = knownFilesByPath[tldPath]
+        files = filesByPath[tldPath] = []
+
+        # Split the tree breadth first until there are enough shards.  The
+        # files within the directories which are split are scanned here.
+        level = [ tldPath ]
+        depth = 0
+        while level:
+            nextLevel = []
+            for dirPath in level:
+                listing = ReadDirectory(handler, dirPath, oldDirectoryState, statistics)
+                if listing is None:
+                    continue
+                filePaths, subDirPaths, stats, unchanged = listing
+                files.extend(ScanFiles(handler, filePaths, stats, unchanged, knownFiles, statistics))
+                nextLevel.extend(sorted(subDirPaths))
+
+            depth += 1
+            if len(nextLevel) >= shardTarget or depth >= MAX_SHARD_DEPTH:
+                shards.extend((tldPath, dirPath) for dirPath in nextLevel)
+                break
+            level = nextLevel
+
+    def ScanShard(shard):
+        tldPath, dirPath = shard
+        shardStatistics = collections.defaultdict(int)
+        startTime = time.time()
+        files = ScanTree(handler, dirPath, oldDirectoryState, knownFilesByPath[tldPath], shardStatistics, throttle=False)
+        return files, shardStatistics, time.time() - startTime
+
+    results = GetThreadPool(handler.scanThreads).map(ScanShard, shards)
+
+    handler.shardTimings = []
+    for (tldPath, dirPath), (files, shardStatistics, elapsedTime) in zip(shards, results):
+        filesByPath[tldPath].extend(files)
+        for k, v in shardStatistics.iteritems():
+            statistics[k] += v
+        handler.shardTimings.append((dirPath, len(files), elapsedTime))
+    statistics["shardsScanned"] += len(shards)
+
+    return filesByPath
+
+# ----------------------------------------------------------------------------
+
+def Check(handler, skipEvents=False, directories=None):
+    for directoryCount in IterateCheck(handler, skipEvents, directories):
+        pass
+
+def IterateCheck(handler, skipEvents=False, directories=None):
+    """
+    Does a check in steps, so that it can be spread out over time.  After
+    each directory is scanned, the number scanned so far is yielded.  The
+    watched state is only updated, and events dispatched, in the final step.
+    """
+    # Basic principle: watchState is a dictionary mapping paths to
+    # file signatures.  We repeatedly crawl through the directory
+    # tree rooted at 'path', doing a stat() on each file and comparing
+    # the signature.  Only the given registered directories are scanned,
+    # the recorded state of the others is kept as it is.
+    if directories is None:
+        directories = handler.directories
+
+    # What directories we are managing might have changed.  By doing this we
+    # can drop the results for the old directories.
+    remainingFilesByPath = {}
+    for path in directories:
+        remainingFilesByPath[path] = handler.watchState.get(path, {})
+
+    if directories is handler.directories or handler.directoryState is None:
+        oldDirectoryState = handler.directoryState or {}
+        handler.directoryState = {}
+    else:
+        # Only the cached listings for the scanned directories are replaced.
+        oldDirectoryState = PopDirectoryState(handler, directories)
+
+    if handler.tieredPolling:
+        StartTieredCheck(handler, directories)
+
+    if handler.scanThreads > 1:
+        filesByPath = ScanInParallel(handler, directories, oldDirectoryState, remainingFilesByPath)
+    else:
+        filesByPath = {}
+        directoryCount = 0
+        for tldPath in directories:
+            knownFiles = remainingFilesByPath[tldPath]
+            files = filesByPath[tldPath] = []
+            for dirPath, filePaths, stats, unchanged in Walk(handler, tldPath, oldDirectoryState):
+                files.extend(ScanFiles(handler, filePaths, stats, unchanged, knownFiles, handler.statistics))
+                directoryCount += 1
+                yield directoryCount
+
+    # Initialise this as it is used later below, and there may be no registered
+    # directories.
+    watchState = {}
+    for tldPath in handler.directories:
+        if tldPath not in remainingFilesByPath and tldPath in handler.watchState:
+            watchState[tldPath] = handler.watchState[tldPath]
+    handler.watchState = watchState
+
+    for tldPath in directories:
+        if handler.compactWatchState:
+            CompareTable(handler, tldPath, remainingFilesByPath[tldPath], filesByPath[tldPath], skipEvents)
+            continue
+
+        remaining_files = remainingFilesByPath[tldPath]
+        tldState = handler.watchState[tldPath] = {}
+
+        for path, signature in filesByPath[tldPath]:
+            oldSignature = remaining_files.get(path)
+            if oldSignature is not None:
+                # Record this file as having been seen
+                del remaining_files[path]
+                # File's mtime, size or identity has been changed since we
+                # last looked at it.
+                # NOTE: mtime is to the nearest second..
+                if not skipEvents and signature != oldSignature:
+                    handler.DispatchFileChange(path, changed=True)
+                    PromoteFile(handler, path)
+            elif not skipEvents:
+                # No recorded modification time, so it must be a brand new file.
+                handler.DispatchFileChange(path, added=True)
+                PromoteFile(handler, path)
+
+            # Record current signature of file.
+            tldState[path] = signature
+
+        if not skipEvents:
+            for path in remaining_files.keys():
+                handler.DispatchFileChange(path, deleted=True)
+            # Any snapshot of this directory has now been accounted for.
+            handler.snapshotState.pop(tldPath, None)
+
+def CompareTable(handler, tldPath, oldState, files, skipEvents=False):
+    # The files are compared in bulk, rather than one at a time.
+    tldState = handler.watchState[tldPath] = filetable.FileTable(files)
+    if skipEvents:
+        return
+
+    if not isinstance(oldState, filetable.FileTable):
+        oldState = filetable.FileTable(oldState.iteritems())
+    added, changed, deleted = tldState.Compare(oldState)
+    for path in changed:
+        handler.DispatchFileChange(path, changed=True)
+        PromoteFile(handler, path)
+    for path in added:
+        handler.DispatchFileChange(path, added=True)
+        PromoteFile(handler, path)
+    for path in deleted:
+        handler.DispatchFileChange(path, deleted=True)
+    handler.snapshotState.pop(tldPath, None)
@@ -0,0 +1,334 @@
+"""
+A process wide service which scans each watched directory once, however many
+change handlers are interested in it.
+
+Each 'ChangeHandler' normally scans its directories on a thread of its own.
+A process with several code reloaders watching the same directories would
+have each of them scanning the same files.  'SharedChangeHandler' instead
+subscribes its directories to the registry, which keeps one scan for each
+distinct directory and filter rules, and passes the events that scan
+produces on to every subscriber.
+
+The scans are done on the registry's thread, scheduled on a timing wheel.
+Each directory is checked as often as the most demanding of its subscribers
+asks for, using their 'delay'.  The events are delivered to each subscriber
+separately, so that each coalesces or batches them as it was told to.  The
+callbacks are called on the registry's dispatching thread, without the
+registry's lock held.
+
+    handler = SharedChangeHandler(callback, delay=0.5)
+    handler.AddDirectory(path)
+"""
+
+import os, time, threading, weakref, logging, Queue
+
+import filechanges
+import scheduling
+
+logger = logging.getLogger("reloader")
+
+_registry = None
+_registryLock = threading.Lock()
+
+def GetRegistry():
+    global _registry
+    _registryLock.acquire()
+    try:
+        if _registry is None:
+            _registry = WatcherRegistry()
+        return _registry
+    finally:
+        _registryLock.release()
+
+
+class SharedWatch(object):
+    """
+    A directory scanned on behalf of all the subscribers which registered it
+    with the same filter rules.
+    """
+
+    def __init__(self, registry, key, pathFilter):
+        self.key = key
+        # The normalised path, subscribers may each have registered another
+        # form of it.
+        self.path = key[0]
+        # Subscribers are not kept alive by their subscriptions.  Watches left
+        # without any are dropped by the registry when next due.
+        self.subscribers = weakref.WeakKeyDictionary()
+        self.checkCount = 0
+
+        self.handler = registry.handlerClass(self.DispatchFileChange, useThread=False)
+        self.handler.AddDirectory(self.path, pathFilter=pathFilter)
+
+    def __repr__(self):
+        return "<SharedWatch '%s' subscribers=%d>" % (self.path, len(self.subscribers))
+
+    def DispatchFileChange(self, filePath, added=False, changed=False, deleted=False):
+        # Each subscriber is given the path under the form it registered.
+        relativePath = filePath[len(self.path):].lstrip(os.path.sep)
+        for subscriber, path in self.subscribers.items():
+            subscriber.DispatchFileChange(os.path.join(path, relativePath), added=added, changed=changed, deleted=deleted)
+
+    def GetDelay(self):
+        delays = [ subscriber.delay for subscriber in self.subscribers.keys() ]
+        if not delays:
+            return None
+        return min(delays)
+
+    def Check(self):
+        self.handler.ProcessFileEvents()
+        self.checkCount += 1
+
+
+class WatcherRegistry(object):
+    # The class used to scan each distinct directory.
+    handlerClass = filechanges.ChangeHandler
+    # The granularity and size of the timing wheel scans are scheduled on.
+    tickDuration = 0.05
+    slotCount = 512
+    # The longest the thread sleeps when there is nothing to do.
+    idleDelay = 10.0
+    # The size of the queue the callbacks are passed to the dispatching
+    # thread through.  Scanning only waits for the callbacks when it is full.
+    dispatchQueueSize = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkCondition = threading.Condition(self.lock)
+        self.wakeEvent = threading.Event()
+
+        self.watches = {}
+        self.wheel = scheduling.TimingWheel(self.tickDuration, self.slotCount)
+        self.thread = None
+        self.dispatchQueue = Queue.Queue(self.dispatchQueueSize)
+        self.dispatchThread = None
+        self.statistics = {
+            "watchesChecked": 0,
+        }
+
+    def GetWatchKey(self, path, pathFilter):
+        path = os.path.normcase(os.path.abspath(path))
+        return path, tuple(pathFilter.includeRules), tuple(pathFilter.excludeRules)
+
+    def Subscribe(self, subscriber, path, pathFilter):
+        key = self.GetWatchKey(path, pathFilter)
+
+        self.lock.acquire()
+        try:
+            watch = self.watches.get(key)
+            if watch is None:
+                watch = self.watches[key] = SharedWatch(self, key, pathFilter)
+
+            # A new subscriber may want the directory checked sooner.
+            previousDelay = watch.GetDelay()
+            watch.subscribers[subscriber] = path
+            if previousDelay is None or subscriber.delay < previousDelay:
+                self.wheel.Schedule(watch, subscriber.delay)
+            if self.thread is None:
+                self.dispatchThread = threading.Thread(target=self.RunDispatch, name="WatcherRegistryDispatch")
+                self.dispatchThread.setDaemon(1)
+                self.dispatchThread.start()
+                self.thread = threading.Thread(target=self.run, name="WatcherRegistry")
+                self.thread.setDaemon(1)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+        self.wakeEvent.set()
+        return watch
+
+    def Unsubscribe(self, subscriber, watch):
+        self.lock.acquire()
+        try:
+            watch.subscribers.pop(subscriber, None)
+            if not watch.subscribers:
+                self.RemoveWatch(watch)
+        finally:
+            self.lock.release()
+
+    def RemoveWatch(self, watch):
+        self.wheel.Cancel(watch)
+        if self.watches.get(watch.key) is watch:
+            del self.watches[watch.key]
+
+    def CheckWatches(self, watches):
+        # The lock must be held by the caller.
+        subscribers = set()
+        for watch in watches:
+            if not watch.subscribers:
+                self.RemoveWatch(watch)
+                continue
+
+            watch.Check()
+            self.statistics["watchesChecked"] += 1
+            subscribers.update(watch.subscribers.keys())
+            self.wheel.Schedule(watch, watch.GetDelay())
+
+        for subscriber in subscribers:
+            subscriber.DispatchFinishedWrites()
+        return subscribers
+
+    def TakeDispatches(self, subscribers, checkedSubscribers):
+        # The lock must be held by the caller.  The checks are complete once
+        # the dispatching thread gets past the callbacks they led to.
+        entries = []
+        for subscriber in subscribers:
+            entries.extend(subscriber.dispatchBuffer)
+            subscriber.dispatchBuffer = []
+        for subscriber in checkedSubscribers:
+            entries.append((self.CompleteCheck, (subscriber,)))
+        return entries
+
+    def QueueDispatches(self, entries):
+        # Called without the lock held, so that waiting for room in the queue
+        # does not hold up subscriptions.
+        for entry in entries:
+            self.dispatchQueue.put(entry)
+
+    def QueueCall(self, function, args=()):
+        self.dispatchQueue.put((function, args))
+
+    def RunDispatch(self):
+        while True:
+            function, args = self.dispatchQueue.get()
+            try:
+                function(*args)
+            except Exception:
+                logger.exception("Problem executing queued call")
+
+    def CompleteCheck(self, subscriber):
+        self.lock.acquire()
+        try:
+            subscriber.checkCount += 1
+            self.checkCondition.notifyAll()
+        finally:
+            self.lock.release()
+
+    def ScanNow(self, subscriber, force=True):
+        if threading.currentThread() is self.dispatchThread:
+            raise RuntimeError("Unable to wait for a check from the dispatching thread")
+
+        self.lock.acquire()
+        try:
+            subscribers = self.CheckWatches(subscriber.watches.values())
+            subscriber.DispatchCoalescedFileChanges(force=force)
+            subscribers.add(subscriber)
+            entries = self.TakeDispatches(subscribers, subscribers)
+        finally:
+            self.lock.release()
+
+        # The callbacks have been called by the time this returns.
+        if self.dispatchThread is None:
+            for function, args in entries:
+                function(*args)
+            return
+
+        dispatchedEvent = threading.Event()
+        self.QueueDispatches(entries + [ (dispatchedEvent.set, ()) ])
+        dispatchedEvent.wait()
+
+    def WaitForCheck(self, subscriber, timeout=None):
+        if threading.currentThread() in (self.thread, self.dispatchThread):
+            raise RuntimeError("Unable to wait for a check from the registry thread")
+
+        startTime = time.time()
+        self.lock.acquire()
+        try:
+            checkCount = subscriber.checkCount + 1
+            while subscriber.checkCount < checkCount:
+                if timeout is None:
+                    self.checkCondition.wait()
+                else:
+                    remainingTime = startTime + timeout - time.time()
+                    if remainingTime <= 0:
+                        return None
+                    self.checkCondition.wait(remainingTime)
+        finally:
+            self.lock.release()
+
+        return time.time() - startTime
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                self.wakeEvent.clear()
+                subscribers = self.CheckWatches(self.wheel.Advance())
+
+                # Coalesced events are dispatched after a quiet period, which
+                # can end between scans.
+                delay = self.wheel.GetNextDelay()
+                if delay is None:
+                    delay = self.idleDelay
+                allSubscribers = set(subscribers)
+                for watch in self.watches.values():
+                    for subscriber in watch.subscribers.keys():
+                        allSubscribers.add(subscriber)
+                        if subscriber.pendingChanges:
+                            subscriber.DispatchCoalescedFileChanges()
+                            if subscriber.pendingChanges:
+                                delay = min(delay, subscriber.coalesceDelay)
+
+                entries = self.TakeDispatches(allSubscribers, subscribers)
+            finally:
+                self.lock.release()
+
+            self.QueueDispatches(entries)
+            self.wakeEvent.wait(delay)
+
+
+class SharedChangeHandler(filechanges.ChangeHandler):
+    """
+    A change handler whose directories are scanned by the registry rather than
+    by itself.  It always behaves as if it was given a thread, with events
+    being dispatched from the registry's thread.
+    """
+
+    # Nothing is scanned by the handler itself, so it should not set up any
+    # native monitoring.  The registry decides how its scans are done.
+    useNativeMonitoring = False
+
+    def __init__(self, callback, delay=None, useThread=True, batchCallback=None, coalesceDelay=None, snapshotPath=None, settleTime=None, registry=None):
+        if snapshotPath is not None:
+            raise ValueError("Shared change handlers do not support snapshots")
+
+        filechanges.ChangeHandler.__init__(self, callback, delay, False, batchCallback, coalesceDelay, settleTime=settleTime)
+        if registry is None:
+            registry = GetRegistry()
+        self.registry = registry
+        self.watches = {}
+        self.checkCount = 0
+        # The callbacks are collected while the registry holds its lock, and
+        # called by its dispatching thread once it has released it.
+        self.dispatchBuffer = []
+
+    def AddDirectory(self, path, pathFilter=None):
+        if pathFilter is None:
+            pathFilter = self.defaultPathFilter
+        pathFilter.Compile()
+
+        self.directories.append(path)
+        self.pathFilters[path] = pathFilter
+        self.watches[path] = self.registry.Subscribe(self, path, pathFilter)
+
+    def RemoveDirectory(self, path):
+        self.directories.remove(path)
+        del self.pathFilters[path]
+        self.registry.Unsubscribe(self, self.watches.pop(path))
+
+    def QueueCall(self, function, args=()):
+        # The callbacks are called by the registry's dispatching thread.
+        self.registry.QueueCall(function, args)
+
+    def ProcessFileEvents(self, timeBudget=None):
+        # The scanning is shared, so there is no budgeting it.
+        self.registry.ScanNow(self, force=False)
+        return False
+
+    def ScanNow(self, timeout=None):
+        # This is done on the calling thread, so there is nothing to time out.
+        self.registry.ScanNow(self)
+        return True
+
+    def WaitForNextMonitoringCheck(self, maxDelay=10.0, checkDelay=None):
+        return self.registry.WaitForCheck(self, maxDelay)
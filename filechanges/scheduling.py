@@ -0,0 +1,145 @@
+"""
+Decides when change detection should next be done, and how much time the
+detection itself is allowed to take up.
+"""
+
+import math, time
+
+
+class AdaptiveDelay(object):
+    """
+    The delay between checks drops to the minimum as soon as a change is seen,
+    on the basis that more changes are likely to follow.  While nothing
+    changes it grows by the given factor with each check, up to the maximum.
+    """
+
+    def __init__(self, delay, minimumDelay, maximumDelay, factor=2.0):
+        self.minimumDelay = minimumDelay
+        self.maximumDelay = maximumDelay
+        self.factor = factor
+        self.delay = min(max(delay, minimumDelay), maximumDelay)
+
+    def Update(self, activity):
+        if activity:
+            self.delay = self.minimumDelay
+        else:
+            self.delay = min(self.delay * self.factor, self.maximumDelay)
+        return self.delay
+
+
+class ScanBudget(object):
+    """
+    Limits the time spent scanning to a fraction of the elapsed time.  The
+    scanner calls 'Step' as it goes, and every 'chunkSize' steps, sleeps for
+    long enough that the time spent on the chunk stays within the budget.
+    Sleeping also lets other threads have the GIL, rather than having them
+    wait for the whole scan to complete.  'Finish' is called at the end of
+    the scan, for the chunk it ended part way through.
+
+    The sleeping is done by 'sleepFunction' if given, so that the scanner can
+    release any locks it holds for the duration.
+    """
+
+    def __init__(self, fraction, chunkSize=256, statistics=None, sleepFunction=None):
+        self.fraction = fraction
+        self.chunkSize = chunkSize
+        self.statistics = statistics
+        self.sleepFunction = sleepFunction
+        self.Reset()
+
+    def Reset(self):
+        self.steps = 0
+        self.chunkStartTime = time.time()
+
+    def Step(self, count=1):
+        self.steps += count
+        if self.steps >= self.chunkSize:
+            self.Sleep()
+
+    def Finish(self):
+        # Otherwise a tree smaller than a chunk would never be throttled.
+        if self.steps:
+            self.Sleep()
+
+    def Sleep(self):
+        busyTime = time.time() - self.chunkStartTime
+        sleepTime = busyTime * (1.0 - self.fraction) / self.fraction
+        if sleepTime > 0:
+            if self.sleepFunction is None:
+                time.sleep(sleepTime)
+            else:
+                self.sleepFunction(sleepTime)
+            if self.statistics is not None:
+                self.statistics["scanThrottleSleeps"] += 1
+                self.statistics["scanThrottleTime"] += sleepTime
+        self.Reset()
+
+
+class TimingWheel(object):
+    """
+    Keeps track of when each of a set of items is next due.  Time is divided
+    into ticks, and each item is kept in the slot for the tick it is due on,
+    modulo the number of slots.  Scheduling and cancelling are constant time,
+    and advancing the wheel only examines the slots of the ticks that passed,
+    however many items are scheduled.
+    """
+
+    def __init__(self, tickDuration=0.05, slotCount=512, startTime=None):
+        if startTime is None:
+            startTime = time.time()
+        self.tickDuration = tickDuration
+        self.slotCount = slotCount
+        self.slots = [ {} for i in range(slotCount) ]
+        self.ticksByItem = {}
+        self.currentTick = int(startTime / tickDuration)
+
+    def __len__(self):
+        return len(self.ticksByItem)
+
+    def __contains__(self, item):
+        return item in self.ticksByItem
+
+    def Schedule(self, item, delay, now=None):
+        if now is None:
+            now = time.time()
+
+        self.Cancel(item)
+        # Nothing can be due on a tick that has already been processed.
+        tick = max(int(math.ceil((now + delay) / self.tickDuration)), self.currentTick + 1)
+        self.slots[tick % self.slotCount][item] = tick
+        self.ticksByItem[item] = tick
+
+    def Cancel(self, item):
+        tick = self.ticksByItem.pop(item, None)
+        if tick is not None:
+            del self.slots[tick % self.slotCount][item]
+
+    def Advance(self, now=None):
+        """
+        Returns the items which have become due, in the order they fell due.
+        """
+        if now is None:
+            now = time.time()
+
+        tick = int(now / self.tickDuration)
+        entries = []
+        # Each slot only needs to be examined once, however long it has been.
+        for i in range(min(tick - self.currentTick, self.slotCount)):
+            slot = self.slots[(self.currentTick + 1 + i) % self.slotCount]
+            for item, itemTick in slot.items():
+                if itemTick <= tick:
+                    del slot[item]
+                    del self.ticksByItem[item]
+                    entries.append((itemTick, len(entries), item))
+        self.currentTick = max(tick, self.currentTick)
+
+        entries.sort()
+        return [ item for (itemTick, index, item) in entries ]
+
+    def GetNextDelay(self, now=None):
+        # Returns None if nothing is scheduled.
+        if not self.ticksByItem:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0.0, min(self.ticksByItem.itervalues()) * self.tickDuration - now)
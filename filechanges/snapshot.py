@@ -0,0 +1,41 @@
+"""
+Saves the watched state of a change handler to disk, so that a later process
+can pick up where it left off.  Rather than silently taking the current state
+of each directory as its starting point, the new process compares it against
+the snapshot and reports anything that changed while nothing was watching.
+
+For each file the snapshot holds its mtime, size and inode, with paths stored
+relative to their registered directory.  It is written with 'marshal', which
+is compact and quick to read back, and replaces any earlier snapshot in a
+single rename, see 'datafile'.
+"""
+
+import os
+
+import datafile
+
+# The layout of the saved watched state, see 'datafile'.
+SNAPSHOT_VERSION = 1
+
+
+def Save(filePath, watchState):
+    data = {}
+    for tldPath, tldState in watchState.iteritems():
+        prefixLength = len(os.path.join(tldPath, ""))
+        data[tldPath] = dict((path[prefixLength:], signature) for (path, signature) in tldState.iteritems())
+    datafile.Save(filePath, SNAPSHOT_VERSION, (data,))
+
+def Load(filePath):
+    """
+    Returns the watched state saved in the given snapshot, or an empty
+    dictionary if there is no usable snapshot.
+    """
+    values = datafile.Load(filePath, SNAPSHOT_VERSION, "file change snapshot")
+    if values is None:
+        return {}
+
+    data, = values
+    watchState = {}
+    for tldPath, tldData in data.iteritems():
+        watchState[tldPath] = dict((os.path.join(tldPath, relativePath), tuple(signature)) for (relativePath, signature) in tldData.iteritems())
+    return watchState
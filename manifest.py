@@ -0,0 +1,41 @@
+"""
+Records the order in which the scripts in a script directory ran when it
+was last loaded, so that a later process can run them in the same order
+rather than working it out again ('ScriptDirectory.manifestPath').
+
+For each script the manifest holds its path relative to the script
+directory and the fingerprint of its compiled code, see
+'namespace.GetCodeFingerprint'.  Scripts whose code no longer matches are
+not run from the manifest, but ordered as if there were none.  It is written
+with 'marshal', and replaces any earlier manifest in a single rename, see
+'filechanges.datafile'.
+"""
+
+import logging
+
+from filechanges import datafile
+
+logger = logging.getLogger("reloader")
+
+# The layout of the saved entries, see 'filechanges.datafile'.
+MANIFEST_VERSION = 1
+
+
+def Save(filePath, baseNamespaceName, entries):
+    # The entries are '(relativePath, codeHash)' in the order the scripts ran.
+    datafile.Save(filePath, MANIFEST_VERSION, (baseNamespaceName, entries))
+
+def Load(filePath, baseNamespaceName):
+    """
+    Returns the entries saved in the given manifest, or an empty list if
+    there is no usable manifest for the namespace.
+    """
+    values = datafile.Load(filePath, MANIFEST_VERSION, "load order manifest")
+    if values is None:
+        return []
+
+    manifestNamespaceName, entries = values
+    if manifestNamespaceName != baseNamespaceName:
+        logger.info("Ignoring load order manifest '%s' for another namespace", filePath)
+        return []
+    return entries
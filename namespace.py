@@ -9,21 +9,114 @@
 import os
 import sys
 import imp
+import hashlib
+import marshal
+import multiprocessing
 import traceback
 import types
 import logging
 import unittest
 
+import codecache
+import dependencies
+import manifest
+from filechanges import pathfilter
+
 logger = logging.getLogger("namespace")
 #logger.setLevel(logging.DEBUG)
 
+def GetSourceFingerprint(script):
+    return hashlib.sha1(script).hexdigest()
+
+def GetCodeFingerprint(codeObject):
+    """
+    A hash of what a code object does, leaving out where it came from.  The
+    line numbers and file name are not included, so a script which only had
+    comments or blank lines changed has the same fingerprint.
+    """
+    h = hashlib.sha1()
+    AddCodeToFingerprint(h, codeObject)
+    return h.hexdigest()
+
+def AddCodeToFingerprint(h, codeObject):
+    h.update(repr((codeObject.co_name, codeObject.co_argcount, codeObject.co_nlocals, codeObject.co_flags,
+        codeObject.co_names, codeObject.co_varnames, codeObject.co_freevars, codeObject.co_cellvars, len(codeObject.co_code))))
+    h.update(codeObject.co_code)
+    for value in codeObject.co_consts:
+        if isinstance(value, types.CodeType):
+            AddCodeToFingerprint(h, value)
+        else:
+            h.update(repr((type(value), value)))
+
+def MapCodeObjects(oldCodeObject, newCodeObject, codeObjects):
+    # The two code objects have the same fingerprint, so their nested code
+    # objects correspond one to one.
+    codeObjects[id(oldCodeObject)] = newCodeObject
+    for oldValue, newValue in zip(oldCodeObject.co_consts, newCodeObject.co_consts):
+        if isinstance(oldValue, types.CodeType):
+            MapCodeObjects(oldValue, newValue, codeObjects)
+
+def GetFunctions(value, seen):
+    # The functions defined directly by a script, or within its classes.
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+
+    if isinstance(value, types.FunctionType):
+        yield value
+    elif isinstance(value, (staticmethod, classmethod)):
+        yield value.__func__
+    elif isinstance(value, property):
+        for function in (value.fget, value.fset, value.fdel):
+            if function is not None:
+                yield function
+    elif isinstance(value, (types.ClassType, types.TypeType)):
+        for attributeValue in value.__dict__.values():
+            for function in GetFunctions(attributeValue, seen):
+                yield function
+
+
+_workerCodeCaches = {}
+
+def CompileScript(task):
+    """
+    Compile a script in a worker process, see 'ScriptDirectory.CompileScripts'.
+    Returns the path, the marshalled code and fingerprints or None if the
+    script did not compile, and the code cache statistics for the script.
+    """
+    scriptFileClass, filePath, codeCacheArgs = task
+
+    codeCache = None
+    if codeCacheArgs is not None:
+        codeCache = _workerCodeCaches.get(codeCacheArgs)
+        if codeCache is None:
+            codeCache = _workerCodeCaches[codeCacheArgs] = codecache.CodeCache(*codeCacheArgs)
+        codeCache.statistics.clear()
+
+    try:
+        scriptFile = scriptFileClass(filePath, None, codeCache=codeCache)
+        compiled = marshal.dumps(scriptFile.codeObject), scriptFile.sourceHash, scriptFile.codeHash
+    except Exception:
+        compiled = None
+
+    cacheStatistics = {}
+    if codeCache is not None:
+        cacheStatistics = dict(codeCache.statistics)
+    return filePath, compiled, cacheStatistics
+
+
 class ScriptFile(object):
     lastError = None
     namespaceContributions = None
+    # Fingerprints of the source and the compiled code, see 'Load'.
+    sourceHash = None
+    codeHash = None
 
-    def __init__(self, filePath, namespacePath, implicitLoad=True, delGlobals=False):
+    def __init__(self, filePath, namespacePath, implicitLoad=True, delGlobals=False, codeCache=None):
         self.filePath = filePath
         self.namespacePath = namespacePath
+        # Where compiled code is kept between loads, see 'codecache'.
+        self.codeCache = codeCache
 
         self.scriptGlobals = {}
         self.delGlobals = delGlobals
@@ -42,8 +135,69 @@ class ScriptFile(object):
     def Load(self, filePath):
         self.filePath = filePath
 
-        script = open(self.filePath, 'rU').read() +"\n"
+        if self.codeCache is not None:
+            t = os.stat(self.filePath)
+        script = self.ReadScript()
+        self.sourceHash = GetSourceFingerprint(script)
+
+        if self.codeCache is not None:
+            entry = self.codeCache.Get(self.filePath, t.st_size, codecache.GetModificationTime(t), self.sourceHash)
+            if entry is not None:
+                self.codeObject, self.codeHash = entry
+                return
+
         self.codeObject = compile(script, self.filePath, "exec")
+        self.codeHash = GetCodeFingerprint(self.codeObject)
+
+        if self.codeCache is not None:
+            self.codeCache.Put(self.filePath, t.st_size, codecache.GetModificationTime(t), self.sourceHash, self.codeObject, self.codeHash)
+
+    def LoadCode(self, filePath, codeObject, sourceHash, codeHash):
+        # Use code which was compiled elsewhere, see 'bundle'.
+        self.filePath = filePath
+        self.codeObject = codeObject
+        self.sourceHash = sourceHash
+        self.codeHash = codeHash
+
+    def ReadScript(self):
+        return open(self.filePath, 'rU').read() +"\n"
+
+    def IsSourceUnchanged(self):
+        # Whether the file still holds the source this was compiled from.
+        try:
+            script = self.ReadScript()
+        except IOError:
+            return False
+        return GetSourceFingerprint(script) == self.sourceHash
+
+    def IsCodeEquivalent(self, scriptFile):
+        # Whether running either would have the same result.
+        return self.codeHash is not None and self.codeHash == scriptFile.codeHash
+
+    def SetCode(self, scriptFile):
+        # This now stands for the contents of the given script file.
+        self.codeObject = scriptFile.codeObject
+        self.sourceHash = scriptFile.sourceHash
+        self.codeHash = scriptFile.codeHash
+
+    def UpdateLineNumbers(self, scriptFile):
+        """
+        Take the code from the given script file, which is equivalent to the
+        code this was run from, but may have moved to different lines.  The
+        functions defined when this was run are given the new code objects,
+        so that tracebacks refer to the right lines.
+        """
+        codeObjects = {}
+        MapCodeObjects(self.codeObject, scriptFile.codeObject, codeObjects)
+
+        seen = set()
+        for value in self.scriptGlobals.values():
+            for function in GetFunctions(value, seen):
+                codeObject = codeObjects.get(id(function.func_code))
+                if codeObject is not None:
+                    function.func_code = codeObject
+
+        self.SetCode(scriptFile)
 
     def GetAttributeValue(self, attributeName):
         return self.scriptGlobals[attributeName]
@@ -74,7 +228,7 @@ class ScriptFile(object):
         testFileExists = os.path.exists(testScriptPath)
 
         # Create a throwaway script file object for the unit test script.
-        scriptFile = self.__class__(testScriptPath, None, implicitLoad=testFileExists)
+        scriptFile = self.__class__(testScriptPath, None, implicitLoad=testFileExists, codeCache=self.codeCache)
         if testFileExists:
             scriptFile.Run()
 
@@ -159,8 +313,19 @@ class ScriptDirectory(object):
 
     unitTest = True
     dependencyResolutionPasses = 10
-
-    def __init__(self, baseDirPath=None, baseNamespace=None, delScriptGlobals=False):
+    # Whether scripts are first run in the order worked out from what they
+    # use from each other, see 'dependencies'.
+    dependencyOrdering = True
+    # How many worker processes to compile scripts in when loading, if more
+    # than one script is found.  By default they are compiled in this process.
+    compileProcesses = None
+
+    # Which files under the base directory are scripts.  See 'filechanges.pathfilter'.
+    pathFilterClass = pathfilter.PathFilter
+    includeRules = ( "*.py", )
+    excludeRules = ( ".svn/", ".git/", "node_modules/", "*_unittest.py" )
+
+    def __init__(self, baseDirPath=None, baseNamespace=None, delScriptGlobals=False, codeCache=None, manifestPath=None):
         # Script file objects indexed in different ways.
         self.filesByPath = {}
         self.filesByDirectory = {}
@@ -171,6 +336,15 @@ class ScriptDirectory(object):
         self.classCreationCallback = None
         self.validateScriptCallback = None
         self.delScriptGlobals = delScriptGlobals
+        # Scripts are compiled through this if given, see 'codecache'.
+        self.codeCache = codeCache
+        # Code compiled by worker processes, see 'CompileScripts'.
+        self.compiledScripts = {}
+        # Where the order the scripts ran in is kept between loads, see 'manifest'.
+        self.manifestPath = manifestPath
+        self.loadOrder = None
+
+        self.pathFilter = self.pathFilterClass(self.includeRules, self.excludeRules)
 
         self.SetBaseDirectory(baseDirPath)
         self.SetBaseNamespaceName(baseNamespace)
@@ -190,6 +364,13 @@ class ScriptDirectory(object):
     def SetBaseNamespaceName(self, baseNamespaceName):
         self.baseNamespaceName = baseNamespaceName
 
+    def GetRelativePath(self, path):
+        # Relative paths given to the path filter always use '/'.
+        relativePath = os.path.relpath(path, self.baseDirPath)
+        if os.path.sep != "/":
+            relativePath = relativePath.replace(os.path.sep, "/")
+        return relativePath
+
     def GetNamespacePath(self, dirPath):
         namespace = self.baseNamespaceName
         relativeDirPath = os.path.relpath(dirPath, self.baseDirPath)
@@ -202,7 +383,21 @@ class ScriptDirectory(object):
         self.LoadDirectory(self.baseDirPath)
         
         ## Pass 2: Execute the scripts, ordering for dependencies and then add the namespace entries.
-        scriptFilesToLoad = set(self.filesByPath.itervalues())
+        # The order they run in is only recorded while loading, see 'RunScript'.
+        self.loadOrder = []
+        try:
+            return self.RunScripts(set(self.filesByPath.itervalues()))
+        finally:
+            self.loadOrder = None
+
+    def RunScripts(self, scriptFilesToLoad):
+        if self.manifestPath is not None:
+            scriptFilesToLoad -= self.RunScriptsFromManifest(scriptFilesToLoad)
+        if self.dependencyOrdering:
+            scriptFilesToLoad -= self.RunScriptsInOrder(scriptFilesToLoad)
+
+        # Any scripts which could not be ordered, or failed to run in order,
+        # are retried until those they depend on have been run.
         attemptsLeft = self.dependencyResolutionPasses
         while len(scriptFilesToLoad) and attemptsLeft > 0:
             logger.debug("ScriptDirectory.Load dependency resolution attempts left %d", attemptsLeft)
@@ -229,29 +424,127 @@ class ScriptDirectory(object):
 
             return False
 
+        if self.manifestPath is not None:
+            self.SaveManifest()
         return True
 
+    def RunScriptsFromManifest(self, scriptFiles):
+        """
+        Run the scripts in the order they ran in last time, other than those
+        which have changed since.  If any have, or fail to run, those which
+        depend on scripts not run from the manifest are left out as well, see
+        'dependencies'.  Returns the scripts which ran successfully.
+        """
+        scriptFilesByPath = dict((self.GetRelativePath(scriptFile.filePath), scriptFile) for scriptFile in scriptFiles)
+        entries = manifest.Load(self.manifestPath, self.baseNamespaceName)
+        order = []
+        for relativePath, codeHash in entries:
+            scriptFile = scriptFilesByPath.get(relativePath)
+            if scriptFile is not None and scriptFile.codeHash == codeHash:
+                order.append(scriptFile)
+        self.CreateScriptNamespaces(order)
+
+        # The recorded order only holds as it is for the same scripts.
+        dependenciesByScript = None
+        if len(order) != len(entries) or len(order) != len(scriptFiles):
+            dependenciesByScript = dependencies.OrderScripts(scriptFiles, self.baseNamespaceName)[2]
+
+        scriptFilesLoaded = set()
+        for scriptFile in order:
+            if dependenciesByScript is not None and dependenciesByScript[scriptFile] - scriptFilesLoaded:
+                continue
+            if self.RunScript(scriptFile):
+                scriptFilesLoaded.add(scriptFile)
+            elif dependenciesByScript is None:
+                dependenciesByScript = dependencies.OrderScripts(scriptFiles, self.baseNamespaceName)[2]
+        logger.debug("ScriptDirectory.Load ran %d of %d scripts from the load order manifest", len(scriptFilesLoaded), len(scriptFiles))
+        return scriptFilesLoaded
+
+    def SaveManifest(self):
+        entries = [ (self.GetRelativePath(scriptFile.filePath), scriptFile.codeHash) for scriptFile in self.loadOrder ]
+        try:
+            manifest.Save(self.manifestPath, self.baseNamespaceName, entries)
+        except (IOError, OSError), e:
+            logger.warning("Unable to write load order manifest '%s': %s", self.manifestPath, e)
+
+    def CreateScriptNamespaces(self, scriptFiles):
+        # Scripts may import their namespaces before anything has been added.
+        for scriptFile in scriptFiles:
+            self.CreateNamespace(scriptFile.namespacePath, scriptFile.filePath)
+
+    def RunScriptsInOrder(self, scriptFiles):
+        """
+        Run each script once, after the scripts it depends on, see
+        'dependencies'.  Returns the scripts which ran successfully.
+        """
+        order, cycles, dependenciesByScript = dependencies.OrderScripts(scriptFiles, self.baseNamespaceName)
+        for cycle in cycles:
+            logger.error("ScriptDirectory.Load found scripts which depend on each other: %s", ", ".join(scriptFile.filePath for scriptFile in cycle))
+
+        self.CreateScriptNamespaces(order)
+
+        scriptFilesLoaded = set()
+        for scriptFile in order:
+            # Those it depends on failed to run, it would fail as well.
+            if dependenciesByScript[scriptFile] - scriptFilesLoaded:
+                continue
+            if self.RunScript(scriptFile):
+                scriptFilesLoaded.add(scriptFile)
+        return scriptFilesLoaded
+
     def LoadDirectory(self, dirPath):
         logger.debug("LoadDirectory %s", dirPath)
 
+        scripts = list(self.FindScripts(dirPath))
+        if self.compileProcesses and len(scripts) > 1:
+            self.CompileScripts([ filePath for (filePath, namespace) in scripts ])
+
+        for filePath, namespace in scripts:
+            scriptFile = self.LoadScript(filePath, namespace)
+            self.RegisterScript(scriptFile)
+
+    def FindScripts(self, dirPath):
+        # Yields '(filePath, namespacePath)' for each script under the directory.
         namespace = self.GetNamespacePath(dirPath)
 
         for entryName in os.listdir(dirPath):
-            if entryName == ".svn":
-                continue
-
             entryPath = os.path.join(dirPath, entryName)
+            relativePath = self.GetRelativePath(entryPath)
             if os.path.isdir(entryPath):
-                self.LoadDirectory(entryPath)
+                if not self.pathFilter.IsDirectoryIgnored(relativePath):
+                    for script in self.FindScripts(entryPath):
+                        yield script
             elif os.path.isfile(entryPath):
-                if not entryName.endswith(".py") or entryName.endswith("_unittest.py"):
+                if self.pathFilter.IsFileIgnored(relativePath):
                     continue
-
-                scriptFile = self.LoadScript(entryPath, namespace)
-                self.RegisterScript(scriptFile)
+                yield entryPath, namespace
             else:
                 logger.error("Unrecognised type of directory entry %s", entryPath)
 
+    def CompileScripts(self, filePaths):
+        """
+        Compile the given scripts in a pool of worker processes, for
+        'LoadScript' to use.  Scripts which fail to compile are compiled again
+        by 'LoadScript', so that the error is raised as it would otherwise be.
+        """
+        codeCacheArgs = None
+        if self.codeCache is not None:
+            codeCacheArgs = self.codeCache.dirPath, self.codeCache.maxSize
+
+        processCount = min(self.compileProcesses, len(filePaths))
+        chunkSize = max(1, len(filePaths) // (processCount * 4))
+        pool = multiprocessing.Pool(processCount)
+        try:
+            tasks = [ (self.scriptFileClass, filePath, codeCacheArgs) for filePath in filePaths ]
+            for filePath, compiled, cacheStatistics in pool.imap_unordered(CompileScript, tasks, chunkSize):
+                if compiled is not None:
+                    self.compiledScripts[filePath] = compiled
+                for k, v in cacheStatistics.iteritems():
+                    self.codeCache.statistics[k] += v
+        finally:
+            pool.close()
+            pool.join()
+
     def Unload(self):
         if not len(self.filesByPath) and not len(self.namespaces):
             return
@@ -345,7 +638,14 @@ class ScriptDirectory(object):
     def LoadScript(self, filePath, namespacePath):
         logger.debug("LoadScript %s", filePath)
 
-        return self.scriptFileClass(filePath, namespacePath, delGlobals=self.delScriptGlobals)
+        compiled = self.compiledScripts.pop(filePath, None)
+        if compiled is not None:
+            data, sourceHash, codeHash = compiled
+            scriptFile = self.scriptFileClass(filePath, namespacePath, implicitLoad=False, delGlobals=self.delScriptGlobals, codeCache=self.codeCache)
+            scriptFile.LoadCode(filePath, marshal.loads(data), sourceHash, codeHash)
+            return scriptFile
+
+        return self.scriptFileClass(filePath, namespacePath, delGlobals=self.delScriptGlobals, codeCache=self.codeCache)
 
     def RunScript(self, scriptFile, tentative=False):
         logger.debug("RunScript %s", scriptFile.filePath)
@@ -367,6 +667,8 @@ class ScriptDirectory(object):
 
             namespace = self.CreateNamespace(scriptFile.namespacePath, scriptFile.filePath)
             self.SetModuleAttributes(scriptFile, namespace)
+            if self.loadOrder is not None:
+                self.loadOrder.append(scriptFile)
 
         return True
 
@@ -385,7 +687,10 @@ class ScriptDirectory(object):
         return True
 
     def UnloadScript(self, scriptFile, force=False):
-        namespace = self.GetNamespace(scriptFile.namespacePath)
+        # Scripts which were loaded but never run have contributed nothing.
+        namespace = self.namespaces.get(scriptFile.namespacePath)
+        if namespace is None:
+            return False
         if self.RemoveModuleAttributes(scriptFile, namespace):
             return True
         return False            
@@ -7,12 +7,15 @@ import types
 import weakref
 import time
 import gc
+import hashlib
 
 logger = logging.getLogger("reloader")
 # logger.setLevel(logging.DEBUG)
 
 # TODO: rename 'namespace.py' to 'namespaces.py' ... need to think about it...
 import namespace as namespaces
+import codecache
+import bundle
 
 MODE_OVERWRITE = 1
 MODE_UPDATE = 2
@@ -26,36 +29,98 @@ class ReloadableScriptDirectory(namespaces.ScriptDirectory):
     scriptFileClass = ReloadableScriptFile
     unitTest = True
 
+class ReloadableBundleScriptDirectory(bundle.BundleScriptDirectory):
+    scriptFileClass = ReloadableScriptFile
+    unitTest = True
+
 
 class CodeReloader:
     internalFileMonitor = None
+    notificationServer = None
+    codeCache = None
     scriptDirectoryClass = ReloadableScriptDirectory
+    bundleDirectoryClass = ReloadableBundleScriptDirectory
 
-    def __init__(self, mode=MODE_UPDATE, monitorFileChanges=True, fileChangeCheckDelay=None):
+    def __init__(self, mode=MODE_UPDATE, monitorFileChanges=True, fileChangeCheckDelay=None, fileChangeCoalesceDelay=None, fileChangeSnapshotPath=None, fileChangeShared=False, fileChangeSettleTime=None, codeCachePath=None, codeCacheMaxSize=None, loadOrderManifestDirPath=None):
         self.mode = mode
         self.monitorFileChanges = monitorFileChanges
+        # Share the scanning of directories with any other code reloaders.
+        self.fileChangeShared = fileChangeShared
 
         self.directoriesByPath = {}
+        # The registered directories whose files are monitored for changes.
+        self.monitoredPaths = set()
         self.namespaceLeaks = {}
         self.classCreationCallback = None
         self.classUpdateCallback = None
         self.validateScriptCallback = None
 
+        # Where the order scripts ran in is recorded for each directory, see 'manifest'.
+        self.loadOrderManifestDirPath = loadOrderManifestDirPath
+        if loadOrderManifestDirPath is not None and not os.path.isdir(loadOrderManifestDirPath):
+            os.makedirs(loadOrderManifestDirPath)
+
+        if codeCachePath is not None:
+            # Compiled scripts are kept here, and used while they match.
+            self.codeCache = codecache.CodeCache(codeCachePath, maxSize=codeCacheMaxSize)
+
         if monitorFileChanges:
             # Grabbing a weakref to a method of this instance requires me to
             # hold onto the method as well.
             pr = weakref.proxy(self)
             cb = lambda *args, **kwargs: pr.ProcessChangedFile(*args, **kwargs)
-            self.internalFileMonitor = self.GetChangeHandler(cb, delay=fileChangeCheckDelay)
+            kwargs = { "delay": fileChangeCheckDelay, "snapshotPath": fileChangeSnapshotPath }
+            if fileChangeCoalesceDelay is not None:
+                kwargs["batchCallback"] = lambda changes: pr.ProcessChangedFiles(changes)
+                kwargs["coalesceDelay"] = fileChangeCoalesceDelay
+            if fileChangeSettleTime is not None:
+                # Scripts still being saved are not loaded until they are complete.
+                kwargs["settleTime"] = fileChangeSettleTime
+            self.internalFileMonitor = self.GetChangeHandler(cb, **kwargs)
 
     def GetChangeHandler(self, cb, *args, **kwargs):
         import filechanges
+        if self.fileChangeShared:
+            from filechanges import registry
+            return registry.SharedChangeHandler(cb, *args, **kwargs)
         return filechanges.ChangeHandler(cb, *args, **kwargs)
 
+    def ScanNow(self, timeout=None):
+        # Look for file changes immediately, and return once any resulting
+        # reloads have been applied.
+        if not self.monitorFileChanges:
+            return False
+        return self.internalFileMonitor.ScanNow(timeout)
+
     def EndMonitoring(self):
-        if self.monitorFileChanges:
+        self.StopNotificationServer()
+        if self.monitorFileChanges and self.internalFileMonitor is not None:
+            # Changes made before monitoring resumes are reported then.
+            self.internalFileMonitor.SaveSnapshot()
             self.internalFileMonitor = None
 
+    def StartNotificationServer(self, socketPath):
+        """
+        Listen on the given Unix socket for editors and deploy tools to report
+        the files they have written, see 'filechanges.notifications'.  These
+        are applied without waiting for the next scan, and the sender is told
+        once they have been.
+        """
+        if not self.monitorFileChanges:
+            raise RuntimeError("File change notifications require file change monitoring")
+
+        from filechanges import notifications
+        pr = weakref.proxy(self)
+        cb = lambda filePath: pr.ProcessNotifiedFile(filePath)
+        self.notificationServer = notifications.NotificationServer(socketPath, self.internalFileMonitor, cb)
+        self.notificationServer.start()
+        return self.notificationServer
+
+    def StopNotificationServer(self):
+        if self.notificationServer is not None:
+            self.notificationServer.Close()
+            self.notificationServer = None
+
     def SetClassUpdateCallback(self, ob):
         if type(ob) is types.MethodType:
             self.classUpdateCallback = (weakref.proxy(ob.im_self), ob.func_name)
@@ -96,7 +161,26 @@ class CodeReloader:
     # Directory registration support.
 
     def AddDirectory(self, baseNamespace, baseDirPath):
-        handler = self.scriptDirectoryClass(baseDirPath, baseNamespace, delScriptGlobals=(self.mode == MODE_UPDATE))
+        if self.codeCache is not None and os.path.join(os.path.abspath(self.codeCache.dirPath), "").startswith(os.path.join(os.path.abspath(baseDirPath), "")):
+            logger.warning("The code cache '%s' is within the script directory '%s'", self.codeCache.dirPath, baseDirPath)
+
+        handler = self.scriptDirectoryClass(baseDirPath, baseNamespace, delScriptGlobals=(self.mode == MODE_UPDATE), codeCache=self.codeCache)
+        return self.RegisterDirectory(handler, baseNamespace, baseDirPath, self.monitorFileChanges)
+
+    def AddBundle(self, baseNamespace, bundlePath, baseDirPath=None, sourceOverrides=False):
+        """
+        Load the scripts packed into the given bundle, see 'bundle'.  They are
+        given paths within the directory they were packed from, unless another
+        is given.  With 'sourceOverrides', scripts in that directory which
+        differ from the bundled versions are used, and changes to it are
+        monitored.
+        """
+        handler = self.bundleDirectoryClass(bundlePath, baseDirPath, baseNamespace, delScriptGlobals=(self.mode == MODE_UPDATE), codeCache=self.codeCache, sourceOverrides=sourceOverrides)
+        return self.RegisterDirectory(handler, baseNamespace, handler.baseDirPath, self.monitorFileChanges and sourceOverrides)
+
+    def RegisterDirectory(self, handler, baseNamespace, baseDirPath, monitor):
+        if self.loadOrderManifestDirPath is not None:
+            handler.manifestPath = self.GetManifestPath(baseDirPath)
         if self.classCreationCallback:
             handler.SetClassCreationCallback(self.classCreationCallback)
         if self.validateScriptCallback:
@@ -106,18 +190,24 @@ class CodeReloader:
             self.directoriesByPath[baseDirPath] = handler
             logger.info("Added '%s' into '%s'", baseDirPath, baseNamespace)
 
-            if self.monitorFileChanges:
+            if monitor:
                 logger.info("Monitoring file changes for '%s'", baseDirPath)
-                self.internalFileMonitor.AddDirectory(baseDirPath)
+                self.internalFileMonitor.AddDirectory(baseDirPath, pathFilter=handler.pathFilter)
+                self.monitoredPaths.add(baseDirPath)
 
             return handler
 
         # Remove the namespace contributions which came from this failed process.
         handler.Unload()
 
+    def GetManifestPath(self, baseDirPath):
+        dirName = os.path.basename(os.path.normpath(baseDirPath))
+        return os.path.join(self.loadOrderManifestDirPath, "%s-%s.order" % (dirName, hashlib.sha1(os.path.abspath(baseDirPath)).hexdigest()[:12]))
+
     def RemoveDirectory(self, baseDirPath):
-        if self.monitorFileChanges:
+        if baseDirPath in self.monitoredPaths:
             self.internalFileMonitor.RemoveDirectory(baseDirPath)
+            self.monitoredPaths.remove(baseDirPath)
 
         handler = self.directoriesByPath[baseDirPath]
         handler.Unload()
@@ -134,30 +224,50 @@ class CodeReloader:
     # External events.
 
     def ProcessChangedFile(self, filePath, added=False, changed=False, deleted=False):
+        # Returns whether the change was applied.
         logger.debug("File change '%s' added=%s changed=%s deleted=%s", filePath, added, changed, deleted)
 
         scriptDirectory = self.FindDirectory(filePath)
         if scriptDirectory is None:
             logger.error("File change event for invalid path '%s'", filePath)
-            return
+            return False
 
         oldScriptFile = scriptDirectory.FindScript(filePath)
         if oldScriptFile:
             # Modified or deleted.
             if changed:
-                logger.info("Script reloaded '%s'", filePath)
-                self.ReloadScript(oldScriptFile)
+                return self.ReloadChangedScript(oldScriptFile)
             elif deleted:
                 logger.info("Script removed '%s'", filePath)
                 logger.warn("Deleted script leaking its namespace contributions")
+                return True
         else:
             if added:
                 logger.info("Script loaded '%s'", filePath)
-                self.LoadScript(filePath)
+                return self.LoadScript(filePath)
             elif changed:
                 logger.error("Modified script not already loaded '%s'", filePath)
             elif deleted:
                 logger.error("Deleted script not already loaded '%s'", filePath)
+        return False
+
+    def ProcessNotifiedFile(self, filePath):
+        # A file reported by whatever wrote it, which does not say how it changed.
+        scriptDirectory = self.FindDirectory(filePath)
+        if scriptDirectory is None:
+            logger.error("File change notification for invalid path '%s'", filePath)
+            return False
+
+        if not os.path.exists(filePath):
+            return self.ProcessChangedFile(filePath, deleted=True)
+        if scriptDirectory.FindScript(filePath):
+            return self.ProcessChangedFile(filePath, changed=True)
+        return self.ProcessChangedFile(filePath, added=True)
+
+    def ProcessChangedFiles(self, changes):
+        # A coalesced batch of changes, in the order they were first seen.
+        for filePath, added, changed, deleted in changes:
+            self.ProcessChangedFile(filePath, added=added, changed=changed, deleted=deleted)
 
     # ------------------------------------------------------------------------
     # Script reloading support.
@@ -176,25 +286,48 @@ class CodeReloader:
             scriptFile.LogLastError()
         return ret            
 
-    def ReloadScript(self, oldScriptFile):
+    def ReloadChangedScript(self, oldScriptFile):
+        """
+        Reload a script file reported as changed, unless its contents are the
+        same, as after a touch or a checkout, or only comments or layout
+        changed.  Neither is worth compiling, or running, again.
+        """
+        filePath = oldScriptFile.filePath
+        if oldScriptFile.IsSourceUnchanged():
+            logger.info("Script unchanged '%s'", filePath)
+            return True
+
+        scriptDirectory = self.FindDirectory(filePath)
+        newScriptFile = scriptDirectory.LoadScript(filePath, oldScriptFile.namespacePath)
+        if newScriptFile.IsCodeEquivalent(oldScriptFile):
+            logger.info("Script comments or layout changed '%s'", filePath)
+            oldScriptFile.UpdateLineNumbers(newScriptFile)
+            return True
+
+        logger.info("Script reloaded '%s'", filePath)
+        return self.ReloadScript(oldScriptFile, newScriptFile)
+
+    def ReloadScript(self, oldScriptFile, newScriptFile=None):
         logger.debug("ReloadScript")
         
-        newScriptFile = self.CreateNewScript(oldScriptFile)
+        newScriptFile = self.CreateNewScript(oldScriptFile, newScriptFile)
         if newScriptFile is None:
             return False
 
         self.UseNewScript(oldScriptFile, newScriptFile)        
         return True
 
-    def CreateNewScript(self, oldScriptFile):
+    def CreateNewScript(self, oldScriptFile, newScriptFile=None):
         filePath = oldScriptFile.filePath
         namespacePath = oldScriptFile.namespacePath
 
         logger.debug("CreateNewScript namespace='%s', file='%s', oldVersion=%d", namespacePath, filePath, oldScriptFile.version)
 
-        # Read in and compile the modified script file.
+        # Read in and compile the modified script file, unless the caller
+        # already has.
         scriptDirectory = self.FindDirectory(filePath)
-        newScriptFile = scriptDirectory.LoadScript(filePath, namespacePath)
+        if newScriptFile is None:
+            newScriptFile = scriptDirectory.LoadScript(filePath, namespacePath)
 
         # Try and execute the new script file.
         if scriptDirectory.RunScript(newScriptFile, tentative=True):
@@ -238,6 +371,8 @@ class CodeReloader:
         elif self.mode == MODE_UPDATE:
             self.UpdateModuleAttributes(oldScriptFile, newScriptFile, namespace, overwritableAttributes=self.namespaceLeaks)
             oldScriptFile.version += 1
+            # The retained script file now has the contents of the new one.
+            oldScriptFile.SetCode(newScriptFile)
 
             # Remove as leaks the attributes the new version contributed.
             self.RemoveLeakedAttributes(newScriptFile)
@@ -426,13 +561,13 @@ class CodeReloader:
 
 class StacklessCodeReloader(CodeReloader):
     def GetChangeHandler(self, cb, *args, **kwargs):
-        kwargs["useThreads"] = False
-
-        import filechanges
-        return filechanges.ChangeHandler(cb, *args, **kwargs)
+        kwargs["useThread"] = False
+        return CodeReloader.GetChangeHandler(self, cb, *args, **kwargs)
 
-    def DispatchPendingFileChanges(self):
-        self.internalFileMonitor.ProcessFileEvents()
+    def DispatchPendingFileChanges(self, timeBudget=None):
+        # Given a time budget in seconds, the work is spread over calls.
+        # Returns True if there is work left for the next call.
+        return self.internalFileMonitor.ProcessFileEvents(timeBudget)
 
 
 def RebindFunction(function, globals_):
@@ -0,0 +1,1265 @@
+#
+# Q. Unit tests failing and not clear why?
+#
+# A. Set the logger to log at DEBUG level.  Go to the bottom of this file
+#    and change one of the last lines.
+#
+
+import unittest
+import os, sys, time, shutil, tempfile, threading, socket, subprocess
+import logging
+
+if __name__ == "__main__":
+    currentPath = sys.path[0]
+    parentPath = os.path.dirname(currentPath)
+    if parentPath not in sys.path:
+        sys.path.append(parentPath)
+
+# Add test information to the logging output.
+class TestCase(unittest.TestCase):
+    def run(self, *args, **kwargs):
+        logging.debug("%s %s", self._testMethodName, (79 - len(self._testMethodName) - 1) *"-")
+        super(TestCase, self).run(*args, **kwargs)
+
+import filechanges
+from filechanges import recipe215418, linuxinotify, pathfilter, scheduling, registry, daemon, filetable, notifications, snapshot, datafile
+
+
+# Where the package is run from, for the command line entry points.
+PACKAGE_PARENT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(filechanges.__file__)))
+
+
+class PollingChangeHandler(filechanges.ChangeHandler):
+    useNativeMonitoring = False
+
+
+class FileChangeTestCase(TestCase):
+    """
+    Each test gets a scratch directory to monitor, and a record of the
+    events which were dispatched for it.
+    """
+
+    handlerClass = filechanges.ChangeHandler
+
+    def setUp(self):
+        self.dirPath = tempfile.mkdtemp()
+        self.events = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dirPath, ignore_errors=True)
+
+    def Callback(self, filePath, added=False, changed=False, deleted=False):
+        relativePath = os.path.relpath(filePath, self.dirPath)
+        if added:
+            self.events.append(("added", relativePath))
+        if changed:
+            self.events.append(("changed", relativePath))
+        if deleted:
+            self.events.append(("deleted", relativePath))
+
+    def CreateHandler(self, **kwargs):
+        handler = self.handlerClass(self.Callback, useThread=False, **kwargs)
+        handler.AddDirectory(self.dirPath)
+        return handler
+
+    def WriteFile(self, relativePath, contents="pass\n", mtimeOffset=0):
+        filePath = os.path.join(self.dirPath, relativePath)
+        dirPath = os.path.dirname(filePath)
+        if not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        open(filePath, "w").write(contents)
+
+        # Timestamps may only have a resolution of a second, so move the
+        # modification time far enough forward that a change will be seen.
+        if mtimeOffset:
+            t = os.stat(filePath).st_mtime + mtimeOffset
+            os.utime(filePath, (t, t))
+        return filePath
+
+    def PopEvents(self):
+        events = sorted(self.events)
+        self.events = []
+        return events
+
+    def CountListings(self, handler):
+        listedPaths = []
+        originalListDir = os.listdir
+        def listdir(path):
+            listedPaths.append(path)
+            return originalListDir(path)
+        os.listdir = listdir
+        try:
+            handler.ProcessFileEvents()
+        finally:
+            os.listdir = originalListDir
+        return len(listedPaths)
+
+    def AgeDirectories(self, seconds=10):
+        # Move directory mtimes out of the window where they are not trusted.
+        for dirPath, dirNames, fileNames in os.walk(self.dirPath):
+            t = os.stat(dirPath).st_mtime - seconds
+            os.utime(dirPath, (t, t))
+
+
+class PollingTests(FileChangeTestCase):
+    handlerClass = PollingChangeHandler
+
+    def testFileEvents(self):
+        self.WriteFile("existing.py")
+        handler = self.CreateHandler()
+
+        self.WriteFile("new.py")
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        self.WriteFile("ignored.txt")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("changed", "existing.py") ])
+
+        os.remove(os.path.join(self.dirPath, "new.py"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("deleted", "new.py") ])
+
+    def testIgnoredDirectoriesPruned(self):
+        self.WriteFile("existing.py")
+        handler = self.CreateHandler()
+
+        self.WriteFile(os.path.join(".git", "hooks", "hook.py"))
+        self.WriteFile(os.path.join("node_modules", "module.py"))
+        self.failUnlessEqual(self.CountListings(handler), 1)
+        self.failUnlessEqual(self.PopEvents(), [])
+        self.failUnless(handler.statistics["directoriesPruned"] == 2, "Ignored directories were not pruned")
+
+    def testSkipList(self):
+        handler = self.CreateHandler()
+        handler.skipList.append(os.path.sep + "generated" + os.path.sep)
+        handler.skipList.append("_scratch")
+
+        self.WriteFile(os.path.join("generated", "a.py"))
+        self.WriteFile("b_scratch.py")
+        self.WriteFile("c.py")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "c.py") ])
+
+    def testSingleStatPerFile(self):
+        self.WriteFile("existing.py")
+        self.WriteFile("ignored.txt")
+        handler = self.CreateHandler()
+
+        handler.statistics.clear()
+        handler.ProcessFileEvents()
+        # Either one stat per entry to tell what it is, or none with scandir.
+        if recipe215418.scandir is None:
+            self.failUnlessEqual(handler.statistics["statCalls"], 2)
+        else:
+            self.failUnlessEqual(handler.statistics["statCalls"], 1)
+        self.failUnless(handler.statistics["statsSaved"] > 0, "No saved stat calls were counted")
+
+    def testCachedDirectoryListings(self):
+        class Handler(PollingChangeHandler):
+            cacheDirectoryListings = True
+        self.handlerClass = Handler
+
+        self.WriteFile("existing.py")
+        self.WriteFile(os.path.join("sub", "nested.py"))
+        self.AgeDirectories()
+        handler = self.CreateHandler()
+
+        # Nothing has changed, so nothing is listed.
+        self.failUnlessEqual(self.CountListings(handler), 0)
+
+        # Files are still checked in unchanged directories.
+        self.WriteFile(os.path.join("sub", "nested.py"), "x = 1\n", mtimeOffset=2)
+        self.failUnlessEqual(self.CountListings(handler), 0)
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", os.path.join("sub", "nested.py")) ])
+
+        # Only the changed directory is listed again.
+        self.WriteFile(os.path.join("sub", "new.py"))
+        self.failUnlessEqual(self.CountListings(handler), 1)
+        self.failUnlessEqual(self.PopEvents(), [ ("added", os.path.join("sub", "new.py")) ])
+
+    def testTrustedDirectoryMtimes(self):
+        class Handler(PollingChangeHandler):
+            trustDirectoryMtimes = True
+        self.handlerClass = Handler
+
+        self.WriteFile("existing.py")
+        self.AgeDirectories()
+        handler = self.CreateHandler()
+
+        # In place modifications are not seen, as the directory is unchanged.
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+        # Replacing the file changes the directory.
+        os.remove(os.path.join(self.dirPath, "existing.py"))
+        self.WriteFile("existing.py", "x = 2\n", mtimeOffset=4)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+    def testTieredPolling(self):
+        class Handler(PollingChangeHandler):
+            tieredPolling = True
+            hotCheckCount = 2
+            warmCheckInterval = 2
+            coldCheckCount = 4
+            coldCheckInterval = 8
+        self.handlerClass = Handler
+
+        self.WriteFile("a.py")
+        self.WriteFile("b.py")
+        self.AgeDirectories()
+        handler = self.CreateHandler()
+
+        # Cold files in unchanged directories wait for the cold interval.
+        self.WriteFile("a.py", "x = 1\n", mtimeOffset=2)
+        for i in range(7):
+            handler.ProcessFileEvents()
+            self.failUnlessEqual(self.PopEvents(), [])
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "a.py") ])
+        self.failUnlessEqual(handler.statistics["tieredStatsSaved"], 14)
+        self.failUnlessEqual(handler.statistics["coldTierChecks"], 1)
+        self.failUnlessEqual(handler.statistics["warmTierChecks"], 4)
+
+        # Once changed, a file is hot and checked every time.
+        self.WriteFile("a.py", "x = 2\n", mtimeOffset=4)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "a.py") ])
+
+        # It cools to warm, and is checked every other time.
+        handler.ProcessFileEvents()
+        self.WriteFile("a.py", "x = 3\n", mtimeOffset=6)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "a.py") ])
+
+        # A changed directory has all its files checked.
+        self.WriteFile("b.py", "x = 1\n", mtimeOffset=2)
+        self.WriteFile("c.py")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "c.py"), ("changed", "b.py") ])
+
+    def testUnfinishedWritesHeld(self):
+        class Handler(PollingChangeHandler):
+            includeRules = ( "*", )
+            lockFileSuffixes = ( ".lock", )
+        self.handlerClass = Handler
+        handler = self.CreateHandler(settleTime=60.0)
+
+        # Editor temporary files are never dispatched.
+        self.WriteFile("script.py~")
+        self.WriteFile(".script.py.swp")
+
+        # A file written since the last check may not be finished yet.
+        self.WriteFile("new.py")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+        self.failUnlessEqual(handler.statistics["temporaryFilesIgnored"], 2)
+
+        # It is still being written.
+        self.WriteFile("new.py", "x = 1\n", mtimeOffset=2)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+        # It has not changed since it was last looked at.
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+
+        # Files renamed into place were finished before they were.
+        otherPath = tempfile.mkdtemp()
+        try:
+            tmpFilePath = os.path.join(otherPath, "renamed.py")
+            open(tmpFilePath, "w").write("pass\n")
+            t = time.time() - 1
+            os.utime(tmpFilePath, (t, t))
+            os.rename(tmpFilePath, os.path.join(self.dirPath, "renamed.py"))
+        finally:
+            shutil.rmtree(otherPath, ignore_errors=True)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "renamed.py") ])
+
+        # Files with lock files are held until the lock file goes away.
+        self.WriteFile("locked.py", mtimeOffset=-120)
+        self.WriteFile("locked.py.lock", mtimeOffset=-120)
+        handler.ProcessFileEvents()
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "locked.py.lock") ])
+        os.remove(os.path.join(self.dirPath, "locked.py.lock"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "locked.py"), ("deleted", "locked.py.lock") ])
+
+    def testTimeBudget(self):
+        for i in range(4):
+            self.WriteFile(os.path.join("sub%d" % i, "file.py"))
+        handler = self.CreateHandler()
+        handler.ProcessFileEvents()
+
+        for i in range(4):
+            self.WriteFile(os.path.join("sub%d" % i, "file.py"), "x = 1\n", mtimeOffset=2)
+
+        # Without any budget, each call does one step of the work.
+        steps = 1
+        while handler.ProcessFileEvents(timeBudget=0.0):
+            steps += 1
+            if handler.checkCursor is not None:
+                self.failUnlessEqual(self.PopEvents(), [])
+        # A step per directory, then a step per callback.
+        self.failUnlessEqual(steps, 5 + 1 + 4)
+        self.failUnlessEqual(handler.GetRemainingWork(), (0, 0))
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", os.path.join("sub%d" % i, "file.py")) for i in range(4) ])
+
+        # Work left over is finished by an unbudgeted call.
+        self.WriteFile("new.py")
+        self.failUnless(handler.ProcessFileEvents(timeBudget=0.0), "No work was left")
+        self.failUnlessEqual(handler.GetRemainingWork(), (4, 0))
+        self.failIf(handler.ProcessFileEvents(), "Work was left")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+
+    def testScanNowAfterTimeBudget(self):
+        handler = self.CreateHandler(coalesceDelay=60.0)
+        while handler.ProcessFileEvents(timeBudget=0.0):
+            pass
+
+        self.WriteFile("new.py")
+        self.failUnless(handler.ScanNow(), "Requested check did not happen")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+        self.failUnlessEqual(handler.GetRemainingWork(), (0, 0))
+
+    def testIncrementalRegistration(self):
+        class Handler(PollingChangeHandler):
+            cacheDirectoryListings = True
+        self.handlerClass = Handler
+
+        self.WriteFile(os.path.join("first", "a.py"))
+        self.WriteFile(os.path.join("second", "b.py"))
+        firstPath = os.path.join(self.dirPath, "first")
+        secondPath = os.path.join(self.dirPath, "second")
+        handler = self.handlerClass(self.Callback, useThread=False)
+        handler.AddDirectory(firstPath)
+
+        # A change made before another directory is registered is still seen.
+        self.WriteFile(os.path.join("first", "a.py"), "x = 1\n", mtimeOffset=2)
+        handler.AddDirectory(secondPath)
+        self.failUnlessEqual(self.PopEvents(), [])
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", os.path.join("first", "a.py")) ])
+
+        # Only the state of the removed directory is dropped.
+        handler.RemoveDirectory(secondPath)
+        self.failUnlessEqual(handler.watchState.keys(), [ firstPath ])
+        self.failIf([ dirPath for dirPath in handler.directoryState if dirPath.startswith(secondPath) ], "Listings were kept")
+        self.failUnless(firstPath in handler.directoryState, "Listings were dropped")
+
+    def testCompactWatchState(self):
+        class Handler(PollingChangeHandler):
+            compactWatchState = True
+        self.handlerClass = Handler
+
+        self.WriteFile("existing.py")
+        self.WriteFile(os.path.join("sub", "nested.py"))
+        self.WriteFile(os.path.join("gone", "deleted.py"))
+        handler = self.CreateHandler()
+        tldState = handler.watchState[self.dirPath]
+        self.failUnless(isinstance(tldState, filetable.FileTable), "State is not compact")
+        self.failUnlessEqual(len(tldState), 3)
+        filePath = os.path.join(self.dirPath, "existing.py")
+        self.failUnlessEqual(tldState[filePath], recipe215418.GetFileSignature(os.stat(filePath)))
+
+        # Nothing changed, so whole arrays compare equal.
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+        self.WriteFile("new.py")
+        self.WriteFile(os.path.join("sub", "nested.py"), "x = 1\n", mtimeOffset=2)
+        self.WriteFile(os.path.join("added", "file.py"))
+        shutil.rmtree(os.path.join(self.dirPath, "gone"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [
+            ("added", os.path.join("added", "file.py")),
+            ("added", "new.py"),
+            ("changed", os.path.join("sub", "nested.py")),
+            ("deleted", os.path.join("gone", "deleted.py")),
+        ])
+
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+    def testFileTableCompare(self):
+        def Table(*names):
+            return filetable.FileTable((os.path.join("d", name), (1.0, 1, 1)) for name in names)
+
+        old = Table("a.py", "b.py", os.path.join("x", "c.py"))
+        new = Table("a.py", "ab.py", os.path.join("y", "d.py"))
+        self.failUnlessEqual(new.Compare(old), ([ os.path.join("d", "ab.py"), os.path.join("d", "y", "d.py") ], [], [ os.path.join("d", "b.py"), os.path.join("d", "x", "c.py") ]))
+        self.failUnlessEqual(sorted(new), sorted(os.path.join("d", p) for p in ("a.py", "ab.py", os.path.join("y", "d.py"))))
+        self.failIf(os.path.join("d", "b.py") in new, "Missing file found")
+
+        changed = filetable.FileTable((path, (signature[0], 2, signature[2])) for (path, signature) in new.iteritems() if path.endswith("ab.py"))
+        changed = filetable.FileTable(list(changed.iteritems()) + [ item for item in new.iteritems() if not item[0].endswith("ab.py") ])
+        self.failUnlessEqual(changed.Compare(new), ([], [ os.path.join("d", "ab.py") ], []))
+
+    def testParallelScanning(self):
+        class Handler(PollingChangeHandler):
+            scanThreads = 2
+        self.handlerClass = Handler
+
+        relativePaths = [ "top.py" ]
+        for i in range(12):
+            for j in range(2):
+                relativePaths.append(os.path.join("sub%02d" % i, "deeper%d" % j, "file.py"))
+        for relativePath in relativePaths:
+            self.WriteFile(relativePath)
+        handler = self.CreateHandler()
+        self.failUnlessEqual(sorted(handler.watchState[self.dirPath]), sorted(os.path.join(self.dirPath, p) for p in relativePaths))
+
+        # Each shard is a subtree, and the shards are merged in path order.
+        shardPaths = [ shardPath for shardPath, fileCount, elapsedTime in handler.shardTimings ]
+        self.failUnlessEqual(shardPaths, sorted(shardPaths))
+        self.failUnlessEqual(sum(fileCount for shardPath, fileCount, elapsedTime in handler.shardTimings), len(relativePaths) - 1)
+
+        self.WriteFile(os.path.join("sub03", "new.py"))
+        self.WriteFile(os.path.join("sub07", "deeper1", "file.py"), "x = 1\n", mtimeOffset=2)
+        os.remove(os.path.join(self.dirPath, "sub11", "deeper0", "file.py"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [
+            ("added", os.path.join("sub03", "new.py")),
+            ("changed", os.path.join("sub07", "deeper1", "file.py")),
+            ("deleted", os.path.join("sub11", "deeper0", "file.py")),
+        ])
+
+
+class ThreadedTests(FileChangeTestCase):
+    handlerClass = PollingChangeHandler
+
+    def CreateHandler(self, **kwargs):
+        handler = self.handlerClass(self.Callback, **kwargs)
+        handler.AddDirectory(self.dirPath)
+        return handler
+
+    def testScanNow(self):
+        # The delay is long enough that only requested checks happen.
+        handler = self.CreateHandler(delay=60.0)
+        self.failUnless(handler.ScanNow(timeout=10.0), "Requested check did not happen")
+
+        self.WriteFile("a.py")
+        startTime = time.time()
+        self.failUnless(handler.ScanNow(timeout=10.0), "Requested check did not happen")
+        self.failUnless(time.time() - startTime < 5.0, "Requested check was not immediate")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py") ])
+
+    def testScanNowDispatchesCoalescedEvents(self):
+        handler = self.CreateHandler(delay=60.0, coalesceDelay=60.0)
+        handler.ScanNow(timeout=10.0)
+
+        self.WriteFile("a.py")
+        handler.ScanNow(timeout=10.0)
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py") ])
+
+    def testWaitForNextMonitoringCheck(self):
+        handler = self.CreateHandler(delay=0.05)
+        self.failUnless(handler.WaitForNextMonitoringCheck(maxDelay=10.0) is not None, "No check happened")
+
+        handler = self.CreateHandler(delay=60.0)
+        handler.ScanNow(timeout=10.0)
+        self.failUnless(handler.WaitForNextMonitoringCheck(maxDelay=0.1) is None, "Unexpected check happened")
+
+    def testIncrementalRegistration(self):
+        handler = self.CreateHandler(delay=60.0)
+        handler.ScanNow(timeout=10.0)
+
+        # The pending change is found by the check which adds the directory.
+        self.WriteFile("a.py")
+        otherPath = tempfile.mkdtemp()
+        try:
+            open(os.path.join(otherPath, "b.py"), "w").write("pass\n")
+            handler.AddDirectory(otherPath)
+            handler.ScanNow(timeout=10.0)
+            self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py") ])
+            self.failUnless(os.path.join(otherPath, "b.py") in handler.watchState[otherPath], "New directory was not primed")
+
+            handler.RemoveDirectory(otherPath)
+            handler.ScanNow(timeout=10.0)
+            self.failIf(otherPath in handler.watchState, "Removed directory was kept")
+        finally:
+            shutil.rmtree(otherPath, ignore_errors=True)
+
+    def testSlowCallbacksDoNotBlockRegistration(self):
+        releaseEvent = threading.Event()
+        def Callback(filePath, added=False, changed=False, deleted=False):
+            releaseEvent.wait(10.0)
+            self.Callback(filePath, added=added, changed=changed, deleted=deleted)
+
+        class Handler(PollingChangeHandler):
+            dispatchQueueSize = 1
+        handler = Handler(Callback, delay=0.05)
+        handler.AddDirectory(self.dirPath)
+        handler.WaitForNextMonitoringCheck(maxDelay=10.0)
+
+        self.WriteFile("a.py")
+        self.WriteFile("b.py")
+        self.WriteFile("c.py")
+        while handler.thread.scanCount == handler.thread.checkCount:
+            time.sleep(0.01)
+
+        # The scanning thread carries on while the callbacks are stuck.
+        otherDirPath = tempfile.mkdtemp()
+        try:
+            startTime = time.time()
+            handler.AddDirectory(otherDirPath)
+            self.failUnless(time.time() - startTime < 5.0, "Registration waited on a callback")
+        finally:
+            shutil.rmtree(otherDirPath, ignore_errors=True)
+
+        releaseEvent.set()
+        self.failUnless(handler.ScanNow(timeout=10.0), "Requested check did not happen")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py"), ("added", "b.py"), ("added", "c.py") ])
+        self.failUnless(handler.statistics["dispatchQueueFullWaits"] > 0, "Backpressure was not recorded")
+        self.failUnlessEqual(handler.statistics["dispatchesQueued"], 3)
+
+
+    def testThrottledScanDoesNotBlockRegistration(self):
+        class Handler(PollingChangeHandler):
+            scanBudget = 0.5
+            scanBudgetChunkSize = 1
+        handler = Handler(self.Callback, delay=60.0)
+        handler.AddDirectory(self.dirPath)
+        handler.ScanNow(timeout=10.0)
+
+        # The scan sleeps between chunks, for long enough to be noticed.
+        sleepingEvent = threading.Event()
+        sleepTimes = [ 2.0 ]
+        throttle = handler.budget.sleepFunction
+        def Throttle(sleepTime):
+            if handler.thread.checking:
+                sleepingEvent.set()
+            throttle(sleepTimes[0])
+        handler.budget.sleepFunction = Throttle
+
+        self.WriteFile("a.py")
+        handler.thread.wakeEvent.set()
+        self.failUnless(sleepingEvent.wait(10.0), "The scan was not throttled")
+
+        otherDirPath = tempfile.mkdtemp()
+        try:
+            startTime = time.time()
+            handler.AddDirectory(otherDirPath)
+            self.failUnless(time.time() - startTime < 1.0, "Registration waited on the throttle")
+        finally:
+            shutil.rmtree(otherDirPath, ignore_errors=True)
+
+        sleepTimes[0] = 0.0
+        self.failUnless(handler.ScanNow(timeout=10.0), "Requested check did not happen")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py") ])
+
+
+class AsyncWatcherTests(FileChangeTestCase):
+    handlerClass = PollingChangeHandler
+
+    def setUp(self):
+        try:
+            import trollius
+        except ImportError:
+            self.skipTest("trollius is not available")
+        super(AsyncWatcherTests, self).setUp()
+
+    def testNextBatch(self):
+        import trollius
+        from filechanges import asyncwatcher
+
+        loop = trollius.new_event_loop()
+        self.addCleanup(loop.close)
+
+        handler = self.handlerClass(None, delay=0.01, useThread=False)
+        watcher = asyncwatcher.ChangeWatcher(handler, loop=loop)
+        watcher.AddDirectory(self.dirPath)
+
+        self.WriteFile("a.py")
+        changes = loop.run_until_complete(trollius.wait_for(watcher.Next(), 10.0, loop=loop))
+        self.failUnlessEqual(changes, [ (os.path.join(self.dirPath, "a.py"), True, False, False) ])
+
+        watcher.Close()
+        self.failUnless(loop.run_until_complete(watcher.Next()) is None, "Closed watcher returned a batch")
+
+    def testRegistrationDuringScan(self):
+        import trollius
+        from filechanges import asyncwatcher
+
+        loop = trollius.new_event_loop()
+        self.addCleanup(loop.close)
+
+        handler = self.handlerClass(None, delay=0.01, useThread=False)
+        watcher = asyncwatcher.ChangeWatcher(handler, loop=loop)
+
+        # A slow scan holds the lock, registration does not wait for it.
+        watcher.lock.acquire()
+        try:
+            watcher.AddDirectory(self.dirPath)
+            self.failIf(self.dirPath in handler.directories, "Registered while a scan was in progress")
+        finally:
+            watcher.lock.release()
+
+        loop.run_until_complete(trollius.wait_for(watcher.ScanNow(), 10.0, loop=loop))
+        self.failUnless(self.dirPath in handler.directories, "Not registered by the next scan")
+
+        self.WriteFile("a.py")
+        changes = loop.run_until_complete(trollius.wait_for(watcher.Next(), 10.0, loop=loop))
+        self.failUnlessEqual(changes, [ (os.path.join(self.dirPath, "a.py"), True, False, False) ])
+
+
+class CoalescingTests(FileChangeTestCase):
+    handlerClass = PollingChangeHandler
+
+    def setUp(self):
+        super(CoalescingTests, self).setUp()
+        self.batches = []
+
+    def BatchCallback(self, changes):
+        self.batches.append([ (os.path.relpath(filePath, self.dirPath), added, changed, deleted) for (filePath, added, changed, deleted) in changes ])
+
+    def testCoalescingRules(self):
+        self.WriteFile("changed.py")
+        self.WriteFile("deleted.py")
+        self.WriteFile("replaced.py")
+        handler = self.CreateHandler(batchCallback=self.BatchCallback, coalesceDelay=60.0)
+
+        handler.DispatchFileChange(os.path.join(self.dirPath, "added.py"), added=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "added.py"), changed=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "transient.py"), added=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "transient.py"), changed=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "transient.py"), deleted=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "changed.py"), changed=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "changed.py"), changed=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "deleted.py"), changed=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "deleted.py"), deleted=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "replaced.py"), deleted=True)
+        handler.DispatchFileChange(os.path.join(self.dirPath, "replaced.py"), added=True)
+
+        # The tree has not been quiet for long enough.
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.batches, [])
+
+        handler.DispatchCoalescedFileChanges(force=True)
+        self.failUnlessEqual(self.batches, [ [
+            ("added.py", True, False, False),
+            ("changed.py", False, True, False),
+            ("deleted.py", False, False, True),
+            ("replaced.py", False, True, False),
+        ] ])
+
+    def testBatchPerScan(self):
+        handler = self.CreateHandler(batchCallback=self.BatchCallback)
+
+        self.WriteFile("a.py")
+        self.WriteFile("b.py")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(len(self.batches), 1)
+        self.failUnlessEqual(sorted(self.batches[0]), [ ("a.py", True, False, False), ("b.py", True, False, False) ])
+
+    def testCallbackAfterQuiet(self):
+        handler = self.CreateHandler(coalesceDelay=0.0)
+
+        self.WriteFile("a.py")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py") ])
+
+
+class SnapshotTests(FileChangeTestCase):
+    handlerClass = PollingChangeHandler
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.snapshotPath = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.snapshotPath):
+            os.remove(self.snapshotPath)
+        super(SnapshotTests, self).tearDown()
+
+    def testOfflineChangesReported(self):
+        self.WriteFile("changed.py")
+        self.WriteFile("replaced.py")
+        self.WriteFile("deleted.py")
+        self.WriteFile("unchanged.py")
+
+        handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+        self.failUnless(handler.SaveSnapshot(), "Snapshot not saved")
+        del handler
+
+        self.WriteFile("changed.py", "x = 1\n", mtimeOffset=2)
+        # Same mtime, different size.
+        replacedPath = os.path.join(self.dirPath, "replaced.py")
+        t = os.stat(replacedPath).st_mtime
+        self.WriteFile("replaced.py", "x = 12345\n")
+        os.utime(replacedPath, (t, t))
+        os.remove(os.path.join(self.dirPath, "deleted.py"))
+        self.WriteFile("added.py")
+
+        # Nothing is scanned until the first check.
+        handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+        self.failUnlessEqual(self.PopEvents(), [])
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "added.py"), ("changed", "changed.py"), ("changed", "replaced.py"), ("deleted", "deleted.py") ])
+        self.failUnlessEqual(handler.snapshotState, {})
+
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+    def testUnusableSnapshotIgnored(self):
+        open(self.snapshotPath, "wb").write("garbage")
+        self.WriteFile("existing.py")
+        handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+    def testSnapshotFromOtherVersionIgnored(self):
+        handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+        handler.SaveSnapshot()
+        self.failIf(os.path.exists("%s.%d.tmp" % (self.snapshotPath, os.getpid())), "Temporary file was left behind")
+        self.failUnless(snapshot.Load(self.snapshotPath), "Snapshot was not saved")
+
+        datafile.Save(self.snapshotPath, snapshot.SNAPSHOT_VERSION + 1, ({},))
+        self.failUnlessEqual(snapshot.Load(self.snapshotPath), {})
+
+    def testOtherDirectoriesPrimed(self):
+        handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+        handler.SaveSnapshot()
+
+        otherDirPath = tempfile.mkdtemp()
+        try:
+            open(os.path.join(otherDirPath, "other.py"), "w").write("pass\n")
+            self.WriteFile("new.py")
+
+            handler = self.CreateHandler(snapshotPath=self.snapshotPath)
+            handler.AddDirectory(otherDirPath)
+            handler.ProcessFileEvents()
+            self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+        finally:
+            shutil.rmtree(otherDirPath, ignore_errors=True)
+
+
+class SchedulingTests(TestCase):
+    def testTimingWheel(self):
+        wheel = scheduling.TimingWheel(tickDuration=1.0, slotCount=8, startTime=100.0)
+        wheel.Schedule("a", 3.0, now=100.0)
+        wheel.Schedule("b", 2.0, now=100.0)
+        # Further away than a full turn of the wheel.
+        wheel.Schedule("c", 20.0, now=100.0)
+        wheel.Schedule("d", 5.0, now=100.0)
+        wheel.Cancel("d")
+
+        self.failUnlessEqual(wheel.GetNextDelay(now=100.5), 1.5)
+        self.failUnlessEqual(wheel.Advance(now=101.5), [])
+        self.failUnlessEqual(wheel.Advance(now=103.0), [ "b", "a" ])
+        self.failUnlessEqual(wheel.Advance(now=111.0), [])
+        self.failUnlessEqual(wheel.Advance(now=150.0), [ "c" ])
+        self.failUnlessEqual(len(wheel), 0)
+        self.failUnless(wheel.GetNextDelay() is None, "Nothing should be scheduled")
+
+    def testAdaptiveDelay(self):
+        delay = scheduling.AdaptiveDelay(1.0, 0.1, 5.0, factor=2.0)
+        self.failUnlessEqual(delay.Update(False), 2.0)
+        self.failUnlessEqual(delay.Update(False), 4.0)
+        self.failUnlessEqual(delay.Update(False), 5.0)
+        self.failUnlessEqual(delay.Update(True), 0.1)
+        self.failUnlessEqual(delay.Update(False), 0.2)
+
+    def testScanBudget(self):
+        sleeps = []
+        originalSleep = time.sleep
+        time.sleep = sleeps.append
+        try:
+            budget = scheduling.ScanBudget(0.25, chunkSize=10)
+            budget.chunkStartTime -= 1.0
+            budget.Step(9)
+            self.failUnlessEqual(sleeps, [])
+            budget.Step()
+            # The partial chunk at the end of a scan is paid for too.
+            budget.chunkStartTime -= 1.0
+            budget.Step(5)
+            budget.Finish()
+            budget.Finish()
+        finally:
+            time.sleep = originalSleep
+
+        # A second of scanning is followed by three seconds of not scanning.
+        self.failUnlessEqual(len(sleeps), 2)
+        for sleepTime in sleeps:
+            self.failUnless(2.9 < sleepTime < 3.2, "Unexpected sleep time %f" % sleepTime)
+
+    def testHandlerDelay(self):
+        class Handler(PollingChangeHandler):
+            minimumDelay = 0.5
+            maximumDelay = 8.0
+        handler = Handler(None, delay=1.0, useThread=False)
+        self.failUnlessEqual(handler.GetNextDelay(False), 2.0)
+        self.failUnlessEqual(handler.GetNextDelay(True), 0.5)
+
+        handler = PollingChangeHandler(None, delay=1.0, useThread=False)
+        self.failUnlessEqual(handler.GetNextDelay(False), 1.0)
+
+
+class RegistryTests(FileChangeTestCase):
+    def setUp(self):
+        super(RegistryTests, self).setUp()
+        self.registry = registry.WatcherRegistry()
+
+    def CreateSubscriber(self, **kwargs):
+        handler = registry.SharedChangeHandler(self.Callback, registry=self.registry, **kwargs)
+        handler.AddDirectory(self.dirPath)
+        return handler
+
+    def testOneScanPerDirectory(self):
+        self.WriteFile("existing.py")
+        first = self.CreateSubscriber(delay=60.0)
+        second = self.CreateSubscriber(delay=30.0)
+        self.failUnlessEqual(len(self.registry.watches), 1)
+
+        # Scanning for one subscriber delivers the events to both.
+        self.WriteFile("new.py")
+        first.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("added", "new.py") ])
+        self.failUnlessEqual(self.registry.statistics["watchesChecked"], 1)
+
+        # The directory is dropped with its last subscriber.
+        first.RemoveDirectory(self.dirPath)
+        self.failUnlessEqual(len(self.registry.watches), 1)
+        second.RemoveDirectory(self.dirPath)
+        self.failUnlessEqual(len(self.registry.watches), 0)
+
+    def testDifferentRulesScannedSeparately(self):
+        first = self.CreateSubscriber()
+        second = registry.SharedChangeHandler(self.Callback, registry=self.registry)
+        second.AddDirectory(self.dirPath, pathFilter=pathfilter.PathFilter([ "*.txt" ]))
+        self.failUnlessEqual(len(self.registry.watches), 2)
+
+        self.WriteFile("new.txt")
+        second.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.txt") ])
+
+    def testCallbacksOutsideLock(self):
+        # Subscribers are given paths in the form they registered them.
+        dirPaths = []
+        unlocked = []
+        def Callback(filePath, added=False, changed=False, deleted=False):
+            dirPaths.append(os.path.dirname(filePath))
+            if self.registry.lock.acquire(False):
+                self.registry.lock.release()
+                unlocked.append(filePath)
+
+        first = registry.SharedChangeHandler(Callback, registry=self.registry)
+        first.AddDirectory(self.dirPath)
+        second = registry.SharedChangeHandler(Callback, registry=self.registry)
+        otherDirPath = os.path.join(self.dirPath, "sub", "..")
+        second.AddDirectory(otherDirPath)
+        self.failUnlessEqual(len(self.registry.watches), 1)
+
+        self.WriteFile("new.py")
+        second.ScanNow()
+        self.failUnlessEqual(sorted(dirPaths), sorted([ self.dirPath, otherDirPath ]))
+        self.failUnlessEqual(len(unlocked), 2)
+
+    def testShortestDelayUsed(self):
+        first = self.CreateSubscriber(delay=60.0)
+        second = self.CreateSubscriber(delay=0.05)
+
+        self.WriteFile("new.py")
+        self.failUnless(first.WaitForNextMonitoringCheck(maxDelay=10.0) is not None, "No check happened")
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("added", "new.py") ])
+
+
+class DaemonTests(FileChangeTestCase):
+    def setUp(self):
+        super(DaemonTests, self).setUp()
+        self.socketPath = tempfile.mktemp()
+        self.StartServer()
+
+    def tearDown(self):
+        self.StopServer()
+        super(DaemonTests, self).tearDown()
+
+    def StartServer(self, **kwargs):
+        class Server(daemon.WatcherServer):
+            handlerClass = PollingChangeHandler
+            pollInterval = 0.05
+        for k, v in kwargs.iteritems():
+            setattr(Server, k, v)
+
+        # Scans only happen when requested.
+        self.server = Server(self.socketPath, delay=60.0)
+        self.server.Listen()
+        self.serverThread = threading.Thread(target=self.server.Serve)
+        self.serverThread.start()
+
+    def StopServer(self):
+        self.server.Close()
+        self.serverThread.join(10.0)
+
+    def CreateHandler(self, **kwargs):
+        handler = daemon.DaemonChangeHandler(self.Callback, useThread=False, socketPath=self.socketPath, **kwargs)
+        handler.AddDirectory(self.dirPath)
+        return handler
+
+    def testFileEvents(self):
+        self.WriteFile("existing.py")
+        first = self.CreateHandler()
+        second = self.CreateHandler()
+        self.failUnlessEqual(self.PopEvents(), [])
+        self.failUnlessEqual(len(self.server.watches), 1)
+
+        self.WriteFile("new.py")
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        first.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("changed", "existing.py") ])
+
+        # The other client gets the same changes without another scan.
+        second.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("changed", "existing.py") ])
+
+    def testMissedChangesReplayed(self):
+        self.WriteFile("existing.py")
+        first = self.CreateHandler()
+        second = self.CreateHandler()
+
+        first.daemonConnection.socket.shutdown(socket.SHUT_RDWR)
+        self.WriteFile("new.py")
+        second.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+
+        # Reconnecting catches up on what was missed.
+        first.ProcessFileEvents()
+        self.failUnlessEqual(first.daemonConnection, None)
+        first.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+
+    def testWatcherProcess(self):
+        socketPath = tempfile.mktemp()
+        # Run as a script, rather than with 'python -m' as the notifications are.
+        process = subprocess.Popen([ sys.executable, os.path.join("filechanges", "daemon.py"), socketPath ], cwd=PACKAGE_PARENT_PATH)
+        try:
+            endTime = time.time() + 10.0
+            while not os.path.exists(socketPath) and process.poll() is None and time.time() < endTime:
+                time.sleep(0.05)
+            self.failUnless(os.path.exists(socketPath), "Watcher process did not start listening")
+
+            handler = daemon.DaemonChangeHandler(self.Callback, useThread=False, socketPath=socketPath)
+            handler.AddDirectory(self.dirPath)
+            self.WriteFile("new.py")
+            handler.ScanNow()
+            self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+        finally:
+            if process.poll() is None:
+                process.terminate()
+            process.wait()
+            if os.path.exists(socketPath):
+                os.remove(socketPath)
+
+    def testResyncAfterRestart(self):
+        self.WriteFile("existing.py")
+        self.WriteFile("deleted.py")
+        handler = self.CreateHandler()
+
+        self.StopServer()
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(handler.daemonConnection, None)
+
+        self.WriteFile("new.py")
+        os.remove(os.path.join(self.dirPath, "deleted.py"))
+        self.StartServer()
+
+        # The restarted watcher cannot replay what it never saw, so it sends
+        # its state for the changes to be worked out from.
+        handler.ScanNow()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("deleted", "deleted.py") ])
+
+
+class NotificationTests(FileChangeTestCase):
+    def setUp(self):
+        super(NotificationTests, self).setUp()
+        self.socketPath = tempfile.mktemp()
+        self.results = {}
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.Close()
+            self.server.join(10.0)
+        super(NotificationTests, self).tearDown()
+
+    def NotifiedCallback(self, filePath):
+        self.Callback(filePath, changed=True)
+        return self.results.get(os.path.basename(filePath), True)
+
+    def StartServer(self, handler):
+        class Server(notifications.NotificationServer):
+            pollInterval = 0.05
+        self.server = Server(self.socketPath, handler, self.NotifiedCallback)
+        self.server.start()
+
+    def testCommandLine(self):
+        handler = PollingChangeHandler(self.Callback, delay=60.0)
+        handler.AddDirectory(self.dirPath)
+        self.StartServer(handler)
+
+        filePath = self.WriteFile("a.py")
+        output = subprocess.check_output([ sys.executable, "-m", "filechanges.notifications", self.socketPath, filePath ], cwd=PACKAGE_PARENT_PATH)
+        self.failUnless(("applied %s" % filePath) in output, "Unexpected output %r" % output)
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "a.py") ])
+
+    def testThreadedNotification(self):
+        # The delay is long enough that no scan finds the changes.
+        handler = PollingChangeHandler(self.Callback, delay=60.0)
+        handler.AddDirectory(self.dirPath)
+        self.StartServer(handler)
+
+        filePaths = [ self.WriteFile("a.py"), self.WriteFile("b.py"), self.WriteFile("c.py") ]
+        self.results["b.py"] = False
+        hashes = { filePaths[2]: "0" * 40 }
+        reply = notifications.NotifyFileChanges(self.socketPath, filePaths, hashes)
+        self.failUnless(reply is not None, "No reply")
+        self.failUnlessEqual(reply["results"], { filePaths[0]: "applied", filePaths[1]: "rejected", filePaths[2]: "stale" })
+        self.failUnless(reply["elapsed"] >= 0.0, "No elapsed time")
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "a.py"), ("changed", "b.py") ])
+
+        # A matching hash is passed on.
+        hashes = { filePaths[2]: notifications.GetFileHash(filePaths[2]) }
+        reply = notifications.NotifyFileChanges(self.socketPath, filePaths[2:], hashes)
+        self.failUnlessEqual(reply["results"], { filePaths[2]: "applied" })
+
+    def testQueuedNotification(self):
+        handler = PollingChangeHandler(self.Callback, useThread=False)
+        handler.AddDirectory(self.dirPath)
+        self.StartServer(handler)
+
+        # Without a thread, the change is applied when the handler is next
+        # given the chance.
+        filePath = self.WriteFile("a.py")
+        replies = []
+        thread = threading.Thread(target=lambda: replies.append(notifications.NotifyFileChanges(self.socketPath, [ filePath ])))
+        thread.start()
+        endTime = time.time() + 10.0
+        while not handler.queuedCalls and time.time() < endTime:
+            time.sleep(0.01)
+        self.failUnlessEqual(replies, [])
+        handler.ProcessFileEvents()
+        thread.join(10.0)
+        self.failUnlessEqual(replies[0]["results"], { filePath: "applied" })
+        # The scan then finds the file too.
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "a.py"), ("changed", "a.py") ])
+
+
+class PathFilterTests(TestCase):
+    def testIncludeRules(self):
+        pathFilter = pathfilter.PathFilter(includeRules=[ "*.py", "!setup.py" ])
+        self.failUnless(not pathFilter.IsFileIgnored("a.py"))
+        self.failUnless(not pathFilter.IsFileIgnored("sub/a.py"))
+        self.failUnless(pathFilter.IsFileIgnored("a.pyc"))
+        self.failUnless(pathFilter.IsFileIgnored("setup.py"))
+        # Include rules only apply to the file itself, not its directories.
+        self.failUnless(pathFilter.IsFileIgnored("package.py/README"))
+
+    def testGitignoreRules(self):
+        pathFilter = pathfilter.PathFilter(includeRules=[ "*" ], excludeRules=[
+            "# Build output.",
+            "build/",
+            "",
+            "/vendor",
+            "docs/**/*.py",
+            "*_unittest.py",
+        ])
+
+        self.failUnless(pathFilter.IsDirectoryIgnored("build"))
+        self.failUnless(pathFilter.IsDirectoryIgnored("sub/build"))
+        self.failUnless(pathFilter.IsFileIgnored("sub/build/a.py"))
+        # Directory only rules do not apply to files.
+        self.failUnless(not pathFilter.IsFileIgnored("build"))
+        self.failUnless(pathFilter.IsDirectoryIgnored("vendor"))
+        self.failUnless(not pathFilter.IsDirectoryIgnored("sub/vendor"))
+        self.failUnless(pathFilter.IsFileIgnored("docs/a.py"))
+        self.failUnless(pathFilter.IsFileIgnored("docs/x/y/a.py"))
+        self.failUnless(not pathFilter.IsFileIgnored("sub/docs/a.py"))
+        self.failUnless(pathFilter.IsFileIgnored("sub/a_unittest.py"))
+        self.failUnless(not pathFilter.IsDirectoryIgnored(""))
+
+    def testLastRuleWins(self):
+        pathFilter = pathfilter.PathFilter(excludeRules=[ "*.py", "!keep*.py", "keep_not.py" ])
+        self.failUnless(pathFilter.IsFileIgnored("a.py"))
+        self.failUnless(not pathFilter.IsFileIgnored("keep.py"))
+        self.failUnless(pathFilter.IsFileIgnored("keep_not.py"))
+
+    def testManyRules(self):
+        # More rules than can be held as groups in a single expression.
+        rules = []
+        for i in range(250):
+            rules.append("gen%d_*/" % i)
+            rules.append("!gen%d_keep/" % i)
+        pathFilter = pathfilter.PathFilter(excludeRules=rules)
+        self.failUnless(pathFilter.IsDirectoryIgnored("gen0_x"))
+        self.failUnless(not pathFilter.IsDirectoryIgnored("gen0_keep"))
+        self.failUnless(pathFilter.IsDirectoryIgnored("a/gen249_x"))
+        self.failUnless(not pathFilter.IsDirectoryIgnored("gen249_keep"))
+        self.failUnless(not pathFilter.IsDirectoryIgnored("other"))
+
+
+class InotifyTests(FileChangeTestCase):
+    def setUp(self):
+        if not linuxinotify.IsAvailable():
+            self.skipTest("inotify is not available")
+        super(InotifyTests, self).setUp()
+
+    def testModuleSelection(self):
+        self.failUnless(filechanges.GetFileChangeModule() is linuxinotify, "Native module not chosen")
+        self.failUnless(filechanges.GetFileChangeModule(allowNative=False) is recipe215418, "Polling module not chosen")
+
+    def testFileEvents(self):
+        self.WriteFile("existing.py")
+        handler = self.CreateHandler()
+        self.failUnless(handler.inotifyState is not None, "Not using inotify")
+
+        self.WriteFile("new.py")
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        self.WriteFile("ignored.txt")
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py"), ("changed", "existing.py") ])
+
+        os.remove(os.path.join(self.dirPath, "new.py"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("deleted", "new.py") ])
+
+    def testTouchedFile(self):
+        filePath = self.WriteFile("existing.py")
+        handler = self.CreateHandler()
+
+        # Only the mtime changes, as with 'touch'.
+        t = os.stat(filePath).st_mtime + 2
+        os.utime(filePath, (t, t))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+    def testNestedDirectories(self):
+        innerPath = os.path.join(self.dirPath, "inner")
+        os.makedirs(innerPath)
+        handler = self.CreateHandler()
+        handler.AddDirectory(innerPath, pathFilter=pathfilter.PathFilter([ "*.txt" ]))
+
+        filePath = self.WriteFile(os.path.join("inner", "new.txt"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", os.path.join("inner", "new.txt")) ])
+        self.failUnless(filePath in handler.watchState[innerPath], "Event was recorded for the outer directory")
+
+    def testIncrementalRegistration(self):
+        self.WriteFile(os.path.join("first", "a.py"))
+        self.WriteFile(os.path.join("second", "b.py"))
+        firstPath = os.path.join(self.dirPath, "first")
+        secondPath = os.path.join(self.dirPath, "second")
+        handler = self.handlerClass(self.Callback, useThread=False)
+        handler.AddDirectory(firstPath)
+
+        self.WriteFile(os.path.join("first", "a.py"), "x = 1\n", mtimeOffset=2)
+        handler.AddDirectory(secondPath)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", os.path.join("first", "a.py")) ])
+
+        handler.RemoveDirectory(secondPath)
+        self.failUnlessEqual(handler.watchState.keys(), [ firstPath ])
+        self.failIf(secondPath in handler.inotifyState.watchesByPath, "Watches were kept")
+        self.WriteFile(os.path.join("second", "b.py"), "x = 1\n", mtimeOffset=2)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [])
+
+    def testNewSubdirectoryWatched(self):
+        handler = self.CreateHandler()
+
+        # The file is in place before the watch on its directory can be added.
+        self.WriteFile(os.path.join("sub", "first.py"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", os.path.join("sub", "first.py")) ])
+
+        self.WriteFile(os.path.join("sub", "second.py"))
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("added", os.path.join("sub", "second.py")) ])
+
+    def testQueueOverflowRescan(self):
+        handler = self.CreateHandler()
+        self.WriteFile("new.py")
+
+        # Discard the queued events and pretend the kernel lost them.
+        handler.inotifyState.ReadEvents()
+        originalReadEvents = handler.inotifyState.ReadEvents
+        handler.inotifyState.ReadEvents = lambda: [ (-1, linuxinotify.IN_Q_OVERFLOW, "") ]
+        handler.ProcessFileEvents()
+        handler.inotifyState.ReadEvents = originalReadEvents
+
+        self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+
+    def testWatchLimitFallback(self):
+        self.WriteFile("existing.py")
+
+        originalAddWatch = linuxinotify.InotifyState.AddWatch
+        def AddWatch(self, dirPath):
+            raise linuxinotify.WatchLimitReached(dirPath)
+        linuxinotify.InotifyState.AddWatch = AddWatch
+        try:
+            handler = self.CreateHandler()
+        finally:
+            linuxinotify.InotifyState.AddWatch = originalAddWatch
+
+        self.failUnless(handler.inotifyState is None, "Did not fall back to polling")
+
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+    def testWatchLimitFallbackDuringCheck(self):
+        self.WriteFile("existing.py")
+        handler = self.CreateHandler()
+        self.failUnless(handler.inotifyState is not None, "Not using inotify")
+
+        # The new directory cannot be watched, the changes read with it must
+        # still be reported.
+        self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+        self.WriteFile(os.path.join("sub", "new.py"))
+        originalAddWatch = linuxinotify.InotifyState.AddWatch
+        def AddWatch(self, dirPath):
+            raise linuxinotify.WatchLimitReached(dirPath)
+        linuxinotify.InotifyState.AddWatch = AddWatch
+        try:
+            handler.ProcessFileEvents()
+        finally:
+            linuxinotify.InotifyState.AddWatch = originalAddWatch
+
+        self.failUnless(handler.inotifyState is None, "Did not fall back to polling")
+        self.failUnlessEqual(sorted(self.PopEvents()), [ ("added", os.path.join("sub", "new.py")), ("changed", "existing.py") ])
+
+        self.WriteFile("existing.py", "x = 2\n", mtimeOffset=4)
+        handler.ProcessFileEvents()
+        self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+    def testSnapshot(self):
+        snapshotPath = tempfile.mktemp()
+        try:
+            self.WriteFile("existing.py")
+            handler = self.CreateHandler(snapshotPath=snapshotPath)
+            handler.SaveSnapshot()
+            del handler
+
+            self.WriteFile("existing.py", "x = 1\n", mtimeOffset=2)
+            handler = self.CreateHandler(snapshotPath=snapshotPath)
+            self.failUnless(handler.inotifyState is not None, "Not using inotify")
+            handler.ProcessFileEvents()
+            self.failUnlessEqual(self.PopEvents(), [ ("changed", "existing.py") ])
+
+            # Watches are in place for later changes.
+            self.WriteFile("new.py")
+            handler.ProcessFileEvents()
+            self.failUnlessEqual(self.PopEvents(), [ ("added", "new.py") ])
+        finally:
+            if os.path.exists(snapshotPath):
+                os.remove(snapshotPath)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    unittest.main()
@@ -6,7 +6,7 @@
 #
 
 import unittest
-import os, sys, time, math
+import os, sys, time, math, tempfile, shutil
 import inspect, copy
 import logging
 
@@ -26,10 +26,17 @@ logger = logging.getLogger("reloader")
 
 import namespace
 import reloader
+import bundle
+import codecache
+import dependencies
+from filechanges import notifications
 
 class ReloadableScriptDirectoryNoUnitTesting(reloader.ReloadableScriptDirectory):
     unitTest = False
 
+class ReloadableBundleScriptDirectoryNoUnitTesting(reloader.ReloadableBundleScriptDirectory):
+    unitTest = False
+
 class CodeReloadingTestCase(TestCase):
     def setUp(self):
         self.codeReloader = None
@@ -916,6 +923,478 @@ class CodeReloaderSupportTests(CodeReloadingTestCase):
         newDocString = game.FileChangeFunction.__doc__
         self.failUnless(newDocString == " new version ", "Updated function doc string value '"+ newDocString +"'")
 
+    def testFileChangeScanNow(self):
+        """
+        This test is intended to verify that a requested scan applies file changes before returning.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+
+        # A check delay long enough that only requested scans will find changes.
+        cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=True, fileChangeCheckDelay=60.0)
+        cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+        scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+        self.failUnless(scriptDirectory is not None, "Script loading failure")
+        self.failUnless(cr.ScanNow(timeout=10.0), "Requested scan did not happen")
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        sourceScriptFilePath = os.path.join(script2DirPath, "fileChange_Before.py")
+        open(scriptFilePath, "w").write(open(sourceScriptFilePath, "r").read())
+        self.failUnless(cr.ScanNow(timeout=10.0), "Requested scan did not happen")
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(scriptDirectory.FindScript(scriptFilePath) is not None, "Script not loaded after a requested scan")
+
+        import game
+        self.failUnless(game.FileChangeFunction.__doc__ == " old version ", "Expected function doc string value not present")
+
+    def testFileChangeNotification(self):
+        """
+        This test is intended to verify that files reported as changed are applied before the reply.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+        socketPath = tempfile.mktemp()
+
+        # A check delay long enough that no scan will find the change.
+        cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=True, fileChangeCheckDelay=60.0)
+        cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+        scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+        self.failUnless(scriptDirectory is not None, "Script loading failure")
+        cr.StartNotificationServer(socketPath)
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            sourceScriptFilePath = os.path.join(script2DirPath, "fileChange_Before.py")
+            open(scriptFilePath, "w").write(open(sourceScriptFilePath, "r").read())
+            reply = notifications.NotifyFileChanges(socketPath, [ scriptFilePath ])
+        finally:
+            cr.StopNotificationServer()
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(reply is not None, "No reply to the notification")
+        self.failUnless(reply["results"] == { scriptFilePath: "applied" }, "Notified change not applied")
+        self.failUnless(scriptDirectory.FindScript(scriptFilePath) is not None, "Script not loaded on notification")
+
+        import game
+        self.failUnless(game.FileChangeFunction.__doc__ == " old version ", "Expected function doc string value not present")
+
+    def testAsyncFileChangeNotification(self):
+        """
+        This test is intended to verify that files reported as changed are applied on the event loop of an async code reloader.
+        """
+        try:
+            import trollius
+        except ImportError:
+            self.skipTest("trollius is not available")
+        import asyncreloader
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+        socketPath = tempfile.mktemp()
+
+        loop = trollius.new_event_loop()
+        self.addCleanup(loop.close)
+        trollius.set_event_loop(loop)
+        self.addCleanup(trollius.set_event_loop, None)
+
+        cr = self.codeReloader = asyncreloader.AsyncCodeReloader(monitorFileChanges=True)
+        cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+        scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+        self.failUnless(scriptDirectory is not None, "Script loading failure")
+        cr.StartNotificationServer(socketPath)
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            sourceScriptFilePath = os.path.join(script2DirPath, "fileChange_Before.py")
+            open(scriptFilePath, "w").write(open(sourceScriptFilePath, "r").read())
+            # The sender waits in an executor, while the loop applies the change.
+            reply = loop.run_until_complete(trollius.wait_for(loop.run_in_executor(None, notifications.NotifyFileChanges, socketPath, [ scriptFilePath ]), 15.0, loop=loop))
+        finally:
+            cr.StopNotificationServer()
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(reply is not None, "No reply to the notification")
+        self.failUnless(reply["results"] == { scriptFilePath: "applied" }, "Notified change not applied")
+        self.failUnless(scriptDirectory.FindScript(scriptFilePath) is not None, "Script not loaded on notification")
+
+    def testUnchangedScriptNotReloaded(self):
+        """
+        This test is intended to verify that changes which do not affect what a script does, do not reload it.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+
+        beforeScript = open(os.path.join(script2DirPath, "fileChange_Before.py"), "r").read()
+        open(scriptFilePath, "w").write(beforeScript)
+
+        cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False)
+        cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+        scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+        self.failUnless(scriptDirectory is not None, "Script loading failure")
+
+        scriptFile = scriptDirectory.FindScript(scriptFilePath)
+        version = scriptFile.version
+        import game
+        function = game.FileChangeFunction
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        # The same contents, as after a touch.
+        cr.ProcessChangedFile(scriptFilePath, changed=True)
+        self.failUnless(scriptFile.version == version, "Unchanged script was reloaded")
+
+        # Only comments and blank lines are added.
+        open(scriptFilePath, "w").write("# A comment.\n\n"+ beforeScript)
+        cr.ProcessChangedFile(scriptFilePath, changed=True)
+        self.failUnless(scriptFile.version == version, "Script with only new comments was reloaded")
+        self.failUnless(game.FileChangeFunction is function, "Script with only new comments was rerun")
+        self.failUnless(function.func_code.co_firstlineno == beforeScript.splitlines().index("def FileChangeFunction():") + 3, "Line numbers were not updated")
+
+        # The code is changed.
+        open(scriptFilePath, "w").write(open(os.path.join(script2DirPath, "fileChange_After.py"), "r").read())
+        cr.ProcessChangedFile(scriptFilePath, changed=True)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(scriptFile.version == version + 1, "Changed script was not reloaded")
+        self.failUnless(game.FileChangeFunction.__doc__ == " new version ", "Changed script was not reloaded")
+
+    def testCodeCache(self):
+        """
+        This test is intended to verify that compiled scripts are reused from the code cache while they are unchanged.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+        cacheDirPath = tempfile.mkdtemp()
+
+        open(scriptFilePath, "w").write(open(os.path.join(script2DirPath, "fileChange_Before.py"), "r").read())
+
+        try:
+            cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False, codeCachePath=cacheDirPath)
+            cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+            scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+            self.failUnless(scriptDirectory is not None, "Script loading failure")
+            statistics = cr.codeCache.statistics
+            scriptCount = len(scriptDirectory.filesByPath)
+            self.failUnless(statistics["misses"] == scriptCount and statistics["hits"] == 0, "Scripts found in an empty code cache")
+            self.failUnless(statistics["writes"] == scriptCount, "Compiled scripts not written to the code cache")
+
+            ## BEHAVIOUR TO BE TESTED:
+
+            cr.RemoveDirectory(scriptDirPath)
+            scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+            self.failUnless(scriptDirectory is not None, "Script loading failure")
+            hits = statistics["hits"]
+
+            open(scriptFilePath, "w").write(open(os.path.join(script2DirPath, "fileChange_After.py"), "r").read())
+            cr.ProcessChangedFile(scriptFilePath, changed=True)
+        finally:
+            shutil.rmtree(cacheDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(hits == scriptCount, "Unchanged scripts not taken from the code cache")
+        self.failUnless(statistics["hits"] == hits and statistics["writes"] == scriptCount + 1, "Changed script taken from the code cache")
+
+        import game
+        self.failUnless(game.FileChangeFunction.__doc__ == " new version ", "Changed script was not reloaded")
+
+    def testCodeCacheSameSizeAndMtime(self):
+        """
+        This test is intended to verify that a script rewritten with the same size and mtime is not given its old code.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = tempfile.mkdtemp()
+        scriptFilePath = os.path.join(scriptDirPath, "a.py")
+        cacheDirPath = tempfile.mkdtemp()
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            codeCache = codecache.CodeCache(cacheDirPath)
+            open(scriptFilePath, "w").write("x = 1\n")
+            t = os.stat(scriptFilePath)
+            namespace.ScriptFile(scriptFilePath, None, codeCache=codeCache)
+
+            open(scriptFilePath, "w").write("x = 2\n")
+            os.utime(scriptFilePath, (t.st_atime, t.st_mtime))
+            scriptFile = namespace.ScriptFile(scriptFilePath, None, codeCache=codeCache)
+            scriptGlobals = {}
+            exec scriptFile.codeObject in scriptGlobals
+        finally:
+            shutil.rmtree(scriptDirPath)
+            shutil.rmtree(cacheDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(scriptGlobals["x"] == 2, "Stale code taken from the code cache")
+        self.failUnless(codeCache.statistics["hits"] == 0 and codeCache.statistics["misses"] == 2, "Rewritten script found in the code cache")
+
+    def testBundleLoading(self):
+        """
+        This test is intended to verify that scripts load from a bundle as they would from their directory, and can be overridden.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        script2DirPath = scriptDirPath +"2"
+        bundleDirPath = tempfile.mkdtemp()
+        bundlePath = os.path.join(bundleDirPath, "scripts.bundle")
+
+        try:
+            scriptCount = bundle.PackDirectory(scriptDirPath, bundlePath, ReloadableScriptDirectoryNoUnitTesting)
+
+            ## BEHAVIOUR TO BE TESTED:
+
+            cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False)
+            cr.bundleDirectoryClass = ReloadableBundleScriptDirectoryNoUnitTesting
+            scriptDirectory = cr.AddBundle("game", bundlePath)
+            self.failUnless(scriptDirectory is not None, "Bundle loading failure")
+            bundledPaths = sorted(scriptDirectory.filesByPath)
+            import game
+            gameFilePaths = game.__file__.split(";")
+            cr.RemoveDirectory(scriptDirPath)
+
+            # A script which is not in the bundle.
+            open(scriptFilePath, "w").write(open(os.path.join(script2DirPath, "fileChange_Before.py"), "r").read())
+            scriptDirectory = cr.AddBundle("game", bundlePath, sourceOverrides=True)
+            self.failUnless(scriptDirectory is not None, "Bundle loading failure")
+        finally:
+            shutil.rmtree(bundleDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(len(bundledPaths) == scriptCount, "Bundled scripts not all loaded")
+        self.failUnless(all(filePath.startswith(scriptDirPath) and os.path.exists(filePath) for filePath in bundledPaths), "Bundled scripts given the wrong paths")
+        self.failUnless(all(filePath in bundledPaths for filePath in gameFilePaths), "Namespace file paths do not match the bundled scripts")
+        self.failUnless(scriptFilePath not in bundledPaths, "Scratch script unexpectedly bundled")
+
+        self.failUnless(scriptDirectory.FindScript(scriptFilePath) is not None, "Script overriding the bundle not loaded")
+        import game
+        self.failUnless(game.FileChangeFunction.__doc__ == " old version ", "Script overriding the bundle not run")
+
+    def testParallelCompilation(self):
+        """
+        This test is intended to verify that scripts compiled by worker processes are loaded, and their errors still raised.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = GetScriptDirectory()
+        scriptFilePath = os.path.join(scriptDirPath, "fileChange.py")
+        compiledCounts = []
+
+        class ParallelScriptDirectory(ReloadableScriptDirectoryNoUnitTesting):
+            compileProcesses = 2
+
+            def CompileScripts(self, filePaths):
+                ReloadableScriptDirectoryNoUnitTesting.CompileScripts(self, filePaths)
+                compiledCounts.append(len(self.compiledScripts))
+
+        cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False)
+        cr.scriptDirectoryClass = ParallelScriptDirectory
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        scriptDirectory = cr.AddDirectory("game", scriptDirPath)
+        self.failUnless(scriptDirectory is not None, "Script loading failure")
+        scriptCount = len(scriptDirectory.filesByPath)
+        cr.RemoveDirectory(scriptDirPath)
+
+        open(scriptFilePath, "w").write("def Broken(:\n")
+        try:
+            cr.AddDirectory("game", scriptDirPath)
+        except SyntaxError, e:
+            syntaxError = e
+        else:
+            syntaxError = None
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(compiledCounts[0] == scriptCount, "Scripts not compiled by the worker processes")
+        self.failUnless(len(scriptDirectory.compiledScripts) == 0, "Compiled scripts left unused")
+        self.failUnless(syntaxError is not None and syntaxError.filename == scriptFilePath, "Syntax error in a worker process not raised for the script")
+
+    def testDependencyOrdering(self):
+        """
+        This test is intended to verify that scripts are run once each in dependency order, and that cycles are found.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = tempfile.mkdtemp()
+        scripts = {
+            "a.py": "import ordering\nclass Derived(ordering.Base):\n    pass\n",
+            "b.py": "import ordering\nclass Base(object):\n    def Func(self):\n        return ordering.Derived\n",
+            "c.py": "from ordering import Derived\nInstance = Derived()\n",
+        }
+        for fileName, script in scripts.iteritems():
+            open(os.path.join(scriptDirPath, fileName), "w").write(script)
+        runCounts = {}
+
+        class CountingScriptDirectory(ReloadableScriptDirectoryNoUnitTesting):
+            def RunScript(self, scriptFile, tentative=False):
+                fileName = os.path.basename(scriptFile.filePath)
+                runCounts[fileName] = runCounts.get(fileName, 0) + 1
+                return ReloadableScriptDirectoryNoUnitTesting.RunScript(self, scriptFile, tentative)
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False)
+            cr.scriptDirectoryClass = CountingScriptDirectory
+            scriptDirectory = cr.AddDirectory("ordering", scriptDirPath)
+            self.failUnless(scriptDirectory is not None, "Script loading failure")
+
+            # 'c' and 'd' need each other's contributions to run.
+            open(os.path.join(scriptDirPath, "c.py"), "w").write("import ordering\nX = ordering.Y\n")
+            open(os.path.join(scriptDirPath, "d.py"), "w").write("import ordering\nY = ordering.X\n")
+            cycleDirectory = namespace.ScriptDirectory(scriptDirPath, "ordering")
+            cycleDirectory.LoadDirectory(scriptDirPath)
+            order, cycles, dependenciesByScript = dependencies.OrderScripts(set(cycleDirectory.filesByPath.itervalues()), "ordering")
+        finally:
+            shutil.rmtree(scriptDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(runCounts == { "a.py": 1, "b.py": 1, "c.py": 1 }, "Scripts not run once each (%s)" % runCounts)
+
+        self.failUnless([ os.path.basename(scriptFile.filePath) for scriptFile in order ] == [ "b.py", "a.py" ], "Scripts not ordered by dependency")
+        self.failUnless([ [ os.path.basename(scriptFile.filePath) for scriptFile in cycle ] for cycle in cycles ] == [ [ "c.py", "d.py" ] ], "Dependency cycle not found")
+
+    def testDependencyOrderingSharedImports(self):
+        """
+        This test is intended to verify that scripts importing the same name from their namespace do not depend on each other.
+        """
+        scriptDirPath = tempfile.mkdtemp()
+        scripts = {
+            "base.py": "class Base(object):\n    pass\n",
+            "a.py": "from ordx import Base\nclass A(Base):\n    pass\n",
+            "c.py": "from ordx import Base\nclass C(Base):\n    pass\n",
+        }
+        try:
+            for fileName, script in scripts.iteritems():
+                open(os.path.join(scriptDirPath, fileName), "w").write(script)
+            scriptDirectory = namespace.ScriptDirectory(scriptDirPath, "ordx")
+            scriptDirectory.LoadDirectory(scriptDirPath)
+            order, cycles, dependenciesByScript = dependencies.OrderScripts(set(scriptDirectory.filesByPath.itervalues()), "ordx")
+        finally:
+            shutil.rmtree(scriptDirPath)
+
+        self.failUnless([ os.path.basename(scriptFile.filePath) for scriptFile in order ] == [ "base.py", "a.py", "c.py" ], "Scripts importing the same name not ordered")
+        self.failUnless(cycles == [], "Scripts importing the same name found to depend on each other")
+
+    def testLoadOrderManifest(self):
+        """
+        This test is intended to verify that the recorded load order is replayed, other than for changed scripts.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = tempfile.mkdtemp()
+        manifestDirPath = tempfile.mkdtemp()
+        open(os.path.join(scriptDirPath, "a.py"), "w").write("import ordering\nclass Derived(ordering.Base):\n    pass\n")
+        open(os.path.join(scriptDirPath, "b.py"), "w").write("class Base(object):\n    pass\n")
+        orderedFileNames = []
+
+        class RecordingScriptDirectory(ReloadableScriptDirectoryNoUnitTesting):
+            def RunScriptsInOrder(self, scriptFiles):
+                orderedFileNames.append(sorted(os.path.basename(scriptFile.filePath) for scriptFile in scriptFiles))
+                return ReloadableScriptDirectoryNoUnitTesting.RunScriptsInOrder(self, scriptFiles)
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False, loadOrderManifestDirPath=manifestDirPath)
+            cr.scriptDirectoryClass = RecordingScriptDirectory
+            for i in range(3):
+                if i == 2:
+                    open(os.path.join(scriptDirPath, "a.py"), "a").write("Value = 1\n")
+                scriptDirectory = cr.AddDirectory("ordering", scriptDirPath)
+                self.failUnless(scriptDirectory is not None, "Script loading failure")
+                # Scripts loaded after the directory are not recorded.
+                extraFilePath = os.path.join(scriptDirPath, "c.py")
+                open(extraFilePath, "w").write("Extra = 1\n")
+                self.failUnless(cr.LoadScript(extraFilePath), "Script loading failure")
+                os.remove(extraFilePath)
+                loadOrder = scriptDirectory.loadOrder
+                cr.RemoveDirectory(scriptDirPath)
+        finally:
+            shutil.rmtree(scriptDirPath)
+            shutil.rmtree(manifestDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(orderedFileNames[0] == [ "a.py", "b.py" ], "Scripts ordered from a manifest before there was one")
+        self.failUnless(orderedFileNames[1] == [], "Unchanged scripts not run from the manifest")
+        self.failUnless(orderedFileNames[2] == [ "a.py" ], "Changed script run from the manifest")
+        self.failUnless(loadOrder is None, "Load order recorded outside of loading")
+
+    def testLoadOrderManifestChangedDependency(self):
+        """
+        This test is intended to verify that scripts depending on a changed script are not replayed before it.
+        """
+
+        ## PREPARATION:
+
+        scriptDirPath = tempfile.mkdtemp()
+        manifestDirPath = tempfile.mkdtemp()
+        runsFilePath = os.path.join(manifestDirPath, "runs.txt")
+        open(os.path.join(scriptDirPath, "a.py"), "w").write("open(%r, 'a').write('a\\n')\nfrom ordering import Base\nclass Derived(Base):\n    pass\n" % runsFilePath)
+        open(os.path.join(scriptDirPath, "b.py"), "w").write("class Base(object):\n    pass\n")
+
+        ## BEHAVIOUR TO BE TESTED:
+
+        try:
+            cr = self.codeReloader = reloader.CodeReloader(monitorFileChanges=False, loadOrderManifestDirPath=manifestDirPath)
+            cr.scriptDirectoryClass = ReloadableScriptDirectoryNoUnitTesting
+            runCounts = []
+            for i in range(2):
+                if i == 1:
+                    open(os.path.join(scriptDirPath, "b.py"), "a").write("Value = 1\n")
+                open(runsFilePath, "w").close()
+                scriptDirectory = cr.AddDirectory("ordering", scriptDirPath)
+                self.failUnless(scriptDirectory is not None, "Script loading failure")
+                cr.RemoveDirectory(scriptDirPath)
+                runCounts.append(len(open(runsFilePath).readlines()))
+        finally:
+            shutil.rmtree(scriptDirPath)
+            shutil.rmtree(manifestDirPath)
+
+        ## ACTUAL TESTS:
+
+        self.failUnless(runCounts == [ 1, 1 ], "Script depending on a changed script was run more than once")
+
     def testScriptUnitTesting(self):
         """
         This test is intended to verify that local unit test failure equals code loading failure.